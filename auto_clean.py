@@ -0,0 +1,241 @@
+import json
+import os
+import time
+
+from ms_metadata import get_ms_index
+from selfcal import image_stats
+from stage_cache import run_stage
+
+# auto-multithresh parameters for the 7m array and for the 12m array
+# with a 75th percentile baseline below 300m (compact) or above 400m
+# (extended), from the CASA automasking guide. The 12m values are
+# interpolated in between. The negativethreshold applies to cubes;
+# continuum images don't mask negative emission.
+AUTOMASK_PRESETS = {'7m': {'sidelobethreshold': 1.25,
+                           'noisethreshold': 5.0,
+                           'lownoisethreshold': 2.0,
+                           'minbeamfrac': 0.1,
+                           'negativethreshold': 10.0},
+                    '12m-compact': {'sidelobethreshold': 2.0,
+                                    'noisethreshold': 4.25,
+                                    'lownoisethreshold': 1.5,
+                                    'minbeamfrac': 0.3,
+                                    'negativethreshold': 15.0},
+                    '12m-extended': {'sidelobethreshold': 3.0,
+                                     'noisethreshold': 5.0,
+                                     'lownoisethreshold': 1.5,
+                                     'minbeamfrac': 0.3,
+                                     'negativethreshold': 7.0}}
+
+# Bands 8-10 have higher and more variable atmospheric phase noise, so
+# the mask is not grown as far into low level emission.
+HIGH_FREQ_LOWNOISETHRESHOLD = 2.0
+
+# niter used with autoclean. The threshold, not niter, stops clean.
+AUTO_NITER = 100000
+
+# Number of channels used for the quick dirty cube that sets the noise.
+NOISE_CHANNELS = 10
+
+# File with one line per image cleaned with autoclean.
+CLEAN_SUMMARY = 'clean_summary.txt'
+
+
+def automask_preset(vis, specmode='mfs'):
+
+    """
+    This function returns the auto-multithresh parameters for imaging
+    vis, chosen from AUTOMASK_PRESETS by array (7m, 12m, or mixed, which
+    uses the 7m values) and the 75th percentile baseline length, with
+    an adjustment for Bands 8-10. The negativethreshold is only used
+    for cubes.
+
+    Example:
+        pars = automask_preset('calibrated_final_cont.ms')
+    """
+
+    index = get_ms_index(vis)
+
+    if index['array'] != '12m':
+        pars = dict(AUTOMASK_PRESETS['7m'])
+    else:
+        compact = AUTOMASK_PRESETS['12m-compact']
+        extended = AUTOMASK_PRESETS['12m-extended']
+        frac = min(max((index['baseline_75'] - 300.0) / 100.0, 0.0), 1.0)
+        pars = dict((key, compact[key] + frac * (extended[key] - compact[key]))
+                    for key in compact)
+
+    bands = [spw['band'] for spw in index['spws']
+             if spw['id'] in index['science_spws']]
+    if bands and min(bands) >= 8:
+        pars['lownoisethreshold'] = max(pars['lownoisethreshold'],
+                                        HIGH_FREQ_LOWNOISETHRESHOLD)
+
+    if specmode == 'mfs':
+        pars['negativethreshold'] = 0.0
+
+    pars.update({'usemask': 'auto-multithresh',
+                 'dogrowprune': True,
+                 'growiterations': 75,
+                 'minpercentchange': 1.0,
+                 'fastnoise': specmode == 'mfs'})
+
+    return pars
+
+
+def estimate_noise(vis, imagename, params, usecache=True):
+
+    """
+    This function estimates the noise (in Jy/beam) of the image that
+    tclean would make with params from a quick dirty image
+    (imagename + '_dirty', niter=0). For cubes only the first
+    NOISE_CHANNELS channels are imaged, which are usually line-free.
+    The noise is a robust estimate (1.4826 x median absolute
+    deviation), so it isn't biased by the source.
+
+    Example:
+        rms = estimate_noise(contvis, contimagename, imagepars)
+    """
+
+    pars = dict(params)
+    for key in ['vis', 'imagename', 'mask', 'usemask', 'savemodel',
+                'startmodel', 'restart', 'calcres', 'calcpsf']:
+        pars.pop(key, None)
+    pars.update({'niter': 0, 'interactive': False, 'pbcor': False})
+    if pars.get('specmode', 'mfs') != 'mfs':
+        if pars.get('nchan', -1) <= 0 or pars['nchan'] > NOISE_CHANNELS:
+            pars['nchan'] = NOISE_CHANNELS
+        pars['restoringbeam'] = ''
+
+    run_stage('tclean', usecache=usecache,
+              vis=vis, imagename=imagename + '_dirty', **pars)
+
+    return image_stats(imagename + '_dirty')[1]
+
+
+def auto_clean_pars(vis, imagename, params, nsigma=4.0, usecache=True):
+
+    """
+    This function returns a copy of the tclean parameters params set
+    up for non-interactive cleaning: interactive=False,
+    auto-multithresh masking with the preset for vis (see
+    automask_preset), niter=AUTO_NITER, and a threshold of nsigma times
+    the noise of a quick dirty image (see estimate_noise). It also
+    returns the noise.
+
+    Example:
+        (pars, rms) = auto_clean_pars(contvis, contimagename, imagepars)
+    """
+
+    rms = estimate_noise(vis, imagename, params, usecache=usecache)
+
+    pars = dict(params)
+    pars.update(automask_preset(vis, pars.get('specmode', 'mfs')))
+    pars.update({'interactive': False,
+                 'niter': max(pars.get('niter', 0), AUTO_NITER),
+                 'threshold': '%.4gmJy' % (nsigma * rms * 1.0e3)})
+
+    return (pars, rms)
+
+
+def record_clean(imagename, pars, result, dirtyrms, summaryfile=CLEAN_SUMMARY):
+
+    """
+    This function records a non-interactive clean: the threshold, the
+    noise of the dirty image, the number of iterations and major
+    cycles, the stop reason, and the peak and rms of the final image.
+    The record is written to imagename + '.clean.json' and a line is
+    added to summaryfile, so the numbers don't have to be noted by hand
+    for the PI. If the clean was skipped because its products were up
+    to date, the previous record is returned.
+    """
+
+    recordfile = imagename + '.clean.json'
+    if result is None and os.path.isfile(recordfile):
+        with open(recordfile, 'r') as f:
+            return json.load(f)
+
+    result = result if isinstance(result, dict) else {}
+    (peak, rms, snr) = image_stats(imagename)
+
+    record = {'image': imagename,
+              'threshold': pars['threshold'],
+              'dirtyrms': dirtyrms,
+              'niter': pars['niter'],
+              'iterdone': result.get('iterdone'),
+              'nmajordone': result.get('nmajordone'),
+              'stopcode': result.get('stopcode'),
+              'peak': peak,
+              'rms': rms,
+              'snr': snr,
+              'automask': dict((key, pars[key]) for key in
+                               ['sidelobethreshold', 'noisethreshold',
+                                'lownoisethreshold', 'minbeamfrac',
+                                'negativethreshold']),
+              'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+    with open(recordfile, 'w') as f:
+        json.dump(record, f, indent=1)
+
+    newfile = not os.path.isfile(summaryfile)
+    with open(summaryfile, 'a') as f:
+        if newfile:
+            f.write('%-40s %12s %12s %8s %6s %12s %12s %8s %s\n' %
+                    ('image', 'threshold', 'dirtyrms(Jy)', 'iter', 'major',
+                     'peak(Jy)', 'rms(Jy)', 'peakSNR', 'date'))
+        f.write('%-40s %12s %12.4g %8s %6s %12.5g %12.4g %8.1f %s\n' %
+                (imagename, record['threshold'], dirtyrms,
+                 record['iterdone'], record['nmajordone'], peak, rms, snr,
+                 record['date']))
+
+    print("Cleaned %s to %s: %s iterations, rms %.3g Jy/beam, peak SNR %.1f" %
+          (imagename, record['threshold'], record['iterdone'], rms, snr))
+
+    return record
+
+
+def auto_tclean(nsigma=4.0, usecache=True, reclean=False, **params):
+
+    """
+    This function runs tclean non-interactively with the parameters
+    params, overriding the mask, niter, and threshold as described in
+    auto_clean_pars, and records the result (see record_clean). Like
+    stage_cache.run_stage, the clean is skipped if its products are up
+    to date unless usecache is False, and with reclean=True a clean
+    whose imaging parameters are unchanged is continued from its
+    existing psf, residual, and model (see stage_cache.can_reclean).
+    It returns the clean record.
+
+    Example:
+        auto_tclean(vis=contvis, imagename=contimagename, field='0',
+                    imsize=[128,128], cell='1arcsec', specmode='mfs',
+                    weighting='briggs', robust=0.5, gridder='standard')
+    """
+
+    vis = params['vis']
+    imagename = params['imagename']
+    (pars, rms) = auto_clean_pars(vis, imagename, params, nsigma=nsigma,
+                                  usecache=usecache)
+    result = run_stage('tclean', usecache=usecache, reclean=reclean, **pars)
+
+    return record_clean(imagename, pars, result, rms)
+
+
+def autoclean_task(nsigma=4.0, usecache=True, reclean=False):
+
+    """
+    This function returns a version of tclean that cleans
+    non-interactively (see auto_tclean), like stage_cache.cached_task.
+    Any interactive, niter, threshold, and mask settings in the calls
+    are replaced. usecache and reclean are passed on to
+    stage_cache.run_stage.
+
+    Example:
+        tclean = autoclean_task(nsigma=4.0)
+    """
+
+    def tclean(**params):
+        return auto_tclean(nsigma=nsigma, usecache=usecache, reclean=reclean,
+                           **params)
+
+    return tclean
@@ -0,0 +1,465 @@
+import os
+
+import numpy as np
+
+from ms_metadata import get_ms_index
+
+# Maximum width in Hz of an averaged continuum channel for each ALMA
+# band. These limits keep the bandwidth smearing loss of peak flux at the
+# edge of the primary beam to about 5% (see the "for continuum" section
+# of the imaging wiki). Bands 1 and 2 and Bands 8-10 aren't covered by
+# the wiki, so their limits are scaled from the neighboring bands.
+MAX_CONT_CHANWIDTH = {1: 62.5e6,
+                      2: 125.0e6,
+                      3: 125.0e6,
+                      4: 125.0e6,
+                      5: 125.0e6,
+                      6: 125.0e6,
+                      7: 250.0e6,
+                      8: 250.0e6,
+                      9: 250.0e6,
+                      10: 250.0e6}
+
+# Speed of light in m/s.
+C = 299792458.0
+
+
+def _parse_ids(ids):
+
+    """
+    This function turns a list of ids given as a comma separated string
+    (e.g., '0,1,2'), a single integer, or a list into a list of
+    integers. An empty string gives an empty list.
+    """
+
+    if isinstance(ids, str):
+        return [int(i) for i in ids.split(',') if i.strip() != '']
+    if isinstance(ids, int):
+        return [ids]
+
+    return [int(i) for i in ids]
+
+
+def average_spectra(vis, spws='', field='', maxuv=0.0, datacolumn='DATA',
+                    chunksize=100000):
+
+    """
+    This function returns the time- and baseline-averaged spectrum of
+    each spectral window of vis, reading the data once in chunks of
+    chunksize rows. The visibilities are vector averaged over time,
+    baselines, and the parallel-hand correlations using the data
+    weights, and flagged data are excluded. Autocorrelations are
+    skipped.
+
+    If maxuv is greater than 0, only baselines with a uv distance
+    shorter than maxuv (in meters) are used. Limiting the average to
+    short baselines greatly improves the visibility of lines with
+    extended emission. The field parameter is a comma separated list
+    of field ids; by default all fields are used.
+
+    It returns a dictionary mapping each spw to a tuple of (amplitude
+    spectrum, valid channel mask).
+
+    Example:
+        spectra = average_spectra('calibrated_final.ms', spws='0,1,2,3',
+                                  maxuv=100.0)
+    """
+
+    from casatools import table
+
+    tb = table()
+    tb.open(os.path.join(vis, 'DATA_DESCRIPTION'))
+    ddspws = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+
+    spwlist = _parse_ids(spws) if spws != '' else sorted(set(int(s) for s in ddspws))
+    fieldlist = _parse_ids(field)
+
+    spectra = {}
+    tb.open(vis)
+    for spw in spwlist:
+        ddids = [dd for dd in range(len(ddspws)) if ddspws[dd] == spw]
+        if not ddids:
+            continue
+
+        query = 'DATA_DESC_ID IN [%s] && ANTENNA1 != ANTENNA2' % \
+            ','.join(map(str, ddids))
+        if fieldlist:
+            query += ' && FIELD_ID IN [%s]' % ','.join(map(str, fieldlist))
+        subtb = tb.query(query)
+
+        datasum = None
+        wtsum = None
+        nrows = subtb.nrows()
+        for startrow in range(0, nrows, chunksize):
+            nrow = min(chunksize, nrows - startrow)
+            data = subtb.getcol(datacolumn, startrow, nrow)
+            flag = subtb.getcol('FLAG', startrow, nrow)
+            weight = subtb.getcol('WEIGHT', startrow, nrow)
+
+            if maxuv > 0:
+                uvw = subtb.getcol('UVW', startrow, nrow)
+                keep = np.hypot(uvw[0], uvw[1]) < maxuv
+                data = data[..., keep]
+                flag = flag[..., keep]
+                weight = weight[..., keep]
+
+            # parallel hands only (XX,YY or XX of XX,XY,YX,YY)
+            corrs = [0, data.shape[0] - 1] if data.shape[0] > 1 else [0]
+            data = data[corrs]
+            flag = flag[corrs]
+            weight = weight[corrs][:, np.newaxis, :] * ~flag
+
+            if datasum is None:
+                datasum = np.zeros(data.shape[1], dtype=complex)
+                wtsum = np.zeros(data.shape[1])
+            datasum += (data * weight).sum(axis=(0, 2))
+            wtsum += weight.sum(axis=(0, 2))
+
+        subtb.close()
+
+        if datasum is None:
+            continue
+
+        valid = wtsum > 0
+        spectrum = np.zeros(len(wtsum))
+        spectrum[valid] = np.abs(datasum[valid] / wtsum[valid])
+        spectra[spw] = (spectrum, valid)
+
+    tb.close()
+
+    return spectra
+
+
+def _runs(mask):
+
+    """
+    This function returns the start and end channels (inclusive) of
+    each run of True values in a boolean array.
+    """
+
+    edges = np.diff(np.concatenate(([0], mask.astype(int), [0])))
+    starts = np.where(edges == 1)[0]
+    ends = np.where(edges == -1)[0] - 1
+
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def find_line_channels(spectrum, valid=None, nsigma=4.0, fitorder=1,
+                       smoothwidths=(1, 4, 16), minwidth=2, grow=2,
+                       mingap=8, niter=10):
+
+    """
+    This function returns a boolean array marking the line channels of
+    a spectrum. The continuum is fit with a polynomial of order
+    fitorder to the channels not (yet) identified as line channels and
+    the noise is estimated robustly (1.4826 x median absolute
+    deviation) from the residuals. Channels that deviate by more than
+    nsigma times the noise in the residual spectrum smoothed by any of
+    the boxcar widths in smoothwidths are marked as line channels. The
+    smoothing picks up weak, broad lines as well as strong, narrow
+    ones. Emission and absorption lines are both found. Runs of line
+    channels shorter than minwidth are ignored, each line is extended
+    by grow channels on either side, and gaps between lines shorter
+    than mingap channels are filled in. The fit and detection are
+    repeated until the line channels no longer change.
+
+    Channels that are not valid (e.g., fully flagged) are never used
+    for the fit and are never marked as line channels.
+
+    Example:
+        linemask = find_line_channels(spectrum, valid, nsigma=4.0)
+    """
+
+    nchan = len(spectrum)
+    chans = np.arange(nchan)
+    if valid is None:
+        valid = np.ones(nchan, dtype=bool)
+    valid = valid & np.isfinite(spectrum)
+
+    line = np.zeros(nchan, dtype=bool)
+    if valid.sum() <= fitorder + 1:
+        return line
+
+    for iteration in range(niter):
+        fit = valid & ~line
+        if fit.sum() <= fitorder + 1:
+            break
+
+        coeffs = np.polyfit(chans[fit], spectrum[fit], fitorder)
+        resid = np.where(valid, spectrum - np.polyval(coeffs, chans), 0.0)
+
+        newline = np.zeros(nchan, dtype=bool)
+        for width in smoothwidths:
+            if width > 1:
+                kernel = np.ones(width)
+                norm = np.convolve(valid.astype(float), kernel, mode='same')
+                smoothed = np.convolve(resid, kernel, mode='same')
+                smoothed = np.where(norm > 0, smoothed / np.maximum(norm, 1), 0.0)
+            else:
+                smoothed = resid
+            dev = smoothed[fit] - np.median(smoothed[fit])
+            sigma = 1.4826 * np.median(np.abs(dev))
+            if sigma > 0:
+                newline |= valid & (np.abs(smoothed - np.median(smoothed[fit])) >
+                                    nsigma * sigma)
+
+        for (start, end) in _runs(newline):
+            if end - start + 1 < minwidth:
+                newline[start:end + 1] = False
+
+        if grow > 0:
+            newline = np.convolve(newline.astype(int), np.ones(2 * grow + 1),
+                                  mode='same') > 0
+            newline &= valid
+
+        for (start, end) in _runs(~newline & valid):
+            if (end - start + 1 < mingap and start > 0 and end < nchan - 1
+                    and newline[:start].any() and newline[end + 1:].any()):
+                newline[start:end + 1] = True
+
+        if np.array_equal(newline, line):
+            break
+        line = newline
+
+    return line
+
+
+def channel_ranges(mask):
+
+    """
+    This function returns a channel range string, e.g.,
+    '0~1200;2200~3839', for the channels marked True in mask. It
+    returns an empty string if there are none.
+    """
+
+    return ';'.join('%d~%d' % (start, end) if end > start else '%d' % start
+                    for (start, end) in _runs(mask))
+
+
+def find_line_free_channels(vis, spws='', field='', maxuv=0.0, nsigma=4.0,
+                            fitorder=1, smoothwidths=(1, 4, 16),
+                            minwidth=2, grow=2, mingap=8, datacolumn='DATA'):
+
+    """
+    This function finds the line channels in each spectral window of
+    vis and returns the flagchannels and fitspw strings used by the
+    imaging script. The spectra are read in a single pass over the
+    data (see average_spectra) and the line channels are found with
+    robust sigma clipping (see find_line_channels).
+
+    It returns a dictionary with the entries:
+
+        flagchannels : line channels to flag before averaging the
+                       continuum, e.g., '2:1201~2199,3:1201~2199'
+        fitspw       : line-free channels for uvcontsub, e.g.,
+                       '0,1,2:0~1200;2200~3839,3:0~1200;2200~3839'.
+                       Line-free spws are included whole.
+        linechannels : dictionary mapping each spw to its line mask
+        spectra      : dictionary mapping each spw to its spectrum
+
+    Spectral windows without line-free channels are left out of fitspw
+    (use combine='spw' in uvcontsub for those).
+
+    Example:
+        linefree = find_line_free_channels('calibrated_final.ms',
+                                           spws='0,1,2,3', maxuv=100.0)
+        flagchannels = linefree['flagchannels']
+        fitspw = linefree['fitspw']
+    """
+
+    spectra = average_spectra(vis, spws=spws, field=field, maxuv=maxuv,
+                              datacolumn=datacolumn)
+
+    flagchannels = []
+    fitspw = []
+    linechannels = {}
+    for spw in sorted(spectra):
+        (spectrum, valid) = spectra[spw]
+        line = find_line_channels(spectrum, valid, nsigma=nsigma,
+                                  fitorder=fitorder,
+                                  smoothwidths=smoothwidths,
+                                  minwidth=minwidth, grow=grow,
+                                  mingap=mingap)
+        linechannels[spw] = line
+
+        if line.any():
+            flagchannels.append('%d:%s' % (spw, channel_ranges(line)))
+            linefree = ~line
+            if linefree.any():
+                fitspw.append('%d:%s' % (spw, channel_ranges(linefree)))
+        else:
+            fitspw.append('%d' % spw)
+
+        print("spw %d: %d of %d channels with line emission" %
+              (spw, line.sum(), len(line)))
+
+    result = {'flagchannels': ','.join(flagchannels),
+              'fitspw': ','.join(fitspw),
+              'linechannels': linechannels,
+              'spectra': spectra}
+
+    print("flagchannels = '" + result['flagchannels'] + "'")
+    print("fitspw = '" + result['fitspw'] + "'")
+
+    return result
+
+
+def parse_channel_ranges(chanstring, nchans):
+
+    """
+    This function turns a channel selection string like
+    '2:1201~2199,3:0~100;3000~3839' into a dictionary mapping each spw
+    to a boolean mask of the selected channels. A spw given without
+    channels (e.g., '0') has all of its channels selected. The number
+    of channels of each spw is taken from the dictionary nchans.
+
+    Example:
+        masks = parse_channel_ranges('2:1201~2199', {2: 3840})
+    """
+
+    masks = {}
+    for entry in chanstring.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if ':' in entry:
+            (spw, chans) = entry.split(':', 1)
+        else:
+            (spw, chans) = (entry, '')
+        spw = int(spw)
+        mask = masks.setdefault(spw, np.zeros(nchans[spw], dtype=bool))
+        if not chans:
+            mask[:] = True
+            continue
+        for chanrange in chans.split(';'):
+            if '~' in chanrange:
+                (start, end) = chanrange.split('~')
+            else:
+                (start, end) = (chanrange, chanrange)
+            mask[int(start):int(end) + 1] = True
+
+    return masks
+
+
+def continuum_widths(vis, contspws, maxchanwidth={}):
+
+    """
+    This function returns the split width parameter for the averaged
+    continuum ms. For each spw in contspws, the width is the largest
+    number of channels that evenly divides the spw and keeps the
+    averaged channel narrower than the bandwidth smearing limit for its
+    band (MAX_CONT_CHANWIDTH, or the limits in Hz given per band in
+    maxchanwidth). Flagged line channels don't need to be taken into
+    account: with channelized weights (initweights with dowtsp=True),
+    split leaves the flagged channels out of each average.
+
+    The channel widths and bands come from the metadata index of vis
+    (see ms_metadata.py). It prints the suggested width parameter for
+    the split of the imaging script and returns the list of widths.
+
+    Example:
+        continuum_widths('calibrated_final.ms', '0,1,2,3')
+    """
+
+    index = get_ms_index(vis)
+    spwinfo = dict((spw['id'], spw) for spw in index['spws'])
+    limits = dict(MAX_CONT_CHANWIDTH)
+    limits.update(maxchanwidth)
+
+    widths = []
+    for spw in _parse_ids(contspws):
+        info = spwinfo[spw]
+        nchan = info['nchan']
+        chanwidth = abs(info['chanwidth'])
+        limit = limits.get(info['band'], min(limits.values()))
+        maxwidth = max(1, int(limit // chanwidth))
+
+        width = max(w for w in range(1, min(maxwidth, nchan) + 1)
+                    if nchan % w == 0)
+
+        widths.append(width)
+        print("spw %d (band %d): %d x %.4f MHz channels, width=%d -> %d channels of %.2f MHz (smearing limit %.1f MHz)" %
+              (spw, info['band'], nchan, chanwidth / 1.0e6, width,
+               nchan // width, width * chanwidth / 1.0e6, limit / 1.0e6))
+
+    print("width=[%s]" % ','.join(map(str, widths)))
+
+    return widths
+
+
+def time_smearing_loss(timebin, fovradius, beam):
+
+    """
+    This function returns the fractional reduction in peak flux due to
+    time-average smearing for a source fovradius away from the phase
+    center, for an averaging time timebin (in seconds) and a
+    synthesized beam of width beam (same units as fovradius). This is
+    the approximation from Bridle & Schwab (Synthesis Imaging in Radio
+    Astronomy II, eq. 18-43): 1.22e-9 (fovradius/beam)^2 timebin^2.
+
+    Example:
+        time_smearing_loss(12.0, 13.7, 0.9) # returns ~0.04
+    """
+
+    return 1.22e-9 * (fovradius / beam) ** 2 * timebin ** 2
+
+
+def continuum_timebin(vis, contspws, maxloss=0.05, fovradius=0.0,
+                      maxtimebin=30.0):
+
+    """
+    This function returns the longest averaging time (a multiple of the
+    integration time, as a string like '12.096s') that keeps the time
+    smearing loss of peak flux below maxloss at a distance fovradius
+    (in arcsec) from the phase center. If fovradius isn't given, the
+    half width at half maximum of the primary beam of the smallest
+    dish is used, i.e., the size of a single field image. For mosaics
+    set fovradius to half the image size. The synthesized beam is
+    estimated from the longest baseline and the highest frequency in
+    contspws (the worst case). The averaging time is also kept below
+    maxtimebin seconds so that the data can still be self-calibrated
+    on short solution intervals and aren't decorrelated by atmospheric
+    phase fluctuations. It returns '0s' (no averaging) if the limit is
+    shorter than two integrations.
+
+    The expected reduction in data volume and the peak flux loss for
+    the chosen averaging time are printed before anything is run.
+
+    Example:
+        conttimebin = continuum_timebin('calibrated_final.ms', '0,1,2,3')
+    """
+
+    index = get_ms_index(vis)
+    spwinfo = dict((spw['id'], spw) for spw in index['spws'])
+
+    spws = _parse_ids(contspws)
+    maxfreq = max(spwinfo[spw]['meanfreq'] + spwinfo[spw]['bandwidth'] / 2.0
+                  for spw in spws)
+    wavelength = C / maxfreq
+    beam = 206265.0 * wavelength / index['max_baseline']
+
+    if fovradius <= 0:
+        diameter = min(ant['diameter'] for ant in index['antennas'])
+        fovradius = 0.5 * 1.22 * 206265.0 * wavelength / diameter
+
+    inttime = max(obs['inttime'] for obs in index['observations'])
+    maxtime = np.sqrt(maxloss / (1.22e-9 * (fovradius / beam) ** 2))
+    nint = int(min(maxtime, maxtimebin) // inttime) if inttime > 0 else 0
+
+    print("Longest baseline %.1fm, beam %.3f arcsec at %.3f GHz, field radius %.1f arcsec" %
+          (index['max_baseline'], beam, maxfreq / 1.0e9, fovradius))
+    print("Time smearing limit for %.0f%% peak loss: %.1fs (integration time %.3fs, maximum %.1fs)" %
+          (100.0 * maxloss, maxtime, inttime, maxtimebin))
+
+    if nint < 2:
+        print("No time averaging: limit is shorter than two integrations.")
+        return '0s'
+
+    timebin = nint * inttime
+    print("timebin='%.3fs': %d integrations per bin, data volume reduced by a factor of up to %d, peak flux loss at field edge %.2f%%" %
+          (timebin, nint, nint,
+           100.0 * time_smearing_loss(timebin, fovradius, beam)))
+
+    return '%.3fs' % timebin
+
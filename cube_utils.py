@@ -0,0 +1,457 @@
+import math
+import os
+import re
+import shutil
+
+from ms_metadata import get_ms_index
+from parallel_utils import run_casa_jobs
+
+# Number of cube-sized float images that tclean keeps in memory while
+# imaging a cube (residual, psf, model, and pb), and the padding of the
+# gridding and FFT planes of a single channel (padding=1.2 in each
+# direction). Used for the rough memory estimates in cube_memory.
+CUBE_IMAGE_COPIES = 4
+GRID_PADDING = 1.2
+
+# Memory for the convolution function caches of the mosaic and
+# awproject gridders (bytes).
+GRIDDER_CFCACHE = {'mosaic': 0.5e9,
+                   'awproject': 2.0e9}
+
+
+def _imsize(imagepars):
+
+    """
+    This function returns the image size in imagepars as (nx, ny).
+    """
+
+    imsize = imagepars.get('imsize', 100)
+    if isinstance(imsize, int):
+        return (imsize, imsize)
+    if len(imsize) == 1:
+        return (imsize[0], imsize[0])
+
+    return (imsize[0], imsize[1])
+
+
+def _spw_nchan(vis, spw):
+
+    """
+    This function returns the largest number of channels of the spws
+    selected by spw (e.g., '1', '0,5,10', or '' for all science spws),
+    read from the metadata index of vis.
+    """
+
+    index = get_ms_index(vis)
+    try:
+        ids = [int(sel.split(':')[0]) for sel in str(spw).split(',') if sel]
+    except ValueError:
+        ids = []
+    if not ids:
+        ids = index['science_spws']
+
+    return max(entry['nchan'] for entry in index['spws'] if entry['id'] in ids)
+
+
+def available_memory():
+
+    """
+    This function returns the memory in bytes that is available for
+    new processes (MemAvailable in /proc/meminfo, or the free physical
+    memory on systems without /proc).
+    """
+
+    if os.path.isfile('/proc/meminfo'):
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def cube_memory(imsize, nchan, gridder='standard', perchanweightdensity=True):
+
+    """
+    This function returns a rough, conservative estimate in bytes of
+    the memory used by a single tclean process making a cube with
+    imsize pixels and nchan channels: the cube images tclean keeps in
+    memory, the complex gridding and FFT planes of one channel, a
+    weight density grid per channel with perchanweightdensity=True (as
+    for the cubes of the imaging script), and the convolution function
+    cache of the mosaic and awproject gridders.
+
+    Example:
+        cube_memory([1000,1000], 2000) / 1e9 # about 43 GB
+    """
+
+    if isinstance(imsize, int):
+        imsize = [imsize, imsize]
+    npix = imsize[0] * imsize[-1]
+    gridpix = npix * GRID_PADDING ** 2
+
+    memory = 4 * npix * nchan * CUBE_IMAGE_COPIES + 2 * 8 * gridpix
+    if perchanweightdensity:
+        memory += 4 * gridpix * nchan
+
+    return memory + GRIDDER_CFCACHE.get(gridder, 0.0)
+
+
+def cube_nchunks(imsize, nchan, nprocs, memfraction=0.8, **memargs):
+
+    """
+    This function returns the number of channel chunks that a cube with
+    imsize pixels and nchan channels is split into by
+    image_line_cube_chunked: one per process (nprocs), or more if a
+    chunk wouldn't fit in its share of memfraction of the available
+    memory (see cube_memory, which gets memargs). It raises a ValueError
+    if even a single channel doesn't fit.
+
+    Example:
+        cube_nchunks([2000,2000], 4000, 8)
+    """
+
+    budget = memfraction * available_memory() / max(nprocs, 1)
+    fixed = cube_memory(imsize, 0, **memargs)
+    perchan = cube_memory(imsize, 1, **memargs) - fixed
+    if fixed + perchan > budget:
+        raise ValueError("A single channel of a %s cube doesn't fit in %.1f GB "
+                         "of memory. Use fewer processes or reduce imsize." %
+                         (imsize, budget / 1.0e9))
+    chanperchunk = int((budget - fixed) // perchan)
+
+    return min(nchan, max(nprocs, int(math.ceil(nchan / float(chanperchunk)))))
+
+
+def max_workers(memories, nprocs, memfraction=0.8):
+
+    """
+    This function returns the number of cube jobs that can run at the
+    same time without using more than memfraction of the available
+    memory, given the memory estimate of each job in memories. It is at
+    most nprocs and at least 1.
+
+    Example:
+        nworkers = max_workers([cube_memory(1000, 2000)] * 4, 4)
+    """
+
+    budget = memfraction * available_memory()
+    nworkers = int(budget // max(max(memories), 1))
+
+    return max(1, min(nprocs, len(memories), nworkers))
+
+
+def image_line_cube(linevis, imagename, imagepars, workdir='', usecache=True,
+                    **line):
+
+    """
+    This function makes a single line cube with
+    imaging_stages.image_line from inside workdir, so that the
+    products and the temporary files of tclean end up in their own
+    directory. The line parameters (spw, restfreq, start, width, nchan,
+    and optionally outframe and veltype) are given in line. It returns
+    the path to the image (without the .image extension).
+    """
+
+    from imaging_stages import image_line
+
+    linevis = os.path.abspath(linevis)
+    cwd = os.getcwd()
+    if workdir:
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        os.chdir(workdir)
+    try:
+        image_line(linevis, imagename, imagepars, usecache=usecache, **line)
+    finally:
+        os.chdir(cwd)
+
+    return os.path.join(workdir, imagename)
+
+
+def image_line_cubes(linevis, lines, imagepars, outdir='line_cubes',
+                     nprocs=4, memfraction=0.8, logdir='line_logs',
+                     usecache=True):
+
+    """
+    This function makes one line cube for each line definition in
+    lines, running the cubes at the same time in a pool of worker
+    processes. Each line definition is a dictionary with the
+    imagename, spw, restfreq, start, width, and nchan of the cube (and
+    optionally outframe and veltype). The imaging parameters that are
+    the same for all cubes (field, imsize, cell, gridder, robust,
+    niter, threshold, etc.) are given in imagepars. Use
+    interactive=False.
+
+    The products of each cube are written to outdir/<imagename>/ and
+    the CASA log of each cube to logdir/<imagename>.log. At most
+    nprocs cubes are imaged at the same time, fewer if the estimated
+    memory of the largest cube (see cube_memory) times the number of
+    cubes would exceed memfraction of the available memory. It returns
+    a dictionary mapping each imagename to the path of its image.
+
+    Example:
+        lines = [{'imagename': 'co_cube', 'spw': '1',
+                  'restfreq': '115.27120GHz', 'start': '-100km/s',
+                  'width': '2km/s', 'nchan': 100},
+                 {'imagename': 'cn_cube', 'spw': '3',
+                  'restfreq': '113.49097GHz', 'start': '-100km/s',
+                  'width': '2km/s', 'nchan': 100}]
+        images = image_line_cubes('calibrated_final.ms.contsub', lines,
+                                  imagepars, nprocs=4)
+    """
+
+    (nx, ny) = _imsize(imagepars)
+
+    joblist = []
+    memories = []
+    for line in lines:
+        line = dict(line)
+        imagename = line.pop('imagename')
+        nchan = line.get('nchan', -1)
+        if nchan <= 0:
+            nchan = _spw_nchan(linevis, line.get('spw', ''))
+        memories.append(cube_memory([nx, ny], nchan,
+                                    gridder=imagepars.get('gridder', 'standard')))
+        line.update({'linevis': linevis, 'imagename': imagename,
+                     'imagepars': imagepars,
+                     'workdir': os.path.join(outdir, imagename),
+                     'usecache': usecache})
+        joblist.append((imagename, line))
+
+    nworkers = max_workers(memories, nprocs, memfraction)
+    print("Imaging %d cubes with %d processes (largest cube needs about %.1f GB)" %
+          (len(joblist), nworkers, max(memories) / 1.0e9))
+
+    return run_casa_jobs(image_line_cube, joblist, nprocs=nworkers,
+                         logdir=logdir)
+
+
+def _split_quantity(quantity):
+
+    """
+    This function splits a quantity string like '-100km/s' or
+    '230.5GHz' into its value and unit, e.g., (-100.0, 'km/s').
+    """
+
+    match = re.match(r'^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(.*?)\s*$',
+                     quantity)
+    if not match:
+        raise ValueError("Can't read the quantity '" + quantity + "'")
+
+    return (float(match.group(1)), match.group(2))
+
+
+def _add_channels(start, width, nchan):
+
+    """
+    This function returns start + nchan x width for the quantity
+    strings start and width, as a quantity string in the unit of start.
+    Quantities in different units are converted with the CASA quanta
+    tool.
+    """
+
+    (startvalue, startunit) = _split_quantity(start)
+    (widthvalue, widthunit) = _split_quantity(width)
+    if startunit == widthunit:
+        return '%.12g%s' % (startvalue + nchan * widthvalue, startunit)
+
+    from casatools import quanta
+    qa = quanta()
+    total = qa.convert(qa.add(qa.quantity(start),
+                              qa.mul(qa.quantity(width), nchan)), startunit)
+
+    return '%.12g%s' % (total['value'], total['unit'])
+
+
+def cube_chunks(start, width, nchan, nchunks):
+
+    """
+    This function splits the spectral grid of a cube (the start, width,
+    and nchan parameters of tclean) into nchunks contiguous chunks of
+    (nearly) equal size. It returns a list of (start, nchan) tuples,
+    one per chunk. The start and width can be quantities (e.g.,
+    '-100km/s' and '2km/s', or '230.5GHz' and '0.5MHz') or channel
+    numbers. The start of the cube must be given explicitly, and so
+    must the width if the start is a quantity, since the native channel
+    width isn't known here.
+
+    Example:
+        cube_chunks('-100km/s', '2km/s', 100, 4)
+        # [('-100km/s', 25), ('-50km/s', 25), ('0km/s', 25), ('50km/s', 25)]
+    """
+
+    if start == '' or nchan <= 0:
+        raise ValueError("Give an explicit start and nchan to image a cube in chunks")
+    if isinstance(start, str) and str(width).strip() == '':
+        raise ValueError("Give an explicit width with start='" + start +
+                         "' to image a cube in chunks")
+
+    nchunks = max(1, min(nchunks, nchan))
+    chunknchan = int(math.ceil(nchan / float(nchunks)))
+
+    chunks = []
+    for first in range(0, nchan, chunknchan):
+        if isinstance(start, str):
+            chunkstart = _add_channels(start, width, first)
+        else:
+            chunkstart = start + first * (width if width else 1)
+        chunks.append((chunkstart, min(chunknchan, nchan - first)))
+
+    return chunks
+
+
+def restore_cube_chunk(linevis, imagename, imagepars, restoringbeam,
+                       workdir='', **line):
+
+    """
+    This function restores an existing cube (e.g., a chunk made by
+    image_line_cube) with the given restoring beam, without any further
+    cleaning, and primary beam corrects it. The line parameters must be
+    the same as the ones the cube was made with.
+    """
+
+    from casatasks import tclean
+    from imaging_stages import _cube_pars
+
+    linevis = os.path.abspath(linevis)
+    pars = _cube_pars(imagepars, restoringbeam)
+    pars.pop('autoclean', None)
+    pars.update(line)
+    pars.update({'niter': 0, 'calcres': False, 'calcpsf': False,
+                 'restart': True, 'interactive': False})
+
+    cwd = os.getcwd()
+    if workdir:
+        os.chdir(workdir)
+    try:
+        tclean(vis=linevis, imagename=imagename, **pars)
+    finally:
+        os.chdir(cwd)
+
+
+def _concat_images(infiles, outfile):
+
+    """
+    This function concatenates the images in infiles along the spectral
+    axis into outfile, sorting them by frequency.
+    """
+
+    from casatasks import imageconcat, rmtables
+
+    rmtables(outfile)
+    imageconcat(infiles=infiles, outfile=outfile, axis=-1, relax=False,
+                reorder=True, overwrite=True)
+
+
+def _common_beam(images):
+
+    """
+    This function returns the smallest beam that encloses the beams of
+    all channels of the images in images (the chunks of a cube) as a
+    [major, minor, position angle] list for the tclean restoringbeam
+    parameter.
+    """
+
+    from casatools import image
+
+    vcube = images[0] + '.allchunks'
+    if os.path.exists(vcube):
+        shutil.rmtree(vcube)
+
+    ia = image()
+    ia.imageconcat(outfile=vcube, infiles=images, axis=-1, relax=False,
+                   tempclose=True, reorder=True, mode='nomove')
+    beam = ia.commonbeam()
+    ia.close()
+    shutil.rmtree(vcube)
+
+    return ['%.6g%s' % (beam['major']['value'], beam['major']['unit']),
+            '%.6g%s' % (beam['minor']['value'], beam['minor']['unit']),
+            '%.6g%s' % (beam['pa']['value'], beam['pa']['unit'])]
+
+
+def image_line_cube_chunked(linevis, imagename, imagepars, spw, restfreq,
+                            start, width, nchan, outframe='lsrk',
+                            veltype='radio', nchunks=0, nprocs=4,
+                            memfraction=0.8, logdir='', usecache=True):
+
+    """
+    This function makes a large line cube by splitting its spectral
+    grid (start, width, nchan) into contiguous channel chunks, imaging
+    each chunk in its own process, and putting the chunks back together
+    into imagename.image, imagename.pb, and imagename.image.pbcor. This
+    bounds the memory used by each process, and the wall time scales
+    with the number of processes.
+
+    The chunks are imaged with the beam of each channel and then
+    re-restored with a single common beam for the whole cube, so the
+    result has the same restoringbeam='common' policy as a cube made in
+    one go. The chunks are weighted with weighting='briggs' instead of
+    the briggsbwtaper of image_line, since the taper of briggsbwtaper
+    depends on the bandwidth of each chunk and would differ from chunk
+    to chunk. If nchunks is 0, the cube is split into nprocs chunks, or
+    more if needed to fit in memfraction of the available memory. The
+    chunks are made in imagename + '_chunks/' and the CASA logs are
+    written to logdir (by default imagename + '_chunks/logs'). Chunks
+    that are up to date are not re-imaged unless usecache is False.
+
+    Example:
+        image_line_cube_chunked('calibrated_final.ms.contsub',
+                                lineimagename, imagepars, '1',
+                                '115.27120GHz', '-500km/s', '0.5km/s',
+                                2000, nprocs=8)
+    """
+
+    (nx, ny) = _imsize(imagepars)
+    chunkdir = imagename + '_chunks'
+    if not logdir:
+        logdir = os.path.join(chunkdir, 'logs')
+
+    gridder = imagepars.get('gridder', 'standard')
+    if nchunks <= 0:
+        nchunks = cube_nchunks([nx, ny], nchan, nprocs, memfraction,
+                               gridder=gridder)
+
+    chunks = cube_chunks(start, width, nchan, nchunks)
+    print("Imaging %s in %d chunks of up to %d channels" %
+          (imagename, len(chunks), chunks[0][1]))
+
+    joblist = []
+    for (i, (chunkstart, chunknchan)) in enumerate(chunks):
+        chunkname = 'chunk%03d' % i
+        joblist.append((chunkname,
+                        {'linevis': linevis, 'imagename': chunkname,
+                         'imagepars': imagepars,
+                         'workdir': os.path.join(chunkdir, chunkname),
+                         'usecache': usecache, 'spw': spw,
+                         'restfreq': restfreq, 'start': chunkstart,
+                         'width': width, 'nchan': chunknchan,
+                         'outframe': outframe, 'veltype': veltype,
+                         'weighting': 'briggs', 'restoringbeam': ''}))
+
+    nworkers = max_workers([cube_memory([nx, ny], chunks[0][1],
+                                        gridder=gridder)] * len(chunks),
+                           nprocs, memfraction)
+    results = run_casa_jobs(image_line_cube, joblist, nprocs=nworkers,
+                            logdir=logdir)
+    chunkimages = [results[chunkname] for (chunkname, pars) in joblist]
+
+    # restore all chunks with the common beam of the whole cube
+    beam = _common_beam([chunk + '.image' for chunk in chunkimages])
+    print("Common beam of " + imagename + ": " + ', '.join(beam))
+
+    restorelist = []
+    for (chunkname, pars) in joblist:
+        pars = dict(pars)
+        del pars['usecache']
+        pars['restoringbeam'] = beam
+        restorelist.append((chunkname + '_restore', pars))
+    run_casa_jobs(restore_cube_chunk, restorelist, nprocs=nworkers,
+                  logdir=logdir)
+
+    for ext in ['.image', '.pb', '.image.pbcor']:
+        _concat_images([chunk + ext for chunk in chunkimages], imagename + ext)
+
+    return imagename
+
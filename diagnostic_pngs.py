@@ -0,0 +1,205 @@
+import glob
+import json
+import os
+
+import numpy as np
+
+from ms_metadata import ms_fingerprint
+from parallel_utils import run_casa_jobs
+
+# Version of the statistics cache format. Bump this when the contents
+# change so that old caches are recomputed.
+STATS_VERSION = 1
+
+# Lower end of the color scale as a fraction of the peak, as in the
+# imview calls of the imaging script.
+PNG_MIN_FRACTION = -0.1
+
+
+def image_stats_filename(image):
+
+    """
+    This function returns the name of the statistics cache of image,
+    e.g., twhya_cont.image.stats.json. The peak map is stored next to it
+    as image + '.peak.npy'.
+    """
+
+    return image.rstrip('/') + '.stats.json'
+
+
+def compute_image_stats(image):
+
+    """
+    This function reads the CASA image image one spectral plane at a
+    time and returns the statistics of the whole image and of each
+    plane, and the peak map (the maximum over the channels of each
+    pixel, like immoments moments=[8]). Masked and NaN pixels are
+    ignored. Only one plane and the peak map are kept in memory, and no
+    intermediate images are written.
+
+    The statistics are a dictionary with the maximum, minimum, mean,
+    rms, and number of pixels of the image; the robust noise (1.4826 x
+    median absolute deviation, the median over the planes for cubes);
+    and the lists 'chanmax' and 'chanrms' (robust) for each plane.
+
+    Example:
+        (stats, peakmap) = compute_image_stats('twhya_cube.image')
+    """
+
+    from casatools import image as iatool
+
+    ia = iatool()
+    ia.open(image)
+    shape = list(ia.shape())
+    axistypes = ia.coordsys().axiscoordinatetypes()
+    specaxis = axistypes.index('Spectral') if 'Spectral' in axistypes else -1
+    nchan = shape[specaxis] if specaxis >= 0 else 1
+
+    peakmap = np.full(shape[:2], np.nan)
+    chanmax = []
+    chanrms = []
+    (vmax, vmin, total, sumsq, npts) = (-np.inf, np.inf, 0.0, 0.0, 0)
+
+    for chan in range(nchan):
+        blc = [0] * len(shape)
+        trc = [n - 1 for n in shape]
+        if specaxis >= 0:
+            blc[specaxis] = chan
+            trc[specaxis] = chan
+        data = ia.getchunk(blc, trc)
+        good = ia.getchunk(blc, trc, getmask=True) & np.isfinite(data)
+        plane = np.where(good, data, np.nan).reshape(shape[0], shape[1], -1)
+        peakmap = np.fmax(peakmap, np.fmax.reduce(plane, axis=2))
+
+        values = data[good]
+        if values.size:
+            vmax = max(vmax, float(values.max()))
+            vmin = min(vmin, float(values.min()))
+            total += float(values.sum(dtype=np.float64))
+            sumsq += float(np.square(values, dtype=np.float64).sum())
+            npts += values.size
+            chanmax.append(float(values.max()))
+            chanrms.append(1.4826 * float(np.median(np.abs(values - np.median(values)))))
+        else:
+            chanmax.append(None)
+            chanrms.append(None)
+
+    ia.close()
+
+    goodrms = [rms for rms in chanrms if rms is not None]
+    stats = {'max': vmax if npts else None,
+             'min': vmin if npts else None,
+             'mean': total / npts if npts else None,
+             'rms': float(np.sqrt(sumsq / npts)) if npts else None,
+             'npts': npts,
+             'noise': float(np.median(goodrms)) if goodrms else None,
+             'nchan': nchan,
+             'chanmax': chanmax,
+             'chanrms': chanrms}
+
+    return (stats, peakmap)
+
+
+def get_image_stats(image, usecache=True):
+
+    """
+    This function returns the statistics of image (see
+    compute_image_stats). They are cached in image + '.stats.json'
+    along with a fingerprint of the image, so they are only recomputed
+    if the image has changed. Use this instead of imstat in QA reports
+    to avoid reading the image again.
+
+    Example:
+        peak = get_image_stats('twhya_cube.image')['max']
+    """
+
+    statsfile = image_stats_filename(image)
+    peakfile = image.rstrip('/') + '.peak.npy'
+    fingerprint = ms_fingerprint(image)
+
+    if usecache and os.path.isfile(statsfile) and os.path.isfile(peakfile):
+        with open(statsfile, 'r') as f:
+            cached = json.load(f)
+        if (cached.get('version') == STATS_VERSION and
+                cached.get('fingerprint') == fingerprint):
+            return cached['stats']
+
+    (stats, peakmap) = compute_image_stats(image)
+    np.save(peakfile, peakmap)
+    with open(statsfile, 'w') as f:
+        json.dump({'version': STATS_VERSION, 'fingerprint': fingerprint,
+                   'stats': stats}, f, indent=1)
+
+    return stats
+
+
+def render_png(image, outfile, usecache=True):
+
+    """
+    This function renders the peak map of image (the image itself for
+    continuum) to the PNG outfile with matplotlib, with the color scale
+    from PNG_MIN_FRACTION times the peak to the peak. The statistics and
+    peak map come from get_image_stats, and the PNG is not re-rendered
+    if it is newer than them. It returns the statistics.
+
+    Example:
+        render_png('twhya_cube.image', 'twhya_cube.image.mom8.png')
+    """
+
+    from matplotlib.figure import Figure
+
+    stats = get_image_stats(image, usecache=usecache)
+    if (usecache and os.path.isfile(outfile) and
+            os.path.getmtime(outfile) >= os.path.getmtime(image_stats_filename(image))):
+        return stats
+
+    peakmap = np.load(image.rstrip('/') + '.peak.npy')
+    vmax = stats['max'] if stats['max'] is not None else 1.0
+
+    fig = Figure(figsize=(6, 5))
+    ax = fig.add_subplot(1, 1, 1)
+    im = ax.imshow(peakmap.T, origin='lower', cmap='viridis',
+                   vmin=PNG_MIN_FRACTION * vmax, vmax=vmax)
+    fig.colorbar(im, ax=ax)
+    ax.set_title(os.path.basename(image.rstrip('/')) +
+                 (' (peak)' if stats['nchan'] > 1 else ''), fontsize=9)
+    ax.set_xlabel('x (pixels)')
+    ax.set_ylabel('y (pixels)')
+    ax.text(0.02, 0.02, 'peak %.3g, noise %.3g' % (vmax, stats['noise'] or 0.0),
+            transform=ax.transAxes, color='white', fontsize=8)
+    fig.savefig(outfile, dpi=100)
+
+    return stats
+
+
+def make_diagnostic_pngs(contpattern='*mfs*manual.image',
+                         linepattern='*cube*manual.image', nprocs=4,
+                         logdir='png_logs', usecache=True):
+
+    """
+    This function makes the diagnostic PNGs of the imaging script in a
+    pool of nprocs worker processes (see parallel_utils.py): image +
+    '.png' for the continuum images matching contpattern and the peak
+    map image + '.mom8.png' for the cubes matching linepattern (see
+    render_png). It returns a dictionary mapping each image to its
+    statistics.
+
+    Example:
+        make_diagnostic_pngs(nprocs=8)
+    """
+
+    joblist = []
+    for image in sorted(glob.glob(contpattern)):
+        joblist.append((image, image + '.png'))
+    for image in sorted(glob.glob(linepattern)):
+        joblist.append((image, image + '.mom8.png'))
+
+    results = run_casa_jobs(render_png,
+                            [(os.path.basename(outfile),
+                              {'image': image, 'outfile': outfile,
+                               'usecache': usecache})
+                             for (image, outfile) in joblist],
+                            nprocs=nprocs, logdir=logdir)
+
+    return dict((image, results[os.path.basename(outfile)])
+                for (image, outfile) in joblist)
@@ -0,0 +1,208 @@
+import glob
+import os
+
+from parallel_utils import run_casa_jobs
+
+# Compression algorithms of the FITS tiled image convention (as written
+# by fpack and astropy).
+TILE_COMPRESSION = ['RICE_1', 'GZIP_1', 'GZIP_2', 'HCOMPRESS_1']
+
+
+def _newest_mtime(path):
+
+    """
+    This function returns the latest modification time of path and, for
+    an image directory, all of the files in it. The table.lock files are
+    ignored since they are touched whenever an image is opened.
+    """
+
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+
+    newest = os.path.getmtime(path)
+    for (root, dirs, files) in os.walk(path):
+        for name in files:
+            if name != 'table.lock':
+                newest = max(newest, os.path.getmtime(os.path.join(root, name)))
+
+    return newest
+
+
+def fits_is_current(image, fitsimage):
+
+    """
+    This function returns True if fitsimage exists and is newer than
+    every file of the CASA image image.
+
+    Example:
+        fits_is_current('twhya_cont.image.pbcor', 'twhya_cont.image.pbcor.fits')
+    """
+
+    return (os.path.isfile(fitsimage) and
+            os.path.getmtime(fitsimage) >= _newest_mtime(image))
+
+
+def _fits_header(fitsimage):
+
+    """
+    This function returns the cards of the primary header of fitsimage
+    as a dictionary of strings, read directly from the 2880 byte header
+    blocks.
+    """
+
+    header = {}
+    with open(fitsimage, 'rb') as f:
+        while True:
+            block = f.read(2880).decode('ascii', 'replace')
+            if not block:
+                return header
+            for i in range(0, len(block), 80):
+                card = block[i:i+80]
+                key = card[:8].strip()
+                if key == 'END':
+                    return header
+                if card[8:10] == '= ':
+                    value = card[10:].strip()
+                    if value.startswith("'"):
+                        # strings can contain '/', which starts a comment
+                        # everywhere else
+                        header[key] = value[1:].split("'")[0].strip()
+                    else:
+                        header[key] = value.split('/')[0].strip()
+
+
+def fits_filename(image, compress=''):
+
+    """
+    This function returns the name of the FITS file of image:
+    image + '.fits', or image + '.fits.fz' if it is tile-compressed.
+    """
+
+    return image + ('.fits.fz' if compress else '.fits')
+
+
+def _quantization_error(fitsimage):
+
+    """
+    This function returns the largest error introduced by quantizing
+    the tile-compressed fitsimage: half of the largest quantization step
+    (the ZSCALE column of the compressed tiles), or 0 if the tiles
+    weren't quantized.
+    """
+
+    from astropy.io import fits
+
+    with fits.open(fitsimage, disable_image_compression=True) as hdulist:
+        table = hdulist[1].data
+        if 'ZSCALE' not in table.names:
+            return 0.0
+        return 0.5 * float(abs(table['ZSCALE']).max())
+
+
+def export_image(image, fitsimage='', bitpix=-32, compress='',
+                 quantize_level=16.0):
+
+    """
+    This function exports the CASA image image to fitsimage (by default
+    image + '.fits', see fits_filename) with exportfits and returns a
+    dictionary with the name and size of the file and the largest error
+    (in image units) introduced by the conversion:
+
+    * bitpix=-32 (default): 32-bit floats, no error.
+
+    * bitpix=16: 16-bit integers scaled between the minimum and maximum
+      of the image (BSCALE and BZERO), half the size of the float
+      file. The error is at most BSCALE/2 = (max - min)/(2 x 65534),
+      which is returned.
+
+    * compress='RICE_1', 'GZIP_1', 'GZIP_2', or 'HCOMPRESS_1': a
+      tile-compressed FITS file (image + '.fits.fz', readable by
+      astropy, ds9, CARTA, and funpack) written with astropy. Float
+      values are quantized to 1/quantize_level of the noise in each tile
+      before compression, with the quantization step of each tile stored
+      in its ZSCALE column, so the error is at most half the largest
+      ZSCALE, which is returned. With quantize_level=0 and GZIP_1 or
+      GZIP_2, the data are compressed losslessly.
+
+    Example:
+        export_image('twhya_cont.image.pbcor', compress='RICE_1')
+    """
+
+    from casatasks import exportfits
+
+    if compress and compress not in TILE_COMPRESSION:
+        raise ValueError("compress must be one of " + ', '.join(TILE_COMPRESSION))
+    if bitpix not in (-32, 16):
+        raise ValueError("bitpix must be -32 or 16")
+
+    fitsimage = fitsimage or fits_filename(image, compress)
+    result = {'image': image, 'fitsimage': fitsimage, 'errorbound': 0.0}
+
+    # write to a temporary file first so that an interrupted export is
+    # never taken as up to date.
+    tmpfits = fitsimage + '.tmp.fits'
+    exportfits(imagename=image, fitsimage=tmpfits,
+               bitpix=-32 if compress else bitpix, overwrite=True)
+
+    if not compress:
+        if bitpix == 16:
+            result['errorbound'] = 0.5 * float(_fits_header(tmpfits).get('BSCALE', 1.0))
+        os.replace(tmpfits, fitsimage)
+    else:
+        from astropy.io import fits
+
+        with fits.open(tmpfits, memmap=True) as hdulist:
+            hdu = fits.CompImageHDU(data=hdulist[0].data,
+                                    header=hdulist[0].header,
+                                    compression_type=compress,
+                                    quantize_level=quantize_level)
+            hdu.writeto(fitsimage, overwrite=True)
+        os.remove(tmpfits)
+        result['errorbound'] = _quantization_error(fitsimage)
+
+    result['size'] = os.path.getsize(fitsimage)
+
+    return result
+
+
+def export_fits(patterns=['*.pbcor', '*.pb'], bitpix=-32, compress='',
+                quantize_level=16.0, nprocs=4, logdir='export_logs',
+                overwrite=False):
+
+    """
+    This function exports the CASA images matching patterns to FITS in
+    a pool of nprocs worker processes (see parallel_utils.py and
+    export_image for bitpix, compress, and quantize_level). Images whose
+    FITS file is already newer than the image are skipped unless
+    overwrite is True. It prints and returns the result of each export
+    (see export_image). The primary beams (*.pb) are always exported
+    losslessly: as 32-bit floats, or with GZIP_2 and quantize_level=0 if
+    compress is set.
+
+    Example:
+        export_fits(patterns=['*.pbcor', '*.pb'], compress='RICE_1', nprocs=8)
+    """
+
+    images = sorted(set(image for pattern in patterns
+                        for image in glob.glob(pattern)))
+
+    joblist = []
+    for image in images:
+        fitsimage = fits_filename(image, compress)
+        if not overwrite and fits_is_current(image, fitsimage):
+            print("Skipping " + image + ": " + fitsimage + " is up to date")
+            continue
+        pars = {'image': image, 'fitsimage': fitsimage, 'bitpix': bitpix,
+                'compress': compress, 'quantize_level': quantize_level}
+        if image.rstrip('/').endswith('.pb'):
+            pars.update({'bitpix': -32, 'compress': 'GZIP_2' if compress else '',
+                         'quantize_level': 0.0})
+        joblist.append((image.replace('/', '_'), pars))
+
+    results = run_casa_jobs(export_image, joblist, nprocs=nprocs, logdir=logdir)
+
+    for (jobname, result) in sorted(results.items()):
+        print("%-50s %10.1f MB  max error %.3g" %
+              (result['fitsimage'], result['size'] / 1.0e6, result['errorbound']))
+
+    return results
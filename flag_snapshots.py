@@ -0,0 +1,352 @@
+import json
+import os
+import shutil
+import time
+import zipfile
+
+import numpy as np
+
+# Name of the base snapshot. All other snapshots are stored as the
+# difference from it, so it can't be used as a version name.
+BASE_SNAPSHOT = 'base'
+
+
+def snapshot_dir(vis):
+
+    """
+    This function returns the directory holding the flag snapshots of
+    vis, e.g., calibrated_final.ms.flagsnapshots.
+    """
+
+    return vis.rstrip('/') + '.flagsnapshots'
+
+
+def _read_snapshot_index(vis):
+
+    """
+    This function returns the index of the flag snapshots of vis: a
+    dictionary mapping each snapshot to its date, comment, size in
+    bytes, and fraction of flagged data.
+    """
+
+    indexfile = os.path.join(snapshot_dir(vis), 'index.json')
+    if not os.path.isfile(indexfile):
+        return {}
+
+    with open(indexfile, 'r') as f:
+        return json.load(f)
+
+
+def _write_snapshot_index(vis, index):
+
+    """
+    This function atomically writes the index of the flag snapshots of
+    vis.
+    """
+
+    indexfile = os.path.join(snapshot_dir(vis), 'index.json')
+    with open(indexfile + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(indexfile + '.tmp', indexfile)
+
+
+def _read_flags(vis, chunksize):
+
+    """
+    This function reads the FLAG column of vis in chunks of at most
+    chunksize rows per data description (the shape of the flags depends
+    on the spw). It yields a key for each chunk and the flags of the
+    chunk flattened to a boolean array.
+    """
+
+    from casatools import table
+
+    tb = table()
+    tb.open(vis)
+    ddids = sorted(set(int(dd) for dd in tb.getcol('DATA_DESC_ID')))
+    for ddid in ddids:
+        subtb = tb.query('DATA_DESC_ID == %d' % ddid, columns='FLAG')
+        nrows = subtb.nrows()
+        for startrow in range(0, nrows, chunksize):
+            nrow = min(chunksize, nrows - startrow)
+            flags = subtb.getcol('FLAG', startrow, nrow)
+            yield ('dd%d_row%d' % (ddid, startrow), flags.ravel())
+        subtb.close()
+    tb.close()
+
+
+def _write_flags(vis, chunkflags, chunksize):
+
+    """
+    This function writes the FLAG column of vis in the chunks of
+    _read_flags, one chunk at a time: chunkflags(key, size) returns the
+    flattened boolean flags of the chunk key. FLAG_ROW is set for rows
+    that are completely flagged.
+    """
+
+    from casatools import table
+
+    tb = table()
+    tb.open(vis, nomodify=False)
+    ddids = sorted(set(int(dd) for dd in tb.getcol('DATA_DESC_ID')))
+    for ddid in ddids:
+        subtb = tb.query('DATA_DESC_ID == %d' % ddid, columns='FLAG,FLAG_ROW')
+        nrows = subtb.nrows()
+        for startrow in range(0, nrows, chunksize):
+            nrow = min(chunksize, nrows - startrow)
+            key = 'dd%d_row%d' % (ddid, startrow)
+            shape = subtb.getcol('FLAG', startrow, 1).shape[:2] + (nrow,)
+            flags = chunkflags(key, int(np.prod(shape))).reshape(shape)
+            subtb.putcol('FLAG', flags, startrow, nrow)
+            subtb.putcol('FLAG_ROW', flags.all(axis=(0, 1)), startrow, nrow)
+        subtb.close()
+    tb.close()
+
+
+def _add_array(archive, key, array):
+
+    """
+    This function writes array to the open zip file archive as key.npy,
+    so that arrays can be added to an .npz file one at a time (np.load
+    reads them back one at a time too).
+    """
+
+    with archive.open(key + '.npy', 'w', force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+
+def _encode_runs(diff):
+
+    """
+    This function run-length encodes a boolean array as the positions
+    at which its value changes, starting from False.
+    """
+
+    padded = np.concatenate(([False], diff))
+
+    return np.flatnonzero(padded[1:] != padded[:-1]).astype(np.int64)
+
+
+def _decode_runs(changes, size):
+
+    """
+    This function decodes the output of _encode_runs back into a
+    boolean array of the given size.
+    """
+
+    counts = np.zeros(size + 1, dtype=np.int64)
+    np.add.at(counts, changes, 1)
+
+    return (np.cumsum(counts[:-1]) % 2).astype(bool)
+
+
+def save_flags(vis, versionname, comment='', chunksize=100000):
+
+    """
+    This function saves the current flags of vis as the snapshot
+    versionname, replacing any existing snapshot with that name. The
+    first snapshot of an ms also stores the full flags, bit-packed and
+    compressed, as the base. Every snapshot is then stored as a
+    run-length encoding of the bits that differ from the base, which is
+    usually a tiny fraction of the size of a flagmanager copy. The flags
+    are read, compared with the base, and written one chunk of chunksize
+    rows at a time, so only one chunk is held in memory. It returns the
+    size of the snapshot in bytes. The name BASE_SNAPSHOT is reserved
+    for the base.
+
+    Example:
+        save_flags('calibrated_final_cont.ms', 'before_selfcal')
+    """
+
+    if versionname == BASE_SNAPSHOT:
+        raise ValueError("The flag version name '" + BASE_SNAPSHOT + "' is "
+                         "reserved for the base snapshot. Choose another name.")
+
+    snapdir = snapshot_dir(vis)
+    if not os.path.isdir(snapdir):
+        os.makedirs(snapdir)
+    basefile = os.path.join(snapdir, BASE_SNAPSHOT + '.npz')
+    shapesfile = os.path.join(snapdir, 'shapes.json')
+    snapfile = os.path.join(snapdir, versionname + '.npz')
+
+    newbase = not os.path.isfile(basefile)
+    if newbase:
+        sizes = {}
+        base = zipfile.ZipFile(basefile + '.tmp', 'w', zipfile.ZIP_DEFLATED)
+    else:
+        with open(shapesfile, 'r') as f:
+            sizes = json.load(f)
+        base = np.load(basefile)
+
+    nflagged = 0
+    ntotal = 0
+    keys = set()
+    try:
+        with zipfile.ZipFile(snapfile + '.tmp', 'w', zipfile.ZIP_DEFLATED) as snapshot:
+            for (key, flags) in _read_flags(vis, chunksize):
+                if newbase:
+                    _add_array(base, key, np.packbits(flags))
+                    sizes[key] = len(flags)
+                    diff = np.zeros(len(flags), dtype=bool)
+                elif sizes.get(key) != len(flags):
+                    raise ValueError("The rows of " + vis + " have changed since " +
+                                     "the base flag snapshot was made. Remove " +
+                                     snapdir + " to start again.")
+                else:
+                    diff = flags != np.unpackbits(base[key], count=len(flags)).astype(bool)
+                _add_array(snapshot, key, _encode_runs(diff))
+                keys.add(key)
+                nflagged += int(flags.sum())
+                ntotal += len(flags)
+        if keys != set(sizes):
+            raise ValueError("The rows of " + vis + " have changed since the " +
+                             "base flag snapshot was made. Remove " + snapdir +
+                             " to start again.")
+    except Exception:
+        base.close()
+        for tmpfile in [basefile + '.tmp', snapfile + '.tmp']:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+        raise
+    base.close()
+
+    if newbase:
+        with open(shapesfile, 'w') as f:
+            json.dump(sizes, f)
+        os.replace(basefile + '.tmp', basefile)
+    os.replace(snapfile + '.tmp', snapfile)
+
+    index = _read_snapshot_index(vis)
+    index[versionname] = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                          'comment': comment,
+                          'size': os.path.getsize(snapfile),
+                          'flagged': nflagged / float(max(ntotal, 1))}
+    _write_snapshot_index(vis, index)
+
+    print("Saved flag snapshot %s of %s (%.1f kB, %.1f%% flagged)" %
+          (versionname, vis, index[versionname]['size'] / 1.0e3,
+           100 * index[versionname]['flagged']))
+
+    return index[versionname]['size']
+
+
+def restore_flags(vis, versionname, chunksize=100000):
+
+    """
+    This function restores the flags of vis from the snapshot
+    versionname (see save_flags), one chunk of chunksize rows at a
+    time.
+
+    Example:
+        restore_flags('calibrated_final_cont.ms', 'before_selfcal')
+    """
+
+    snapdir = snapshot_dir(vis)
+    if versionname not in _read_snapshot_index(vis):
+        raise ValueError("No flag snapshot " + versionname + " for " + vis)
+
+    with open(os.path.join(snapdir, 'shapes.json'), 'r') as f:
+        sizes = json.load(f)
+
+    base = np.load(os.path.join(snapdir, BASE_SNAPSHOT + '.npz'))
+    runs = np.load(os.path.join(snapdir, versionname + '.npz'))
+
+    def chunkflags(key, size):
+        if sizes.get(key) != size:
+            raise ValueError("The rows of " + vis + " have changed since the " +
+                             "flag snapshot " + versionname + " was made.")
+        baseflags = np.unpackbits(base[key], count=size).astype(bool)
+        return baseflags ^ _decode_runs(runs[key], size)
+
+    try:
+        _write_flags(vis, chunkflags, chunksize)
+    finally:
+        base.close()
+        runs.close()
+
+    print("Restored flag snapshot " + versionname + " of " + vis)
+
+
+def list_flag_snapshots(vis):
+
+    """
+    This function prints the flag snapshots of vis with their date,
+    size, fraction of flagged data, and comment, and returns the
+    snapshot index.
+
+    Example:
+        list_flag_snapshots('calibrated_final_cont.ms')
+    """
+
+    index = _read_snapshot_index(vis)
+    basefile = os.path.join(snapshot_dir(vis), BASE_SNAPSHOT + '.npz')
+    if os.path.isfile(basefile):
+        print("Base flags of %s: %.1f kB" % (vis, os.path.getsize(basefile) / 1.0e3))
+    for (name, entry) in sorted(index.items(), key=lambda item: item[1]['date']):
+        print("  %-24s %s %10.1f kB %6.1f%% flagged  %s" %
+              (name, entry['date'], entry['size'] / 1.0e3,
+               100 * entry['flagged'], entry['comment']))
+
+    return index
+
+
+def delete_flag_snapshot(vis, versionname):
+
+    """
+    This function deletes the flag snapshot versionname of vis. The
+    whole snapshot directory is removed with the last snapshot.
+    """
+
+    index = _read_snapshot_index(vis)
+    if versionname in index:
+        del index[versionname]
+        os.remove(os.path.join(snapshot_dir(vis), versionname + '.npz'))
+        _write_snapshot_index(vis, index)
+    if not index and os.path.isdir(snapshot_dir(vis)):
+        shutil.rmtree(snapshot_dir(vis))
+
+
+def snapshot_flagmanager(vis, mode='list', versionname='', comment='',
+                         merge='replace', **kwargs):
+
+    """
+    This function takes the same parameters as the CASA flagmanager task
+    for modes 'save', 'restore', 'list', and 'delete', but uses flag
+    snapshots (see save_flags) instead of full copies of the flags in
+    <vis>.flagversions. Versions that only exist in .flagversions (e.g.,
+    saved by other tasks) are restored and listed with the CASA
+    flagmanager. The merge parameter is accepted for compatibility;
+    flags are always restored exactly as saved. Snapshots can only be
+    restored with this function, not with the CASA flagmanager, so
+    don't use it in scripts delivered to the PI.
+
+    Example:
+        from flag_snapshots import snapshot_flagmanager
+        snapshot_flagmanager(vis=finalvis, mode='save',
+                             versionname='before_cont_flags')
+    """
+
+    import casatasks
+
+    if mode == 'save':
+        save_flags(vis, versionname, comment=comment)
+    elif mode == 'restore':
+        if versionname in _read_snapshot_index(vis):
+            restore_flags(vis, versionname)
+        else:
+            casatasks.flagmanager(vis=vis, mode='restore',
+                                  versionname=versionname, merge=merge,
+                                  **kwargs)
+    elif mode == 'delete':
+        if versionname in _read_snapshot_index(vis):
+            delete_flag_snapshot(vis, versionname)
+        else:
+            casatasks.flagmanager(vis=vis, mode='delete',
+                                  versionname=versionname, **kwargs)
+    elif mode == 'list':
+        list_flag_snapshots(vis)
+        if os.path.isdir(vis.rstrip('/') + '.flagversions'):
+            casatasks.flagmanager(vis=vis, mode='list', **kwargs)
+    else:
+        casatasks.flagmanager(vis=vis, mode=mode, versionname=versionname,
+                              comment=comment, merge=merge, **kwargs)
@@ -0,0 +1,172 @@
+import math
+import os
+
+import numpy as np
+
+from ms_metadata import get_ms_index, select_field_ids
+
+C = 299792458.0
+
+# Primary beam size in arcsec times the sky frequency in GHz for the
+# 12m and 7m antennas (see the "imaging parameters" section of the
+# imaging script).
+PB_SCALE = {'12m': 6300.0,
+            '7m': 10608.0}
+
+
+def fft_size(n):
+
+    """
+    This function returns the smallest even number that is at least n
+    and has no prime factors other than 2, 3, and 5. The FFTs used for
+    gridding run fastest on these sizes.
+
+    Example:
+        fft_size(1001) # returns 1024
+        fft_size(130) # returns 144
+    """
+
+    size = max(int(math.ceil(n)), 2)
+    while True:
+        if size % 2 == 0:
+            rest = size
+            for factor in (2, 3, 5):
+                while rest % factor == 0:
+                    rest //= factor
+            if rest == 1:
+                return size
+        size += 1
+
+
+def _round_down(value, digits=2):
+
+    """
+    This function rounds a positive value down to digits significant
+    figures, e.g., 0.1289 to 0.12, so that a cell size never ends up
+    larger than the one asked for.
+    """
+
+    scale = 10.0 ** (math.floor(math.log10(value)) - digits + 1)
+
+    # the small tolerance keeps values that are already round (e.g.,
+    # 0.12, which is 11.999... x 0.01 in floating point) unchanged.
+    return float('%.*g' % (digits, math.floor(value / scale * (1.0 + 1.0e-9)) * scale))
+
+
+def max_uv_distance(vis, spws='', field='', chunksize=1000000):
+
+    """
+    This function returns the longest projected baseline (uv distance)
+    of the unflagged data of each spw of vis in wavelengths at the
+    highest frequency of the spw. Unlike the antenna positions, this
+    takes into account the projection of the baselines onto the sky.
+    The UVW column is read in chunks of chunksize rows. The field
+    parameter selects the fields (e.g., '4~150'); by default all
+    target fields are used.
+
+    Example:
+        maxuv = max_uv_distance('calibrated_final.ms', spws='0,1,2,3')
+    """
+
+    from casatools import table
+
+    index = get_ms_index(vis)
+    spwinfo = dict((spw['id'], spw) for spw in index['spws'])
+    spwlist = ([int(s) for s in str(spws).split(',') if s != ''] or
+               index['science_spws'])
+    fieldlist = (select_field_ids(index, field) if field != '' else
+                 index['target_fields'])
+
+    tb = table()
+    tb.open(os.path.join(vis, 'DATA_DESCRIPTION'))
+    ddspws = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+
+    maxuv = {}
+    tb.open(vis)
+    for spw in spwlist:
+        ddids = [dd for dd in range(len(ddspws)) if ddspws[dd] == spw]
+        if not ddids:
+            continue
+
+        query = ('DATA_DESC_ID IN [%s] && ANTENNA1 != ANTENNA2 && !FLAG_ROW' %
+                 ','.join(map(str, ddids)))
+        if fieldlist:
+            query += ' && FIELD_ID IN [%s]' % ','.join(map(str, fieldlist))
+        subtb = tb.query(query, columns='UVW')
+
+        longest = 0.0
+        nrows = subtb.nrows()
+        for startrow in range(0, nrows, chunksize):
+            uvw = subtb.getcol('UVW', startrow, min(chunksize, nrows - startrow))
+            longest = max(longest, float(np.hypot(uvw[0], uvw[1]).max()))
+        subtb.close()
+
+        info = spwinfo[spw]
+        maxfreq = max(info['chanfreq0'],
+                      info['chanfreq0'] + info['chanwidth'] * (info['nchan'] - 1))
+        maxuv[spw] = longest * maxfreq / C
+
+    tb.close()
+
+    return maxuv
+
+
+def pick_cell_imsize(vis, spws='', field='', cellsperbeam=5, pbfactor=1.0):
+
+    """
+    This function returns the cell size and image size for imaging the
+    spws of vis together. The cell gives at least cellsperbeam (5-8)
+    pixels across the synthesized beam, estimated as 206265/(longest
+    projected baseline in wavelengths) arcsec (see max_uv_distance),
+    and is rounded down to two significant figures. For a single field
+    the image covers pbfactor times the primary beam (6300/nu[GHz]
+    arcsec for the 12m array and 10608/nu[GHz] arcsec for the 7m array,
+    at the lowest frequency). For a mosaic it covers the extent of the
+    pointings plus pbfactor times the primary beam. The image size is
+    rounded up to a fast FFT size (see fft_size). Spws without any
+    unflagged cross-correlation data are left out, and a ValueError is
+    raised if none are left.
+
+    It returns a tuple of the cell as a string (e.g., '0.12arcsec') and
+    the imsize as a list (e.g., [540,540]).
+
+    Example:
+        (cell, imsize) = pick_cell_imsize('calibrated_final.ms', field='0')
+    """
+
+    index = get_ms_index(vis)
+    # spws without any unflagged cross-correlations have no baselines
+    maxuv = dict((spw, uv) for (spw, uv) in
+                 max_uv_distance(vis, spws=spws, field=field).items() if uv > 0)
+    if not maxuv:
+        raise ValueError("No unflagged cross-correlation data selected in " +
+                         vis + " (spws='" + str(spws) + "', field='" +
+                         str(field) + "')")
+
+    beam = 206265.0 / max(maxuv.values())
+    cell = _round_down(beam / cellsperbeam)
+
+    minfreq = min(spw['meanfreq'] - 0.5 * spw['bandwidth']
+                  for spw in index['spws'] if spw['id'] in maxuv)
+    pbsize = PB_SCALE.get(index['array'], PB_SCALE['7m']) / (minfreq / 1.0e9)
+
+    fieldlist = (select_field_ids(index, field) if field != '' else
+                 index['target_fields'])
+    fields = [f for f in index['fields'] if f['id'] in fieldlist]
+    dec0 = fields[0]['dec']
+    ra = np.array([(f['ra'] - fields[0]['ra'] + np.pi) % (2 * np.pi) - np.pi
+                   for f in fields]) * np.cos(dec0)
+    dec = np.array([f['dec'] - dec0 for f in fields])
+    width = (ra.max() - ra.min()) * 206265.0 + pbfactor * pbsize
+    height = (dec.max() - dec.min()) * 206265.0 + pbfactor * pbsize
+
+    imsize = [fft_size(width / cell), fft_size(height / cell)]
+
+    print("Longest projected baseline: %.0f klambda (beam ~%.3g arcsec)" %
+          (max(maxuv.values()) / 1.0e3, beam))
+    print("Primary beam: %.1f arcsec (%s array), %d field(s)" %
+          (pbsize, index['array'], len(fields)))
+    print("cell = '%garcsec', imsize = %s" % (cell, imsize))
+
+    return ('%garcsec' % cell, imsize)
@@ -0,0 +1,283 @@
+import json
+
+from stage_cache import run_stage
+
+
+def split_continuum(finalvis, contvis, contspws, width, timebin='0s',
+                    flagchannels='', usecache=True):
+
+    """
+    This function creates the averaged continuum ms contvis from
+    finalvis, as in the "Create an Averaged Continuum MS" section of
+    the imaging script. The line channels given in flagchannels are
+    flagged before averaging and the original flags of finalvis are
+    restored afterwards. With usecache, the channelized weights are
+    only initialized if finalvis doesn't have them yet. The data are also averaged in time if
+    timebin is set (see continuum_utils.continuum_timebin).
+
+    Example:
+        split_continuum('calibrated_final.ms', 'calibrated_final_cont.ms',
+                        '0,1,2,3', [256,8,8,8],
+                        flagchannels='2:1201~2199,3:1201~2199')
+    """
+
+    from casatasks import flagdata, flagmanager, initweights
+    from casatools import table
+
+    flagmanager(vis=finalvis, mode='save', versionname='before_cont_flags')
+
+    # rewriting the weights would make the cached split out of date
+    tb = table()
+    tb.open(finalvis)
+    hasweightspectrum = 'WEIGHT_SPECTRUM' in tb.colnames()
+    tb.close()
+    if not (usecache and hasweightspectrum):
+        initweights(vis=finalvis, wtmode='weight', dowtsp=True)
+
+    if flagchannels:
+        flagdata(vis=finalvis, mode='manual', spw=flagchannels,
+                 flagbackup=False)
+
+    run_stage('split', usecache=usecache,
+              vis=finalvis, spw=contspws, outputvis=contvis,
+              width=width, timebin=timebin, datacolumn='data')
+
+    flagmanager(vis=finalvis, mode='restore', versionname='before_cont_flags')
+
+
+def _tclean_mfs(vis, imagename, imagepars, usecache=True, **kwargs):
+
+    """
+    This function runs a continuum (mfs) tclean with the imaging
+    parameters in imagepars (field, imsize, cell, gridder, weighting,
+    robust, niter, threshold, interactive, etc.). Any extra keyword
+    arguments are passed on to tclean. See _tclean for the autoclean
+    entry of imagepars.
+    """
+
+    pars = {'specmode': 'mfs',
+            'deconvolver': 'hogbom',
+            'usepointing': False}
+    pars.update(imagepars)
+    pars.update(kwargs)
+
+    return _tclean(vis, imagename, pars, usecache=usecache)
+
+
+def _tclean(vis, imagename, pars, usecache=True):
+
+    """
+    This function runs tclean with the parameters pars through the
+    stage cache. If pars has an 'autoclean' entry greater than 0, the
+    image is cleaned non-interactively with automasking down to
+    autoclean times the noise of a quick dirty image, and the result
+    is recorded (see auto_clean.auto_tclean).
+    """
+
+    pars = dict(pars)
+    nsigma = pars.pop('autoclean', 0)
+    if nsigma:
+        from auto_clean import auto_tclean
+        return auto_tclean(nsigma=nsigma, usecache=usecache,
+                           vis=vis, imagename=imagename, **pars)
+
+    return run_stage('tclean', usecache=usecache,
+                     vis=vis, imagename=imagename, **pars)
+
+
+def restored_image(imagename, imagepars):
+
+    """
+    This function returns the name of the restored image that tclean
+    writes for imagename with the imaging parameters imagepars:
+    imagename + '.image', or imagename + '.image.tt0' (the first Taylor
+    term) for deconvolver='mtmfs'. Use it to declare the outputs of a
+    continuum imaging stage.
+
+    Example:
+        restored_image(contimagename, {'deconvolver': 'mtmfs', 'nterms': 2})
+    """
+
+    if imagepars.get('deconvolver', 'hogbom') == 'mtmfs':
+        return imagename + '.image.tt0'
+
+    return imagename + '.image'
+
+
+def image_continuum(contvis, contimagename, imagepars, usecache=True):
+
+    """
+    This function makes the continuum image contimagename from contvis
+    as in the "Imaging the Continuum" section of the imaging script.
+
+    Example:
+        image_continuum('calibrated_final_cont.ms', contimagename,
+                        {'field': '0', 'imsize': [128,128],
+                         'cell': '1arcsec', 'gridder': 'standard',
+                         'weighting': 'briggs', 'robust': 0.5,
+                         'niter': 1000, 'threshold': '0.0mJy',
+                         'interactive': False})
+    """
+
+    _tclean_mfs(contvis, contimagename, imagepars, usecache=usecache,
+                pbcor=True)
+
+
+def selfcal_continuum(contvis, contimagename, imagepars, refant, spwmap,
+                      rounds=None, minimprovement=0.02, warmstart=False,
+                      usecache=True):
+
+    """
+    This function self-calibrates the continuum ms contvis as in the
+    "Self-calibration on the continuum" section of the imaging script
+    using selfcal.run_selfcal. The rounds are (solint, calmode) tuples;
+    by default the pcal1, pcal2, pcal3, and apcal rounds of the script
+    are run. The self-calibrated data are saved in contvis + '.selfcal'
+    and the corrected data column of contvis is then reset. The summary
+    of the rounds and the accepted calibration tables are written to
+    contimagename + '_selfcal_summary.txt(.json)'. If warmstart is
+    True, each round starts from the model of the previous round. An
+    empty spwmap is taken from the metadata index of contvis.
+
+    Example:
+        selfcal_continuum('calibrated_final_cont.ms', contimagename,
+                          imagepars, 'DV09', [0,0,0,0])
+    """
+
+    from casatasks import clearcal
+    from selfcal import DEFAULT_ROUNDS, run_selfcal
+
+    run_selfcal(contvis, contimagename, imagepars, refant, spwmap,
+                rounds=rounds or DEFAULT_ROUNDS,
+                minimprovement=minimprovement, warmstart=warmstart,
+                usecache=usecache)
+
+    run_stage('split', usecache=False,
+              vis=contvis, outputvis=contvis + '.selfcal',
+              datacolumn='corrected')
+
+    clearcal(vis=contvis)
+
+
+def subtract_continuum(finalvis, fitspw, linespw, usecache=True):
+
+    """
+    This function subtracts the continuum from the line spws of
+    finalvis as in the "Continuum Subtraction for Line Imaging" section
+    of the imaging script. The result is written to
+    finalvis + '.contsub'.
+
+    Example:
+        subtract_continuum('calibrated_final.ms',
+                           '2:0~1200;1500~3839,3:0~1200;1500~3839', '2,3')
+    """
+
+    run_stage('uvcontsub', usecache=usecache,
+              vis=finalvis, spw=linespw, fitspw=fitspw,
+              excludechans=False, solint='int', fitorder=1,
+              want_cont=False)
+
+
+def apply_selfcal_to_line(linevis, field, spwmap_line, selfcalsummary):
+
+    """
+    This function applies the continuum self-calibration tables to the
+    line ms linevis and saves the result in linevis + '.selfcal' as in
+    the "Apply continuum self-calibration to line data" section of the
+    imaging script, in a single pass over the data (see
+    selfcal.apply_and_split). The tables are the ones accepted by
+    selfcal.run_selfcal and are read from its summary file
+    selfcalsummary. The executions of linevis are matched with those of
+    the self-calibrated continuum ms (see ms_metadata.match_executions),
+    and if spwmap_line is empty, it is derived from them (see
+    ms_metadata.line_spwmap).
+
+    Example:
+        apply_selfcal_to_line('calibrated_final.ms.contsub', '0', [0],
+                              contimagename + '_selfcal_summary.txt')
+    """
+
+    from ms_metadata import get_ms_index, line_spwmap, match_executions
+    from selfcal import apply_and_split, read_selfcal_tables
+
+    gaintables = read_selfcal_tables(selfcalsummary)
+    with open(selfcalsummary + '.json', 'r') as f:
+        contvis = json.load(f)['vis']
+    obsmap = match_executions(get_ms_index(linevis), get_ms_index(contvis))
+    if not spwmap_line:
+        spwmap_line = line_spwmap(linevis, contvis)
+
+    apply_and_split(linevis, linevis + '.selfcal', gaintables, spwmap_line,
+                    field=field, obsmap=obsmap)
+
+
+def _cube_pars(imagepars, restoringbeam='common', weighting='briggsbwtaper'):
+
+    """
+    This function returns the tclean parameters of a line cube: the
+    imaging parameters in imagepars together with the cube settings of
+    the "Image line emission" section of the imaging script.
+    """
+
+    pars = {'usepointing': False}
+    pars.update(imagepars)
+    pars.update({'specmode': 'cube',
+                 'perchanweightdensity': True,
+                 'weighting': weighting,
+                 'pbcor': True,
+                 'restoringbeam': restoringbeam})
+
+    return pars
+
+
+def image_line(linevis, lineimagename, imagepars, spw, restfreq, start,
+               width, nchan, outframe='lsrk', veltype='radio',
+               restoringbeam='common', weighting='briggsbwtaper',
+               usecache=True):
+
+    """
+    This function makes the line cube lineimagename as in the "Image
+    line emission" section of the imaging script. By default the cube
+    is restored with a common beam for all channels; set restoringbeam
+    to '' to keep the beam of each channel. The cube is weighted with
+    briggsbwtaper as in the script unless weighting is given.
+
+    Example:
+        image_line('calibrated_final.ms.contsub.selfcal', lineimagename,
+                   imagepars, '1', '115.27120GHz', '-100km/s', '2km/s', 100)
+    """
+
+    pars = _cube_pars(imagepars, restoringbeam, weighting)
+    pars.update({'spw': spw, 'start': start, 'width': width, 'nchan': nchan,
+                 'outframe': outframe, 'veltype': veltype,
+                 'restfreq': restfreq})
+
+    _tclean(linevis, lineimagename, pars, usecache=usecache)
+
+
+def export_images(patterns=['*.pbcor', '*.pb'], bitpix=-32, compress='',
+                  nprocs=4):
+
+    """
+    This function exports the images matching patterns to FITS as in
+    the "Export the images" section of the imaging script (see
+    fits_export.export_fits).
+    """
+
+    from fits_export import export_fits
+
+    export_fits(patterns=patterns, bitpix=bitpix, compress=compress,
+                nprocs=nprocs)
+
+
+def make_pngs(nprocs=4):
+
+    """
+    This function creates the diagnostic PNGs as in the "Create
+    Diagnostic PNGs" section of the imaging script (see
+    diagnostic_pngs.make_diagnostic_pngs).
+    """
+
+    from diagnostic_pngs import make_diagnostic_pngs
+
+    make_diagnostic_pngs(nprocs=nprocs)
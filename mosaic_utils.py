@@ -0,0 +1,507 @@
+import math
+import os
+import shutil
+
+import numpy as np
+
+from imaging_params import fft_size
+from ms_metadata import get_ms_index, select_field_ids
+from parallel_utils import run_casa_jobs
+
+C = 299792458.0
+
+
+def _to_rad(angle):
+
+    """
+    This function converts an angle (e.g., '0.5arcsec', '19h30m00',
+    or '-40d00m00') to radians.
+    """
+
+    from casatools import quanta
+
+    qa = quanta()
+
+    return qa.convert(qa.toangle(angle), 'rad')['value']
+
+
+def _direction(index, phasecenter):
+
+    """
+    This function returns the (ra, dec) in radians of a phase center
+    given as a field id or as a 'J2000 19h30m00 -40d00m00' string.
+    """
+
+    if isinstance(phasecenter, int) or str(phasecenter).isdigit():
+        fieldinfo = [f for f in index['fields'] if f['id'] == int(phasecenter)][0]
+        return (fieldinfo['ra'], fieldinfo['dec'])
+
+    parts = phasecenter.split()
+    if len(parts) != 3 or parts[0] != 'J2000':
+        raise ValueError("Give the phasecenter as a field id or as 'J2000 <ra> <dec>'")
+
+    return (_to_rad(parts[1]), _to_rad(parts[2]))
+
+
+def primary_beam_fwhm(index):
+
+    """
+    This function returns the FWHM of the primary beam in radians
+    (1.13 lambda/D) at the mean frequency of the science spws, for the
+    smallest antennas in the ms.
+    """
+
+    freqs = [spw['meanfreq'] for spw in index['spws']
+             if spw['id'] in index['science_spws']]
+    diameter = min(ant['diameter'] for ant in index['antennas'])
+
+    return 1.13 * C / np.mean(freqs) / diameter
+
+
+def mosaic_tiles(vis, field, imagepars, ntiles=(2, 2), margin=1.0):
+
+    """
+    This function partitions the mosaic fields selected by field into
+    ntiles[0] x ntiles[1] rectangular tiles. The tiles cover the
+    bounding box of the pointings. Each tile images all the pointings
+    within margin primary beam FWHMs of its own area, so neighboring
+    tiles overlap, and its image extends a further primary beam FWHM
+    beyond those pointings, rounded up to a fast FFT size (see
+    imaging_params.fft_size). The cell in imagepars is used for the
+    image size. It returns a list of dictionaries with the field, phasecenter,
+    and imsize of each tile. Tiles without any pointings are left out.
+
+    Example:
+        tiles = mosaic_tiles('calibrated_final_cont.ms', '4~150',
+                             imagepars, ntiles=(3,3))
+    """
+
+    index = get_ms_index(vis)
+    ids = select_field_ids(index, field)
+    fields = [f for f in index['fields'] if f['id'] in ids]
+    if not fields:
+        raise ValueError("No fields selected by " + str(field))
+
+    cell = _to_rad(imagepars['cell'][0] if isinstance(imagepars['cell'], list)
+                   else imagepars['cell'])
+    fwhm = primary_beam_fwhm(index)
+
+    # offsets of the pointings in the tangent plane around the first
+    # pointing (small-angle approximation, fine for mosaics).
+    (ra0, dec0) = (fields[0]['ra'], fields[0]['dec'])
+    dra = np.array([(f['ra'] - ra0 + np.pi) % (2 * np.pi) - np.pi for f in fields])
+    x = dra * np.cos(dec0)
+    y = np.array([f['dec'] - dec0 for f in fields])
+
+    xedges = np.linspace(x.min(), x.max(), ntiles[0] + 1)
+    yedges = np.linspace(y.min(), y.max(), ntiles[1] + 1)
+
+    tiles = []
+    for i in range(ntiles[0]):
+        for j in range(ntiles[1]):
+            inside = ((x >= xedges[i] - margin * fwhm) &
+                      (x <= xedges[i + 1] + margin * fwhm) &
+                      (y >= yedges[j] - margin * fwhm) &
+                      (y <= yedges[j + 1] + margin * fwhm))
+            if not inside.any():
+                continue
+            (xc, yc) = (0.5 * (xedges[i] + xedges[i + 1]),
+                        0.5 * (yedges[j] + yedges[j + 1]))
+            halfx = max(abs(x[inside] - xc).max(), 0.0) + fwhm
+            halfy = max(abs(y[inside] - yc).max(), 0.0) + fwhm
+            imsize = [fft_size(2 * int(math.ceil(halfx / cell))),
+                      fft_size(2 * int(math.ceil(halfy / cell)))]
+            ra = ra0 + xc / np.cos(dec0)
+            dec = dec0 + yc
+            tiles.append({'field': ','.join(str(fields[k]['id']) for k in
+                                            np.nonzero(inside)[0]),
+                          'phasecenter': 'J2000 %.12frad %.12frad' % (ra, dec),
+                          'imsize': imsize})
+
+    return tiles
+
+
+def _output_template(image, imsize, phasecenter):
+
+    """
+    This function returns an imregrid template (as returned by
+    imregrid(template='get')) with the coordinate system of image,
+    centred on phasecenter (ra, dec in radians) and with imsize pixels.
+    """
+
+    from casatasks import imregrid
+    from casatools import coordsys, quanta
+
+    qa = quanta()
+    template = imregrid(imagename=image, template='get')
+
+    cs = coordsys()
+    cs.fromrecord(template['csys'])
+    units = cs.units('direction')
+    cs.setreferencevalue(type='direction',
+                         value=[qa.convert(qa.quantity(angle, 'rad'), unit)['value']
+                                for (angle, unit) in zip(phasecenter, units)])
+    cs.setreferencepixel(type='direction',
+                         value=[imsize[0] // 2, imsize[1] // 2])
+    template['csys'] = cs.torecord()
+    cs.done()
+
+    shape = list(template['shap'])
+    shape[0] = imsize[0]
+    shape[1] = imsize[1]
+    template['shap'] = shape
+
+    return template
+
+
+def _read_image(imagename):
+
+    """
+    This function returns the pixels of an image with masked pixels
+    (and NaNs) set to 0, and the mask (True for good pixels).
+    """
+
+    from casatools import image
+
+    ia = image()
+    ia.open(imagename)
+    pixels = ia.getchunk()
+    mask = ia.getchunk(getmask=True)
+    ia.close()
+
+    mask &= np.isfinite(pixels)
+    pixels[~mask] = 0.0
+
+    return (pixels, mask)
+
+
+def _write_image(template, imagename, pixels, maskexpr=''):
+
+    """
+    This function writes pixels to imagename, using the image template
+    for the coordinates, beam, and units. If maskexpr is given, it is
+    set as the pixel mask (an LEL expression).
+    """
+
+    from casatools import image
+
+    if os.path.exists(imagename):
+        shutil.rmtree(imagename)
+    shutil.copytree(template, imagename)
+
+    ia = image()
+    ia.open(imagename)
+    ia.putchunk(pixels)
+    if maskexpr:
+        ia.calcmask(maskexpr, name='linmos', asdefault=True)
+    ia.close()
+
+
+def _beam_matrix(beam):
+
+    """
+    This function returns the 2x2 covariance matrix (in arcsec^2, up to
+    a constant factor) of a Gaussian beam given as (major, minor, pa)
+    with the FWHMs in arcsec and the position angle in degrees east of
+    north.
+    """
+
+    (major, minor, pa) = beam
+    pa = np.radians(pa)
+    u = np.array([np.sin(pa), np.cos(pa)])
+    v = np.array([np.cos(pa), -np.sin(pa)])
+
+    return major ** 2 * np.outer(u, u) + minor ** 2 * np.outer(v, v)
+
+
+def _matrix_beam(matrix):
+
+    """
+    This function returns the (major, minor, pa) beam of a covariance
+    matrix made by _beam_matrix, with the position angle in (-90, 90].
+    """
+
+    (values, vectors) = np.linalg.eigh(matrix)
+    values = np.maximum(values, 0.0)
+    u = vectors[:, 1]
+    pa = np.degrees(np.arctan2(u[0], u[1]))
+    if pa <= -90:
+        pa += 180
+    elif pa > 90:
+        pa -= 180
+
+    return (float(np.sqrt(values[1])), float(np.sqrt(values[0])), float(pa))
+
+
+def common_beam(beams):
+
+    """
+    This function returns a beam that encloses all the beams in beams,
+    each given as (major, minor, pa) with the FWHMs in arcsec and the
+    position angle in degrees. It starts from the beam of largest area
+    and grows it along the directions where another beam sticks out, so
+    every beam can be convolved to the result. The result is the
+    smallest enclosing beam when one of the beams encloses the others,
+    and close to it otherwise.
+
+    Example:
+        common_beam([(0.52, 0.41, 30.0), (0.50, 0.44, -60.0)])
+    """
+
+    matrices = [_beam_matrix(beam) for beam in beams]
+    common = max(matrices, key=np.linalg.det)
+    for matrix in matrices:
+        (values, vectors) = np.linalg.eigh(common - matrix)
+        common = common - np.dot(vectors * np.minimum(values, 0.0), vectors.T)
+
+    return _matrix_beam(common)
+
+
+def _image_beams(imagename):
+
+    """
+    This function returns the restoring beams of all planes of an image
+    as a list of (major, minor, pa) in arcsec and degrees.
+    """
+
+    from casatools import image, quanta
+
+    qa = quanta()
+    ia = image()
+    ia.open(imagename)
+    info = ia.restoringbeam()
+    ia.close()
+
+    if 'beams' in info:
+        beams = [beam for channel in info['beams'].values()
+                 for beam in channel.values()]
+    else:
+        beams = [info]
+
+    return [(qa.convert(beam['major'], 'arcsec')['value'],
+             qa.convert(beam['minor'], 'arcsec')['value'],
+             qa.convert(beam['positionangle'], 'deg')['value'])
+            for beam in beams]
+
+
+def restore_tile(vis, imagename, imagepars, restoringbeam):
+
+    """
+    This function restores an existing tile image (made by
+    image_mosaic_tiled) with the given restoring beam, without any
+    further cleaning. The imaging parameters must be the ones the tile
+    was made with.
+    """
+
+    from casatasks import tclean
+
+    pars = {'specmode': 'mfs',
+            'deconvolver': 'hogbom',
+            'usepointing': False}
+    pars.update(imagepars)
+    pars.pop('autoclean', None)
+    pars.update({'niter': 0, 'calcres': False, 'calcpsf': False,
+                 'restart': True, 'interactive': False,
+                 'restoringbeam': restoringbeam})
+
+    tclean(vis=vis, imagename=imagename, **pars)
+
+
+def combine_tiles(images, pbs):
+
+    """
+    This function combines tiles that are on the same grid by
+    primary-beam-weighted linear mosaicking. images are the flat noise
+    tile images I and pbs their primary beams A, with masked pixels set
+    to 0 in the primary beams. It returns the primary beam corrected
+    mosaic sum(A I) / sum(A^2) and its primary beam sum(A^2) / sum(A),
+    both 0 where no tile has any weight.
+    """
+
+    num = 0.0
+    den = 0.0
+    sumpb = 0.0
+    for (image, pb) in zip(images, pbs):
+        num = num + pb * image
+        den = den + pb ** 2
+        sumpb = sumpb + pb
+
+    good = np.asarray(den > 0)
+    pbcor = np.where(good, num / np.where(good, den, 1.0), 0.0)
+    pbout = np.where(good, den / np.where(good, sumpb, 1.0), 0.0)
+
+    return (pbcor, pbout)
+
+
+def linear_mosaic(tileimages, imagename, imsize, phasecenter, pblimit=0.2):
+
+    """
+    This function combines the tile images (image names without the
+    .image extension) into imagename.image, imagename.pb, and
+    imagename.image.pbcor using primary-beam-weighted linear
+    mosaicking (see combine_tiles). Each tile is regridded onto the
+    output grid given by imsize and phasecenter (ra, dec in radians).
+    Pixels where the primary beam is below pblimit are masked. The
+    tiles must have the same restoring beam, which is copied to the
+    output (image_mosaic_tiled restores them with a common beam).
+    """
+
+    from casatasks import imregrid
+
+    template = _output_template(tileimages[0] + '.image', imsize, phasecenter)
+
+    images = []
+    pbs = []
+    regridded = []
+    for tile in tileimages:
+        for ext in ['.image', '.pb']:
+            output = tile + ext + '.linmos'
+            if os.path.exists(output):
+                shutil.rmtree(output)
+            imregrid(imagename=tile + ext, template=template, output=output,
+                     overwrite=True)
+            regridded.append(output)
+        (image, imagemask) = _read_image(tile + '.image.linmos')
+        (pb, pbmask) = _read_image(tile + '.pb.linmos')
+        images.append(image)
+        pbs.append(np.where(imagemask & pbmask, pb, 0.0))
+
+    (pbcor, pbout) = combine_tiles(images, pbs)
+
+    _write_image(tileimages[0] + '.pb.linmos', imagename + '.pb', pbout)
+    maskexpr = '"%s" >= %g' % (imagename + '.pb', pblimit)
+    _write_image(tileimages[0] + '.image.linmos', imagename + '.image.pbcor',
+                 pbcor, maskexpr)
+    _write_image(tileimages[0] + '.image.linmos', imagename + '.image',
+                 pbcor * pbout, maskexpr)
+
+    for output in regridded:
+        shutil.rmtree(output)
+
+
+def image_mosaic_tiled(vis, imagename, imagepars, ntiles=(2, 2), margin=1.0,
+                       nprocs=4, logdir='', usecache=True):
+
+    """
+    This function images a large mosaic in overlapping spatial tiles
+    (see mosaic_tiles), one tclean process per tile with
+    gridder='mosaic', and combines the tiles into imagename.image,
+    imagename.pb, and imagename.image.pbcor with linear_mosaic. The
+    imaging parameters in imagepars (field, imsize, cell, phasecenter,
+    weighting, robust, niter, threshold, etc.) are the ones you would
+    use for a single tclean of the whole mosaic; imsize and phasecenter
+    define the output grid and each tile gets its own imsize and
+    phasecenter. Extra tclean parameters (e.g., specmode='cube') can be
+    given in imagepars. Use interactive=False.
+
+    The tiles are made as imagename + '_tile<i>' and the CASA logs are
+    written to logdir (by default imagename + '_tiles_logs'). Tiles that
+    are up to date are not re-imaged unless usecache is False.
+
+    The tiles are cleaned separately, so each gets its own beam. Unless
+    a restoringbeam is given in imagepars, all tiles are re-restored
+    with their common beam (see common_beam) before they are combined,
+    so the mosaic has a single beam. The tiles differ from a single
+    tclean of the whole mosaic in the clean components found near their
+    edges, where the primary beam weighting favors the neighboring
+    tile. How close the two are depends on the data, so check the
+    result against a single tclean with compare_images (e.g., on a
+    cut-down imsize) before relying on it.
+
+    Example:
+        image_mosaic_tiled('calibrated_final_cont.ms', contimagename,
+                           {'field': '4~150', 'imsize': [4000,4000],
+                            'cell': '0.2arcsec',
+                            'phasecenter': 'J2000 19h30m00 -40d00m00',
+                            'weighting': 'briggs', 'robust': 0.5,
+                            'niter': 10000, 'threshold': '0.5mJy',
+                            'interactive': False},
+                           ntiles=(3,3), nprocs=9)
+    """
+
+    from imaging_stages import _tclean_mfs
+
+    index = get_ms_index(vis)
+    phasecenter = imagepars.get('phasecenter', '')
+    if phasecenter == '':
+        raise ValueError("Give the phasecenter of the mosaic in imagepars")
+    if not logdir:
+        logdir = imagename + '_tiles_logs'
+
+    tiles = mosaic_tiles(vis, imagepars['field'], imagepars, ntiles=ntiles,
+                         margin=margin)
+
+    joblist = []
+    tileimages = []
+    for (i, tile) in enumerate(tiles):
+        tileimage = imagename + '_tile%d' % i
+        pars = dict(imagepars)
+        pars.update(tile)
+        pars.update({'gridder': 'mosaic', 'pbcor': False})
+        joblist.append(('tile%d' % i,
+                        {'vis': vis, 'imagename': tileimage,
+                         'imagepars': pars, 'usecache': usecache}))
+        tileimages.append(tileimage)
+        print("Tile %d: %d fields, imsize %s" %
+              (i, len(tile['field'].split(',')), tile['imsize']))
+
+    run_casa_jobs(_tclean_mfs, joblist, nprocs=nprocs, logdir=logdir)
+
+    # restore all tiles with the common beam of the mosaic
+    if not imagepars.get('restoringbeam', ''):
+        beam = common_beam(sum([_image_beams(tile + '.image')
+                                for tile in tileimages], []))
+        restoringbeam = ['%.6garcsec' % beam[0], '%.6garcsec' % beam[1],
+                         '%.6gdeg' % beam[2]]
+        print("Common beam of " + imagename + ": " + ', '.join(restoringbeam))
+        restorelist = []
+        for (tilename, pars) in joblist:
+            pars = dict(pars)
+            del pars['usecache']
+            pars['restoringbeam'] = restoringbeam
+            restorelist.append((tilename + '_restore', pars))
+        run_casa_jobs(restore_tile, restorelist, nprocs=nprocs, logdir=logdir)
+
+    imsize = imagepars['imsize']
+    if isinstance(imsize, int):
+        imsize = [imsize, imsize]
+    linear_mosaic(tileimages, imagename, imsize,
+                  _direction(index, phasecenter),
+                  pblimit=imagepars.get('pblimit', 0.2))
+
+    return imagename
+
+
+def compare_images(image, reference, pbimage='', pblimit=0.2,
+                   tolerance=0.01):
+
+    """
+    This function compares two images of the same field on the same
+    grid (e.g., the .image.pbcor of a tiled and of a single tclean of a
+    mosaic) inside the region where pbimage is above pblimit. It
+    returns the largest absolute difference and the rms of the
+    difference, both as a fraction of the peak of the reference, and
+    whether the largest difference is within tolerance.
+
+    Example:
+        compare_images('mosaic_tiled.image.pbcor', 'mosaic.image.pbcor',
+                       pbimage='mosaic.pb')
+    """
+
+    (pixels, mask) = _read_image(image)
+    (refpixels, refmask) = _read_image(reference)
+    mask &= refmask
+    if pbimage:
+        (pb, pbmask) = _read_image(pbimage)
+        mask &= pbmask & (pb >= pblimit)
+
+    diff = (pixels - refpixels)[mask]
+    peak = np.abs(refpixels[mask]).max()
+    maxdiff = float(np.abs(diff).max() / peak)
+    rmsdiff = float(np.sqrt(np.mean(diff ** 2)) / peak)
+
+    print("Largest difference: %.3g%% of peak, rms difference: %.3g%% of peak" %
+          (100 * maxdiff, 100 * rmsdiff))
+
+    return {'maxdiff': maxdiff, 'rmsdiff': rmsdiff,
+            'within_tolerance': maxdiff <= tolerance}
@@ -0,0 +1,617 @@
+import hashlib
+import json
+import os
+import re
+
+# Version of the index format. Bump this if the contents of the index
+# change so that old sidecar files are rebuilt.
+INDEX_VERSION = 4
+
+# Subtables left out of ms_data_fingerprint: almost every task appends
+# to the HISTORY.
+UNTRACKED_SUBTABLES = ['HISTORY']
+
+# Main table columns that tasks rewrite in place (flagdata, flagmanager,
+# applycal, clearcal). ms_data_fingerprint hashes the data files of
+# these columns by content, so writing the same values again (e.g.,
+# flagging the line channels and restoring the flags afterwards)
+# doesn't count as a change.
+CONTENT_COLUMNS = ['FLAG', 'FLAG_ROW', 'CORRECTED_DATA']
+
+# Data columns of the main table, by the datacolumn name of the tasks.
+DATA_COLUMNS = {'data': 'DATA', 'corrected': 'CORRECTED_DATA',
+                'model': 'MODEL_DATA'}
+
+# ALMA receiver band edges in GHz.
+ALMA_BANDS = [(1, 35.0, 50.0),
+              (2, 67.0, 84.0),
+              (3, 84.0, 116.0),
+              (4, 125.0, 163.0),
+              (5, 163.0, 211.0),
+              (6, 211.0, 275.0),
+              (7, 275.0, 373.0),
+              (8, 385.0, 500.0),
+              (9, 602.0, 720.0),
+              (10, 787.0, 950.0)]
+
+
+def alma_band(freq):
+
+    """
+    This function returns the ALMA band number for a sky frequency
+    given in Hz. It returns 0 if the frequency isn't in any ALMA band.
+
+    Example:
+        alma_band(230.538e9) # returns 6
+    """
+
+    freqghz = freq / 1.0e9
+    for (band, lo, hi) in ALMA_BANDS:
+        if lo <= freqghz <= hi:
+            return band
+
+    return 0
+
+
+def ms_fingerprint(vis, metadata_only=False):
+
+    """
+    This function returns a string that changes whenever the contents
+    of the measurement set vis change. It is computed from the names,
+    sizes, and modification times of the files in the ms, so it is
+    cheap to compute even for very large data sets.
+
+    If metadata_only is True, the column data files of the main table
+    are left out. The fingerprint then only changes when the
+    subtables (spectral windows, fields, antennas, etc.) or the
+    structure of the main table change, and not when, for example, the
+    flags or the corrected data column are written.
+
+    Example:
+        fingerprint = ms_fingerprint('calibrated_final.ms')
+    """
+
+    vis = vis.rstrip('/')
+    entries = []
+    for (dirpath, dirnames, filenames) in os.walk(vis):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            # lock files are touched whenever a table is opened
+            if filename == 'table.lock':
+                continue
+            if (metadata_only and dirpath == vis and
+                    filename not in ['table.dat', 'table.info']):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            stat = os.stat(filepath)
+            entries.append('%s:%d:%d' % (os.path.relpath(filepath, vis),
+                                         stat.st_size, stat.st_mtime_ns))
+
+    return hashlib.sha1('\n'.join(entries).encode('utf-8')).hexdigest()
+
+
+def _column_files(vis):
+
+    """
+    This function returns a dictionary mapping each column of the main
+    table of vis to the names of the data files of its storage manager
+    (table.f<n>, table.f<n>i, table.f<n>_TSM<m>).
+    """
+
+    from casatools import table
+
+    tb = table()
+    tb.open(vis)
+    dminfo = tb.getdminfo()
+    tb.close()
+
+    filenames = os.listdir(vis)
+    columnfiles = {}
+    for dm in dminfo.values():
+        pattern = re.compile(r'^table\.f%d(i|_TSM\d+)?$' % dm['SEQNR'])
+        dmfiles = sorted(f for f in filenames if pattern.match(f))
+        for column in dm['COLUMNS']:
+            columnfiles[str(column)] = dmfiles
+
+    return columnfiles
+
+
+def _file_hash(filepath, blocksize=2**20):
+
+    """
+    This function returns the SHA1 hash of the contents of filepath.
+    """
+
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+def ms_data_fingerprint(vis, datacolumn=''):
+
+    """
+    This function returns a string that changes whenever the data that
+    a task reads from the measurement set vis change: the subtables
+    (except UNTRACKED_SUBTABLES), the names of the columns read, and
+    their data files. Files of the columns in CONTENT_COLUMNS are hashed
+    by content, so flags that are changed and restored, or corrected
+    data that are written again with the same values, leave the
+    fingerprint unchanged; all other files are fingerprinted by size
+    and modification time like in ms_fingerprint. Hashing by content
+    costs a read of those columns.
+
+    If datacolumn is given ('data', 'corrected', or 'model'), the other
+    data columns are left out, falling back to DATA if datacolumn is
+    'corrected' and there is no CORRECTED_DATA column (like split and
+    tclean do). Otherwise all data columns except MODEL_DATA are
+    included.
+
+    Example:
+        fingerprint = ms_data_fingerprint('calibrated_final.ms', 'data')
+    """
+
+    vis = vis.rstrip('/')
+    entries = []
+    for subtable in sorted(os.listdir(vis)):
+        subdir = os.path.join(vis, subtable)
+        if not os.path.isdir(subdir) or subtable in UNTRACKED_SUBTABLES:
+            continue
+        for (dirpath, dirnames, filenames) in os.walk(subdir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename == 'table.lock':
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                stat = os.stat(filepath)
+                entries.append('%s:%d:%d' % (os.path.relpath(filepath, vis),
+                                             stat.st_size, stat.st_mtime_ns))
+
+    columnfiles = _column_files(vis)
+    datacolumn = datacolumn.lower()
+    if datacolumn == 'corrected' and 'CORRECTED_DATA' not in columnfiles:
+        datacolumn = 'data'
+    if datacolumn:
+        skipcolumns = [column for (name, column) in DATA_COLUMNS.items()
+                       if name != datacolumn]
+    else:
+        skipcolumns = ['MODEL_DATA']
+    columns = sorted(column for column in columnfiles
+                     if column not in skipcolumns)
+    entries.append('columns:' + ','.join(columns))
+
+    contentfiles = set(filename for column in CONTENT_COLUMNS
+                       for filename in columnfiles.get(column, []))
+    for filename in sorted(set(filename for column in columns
+                               for filename in columnfiles[column])):
+        filepath = os.path.join(vis, filename)
+        if filename in contentfiles:
+            entries.append('%s:%s' % (filename, _file_hash(filepath)))
+        else:
+            stat = os.stat(filepath)
+            entries.append('%s:%d:%d' % (filename, stat.st_size,
+                                         stat.st_mtime_ns))
+
+    return hashlib.sha1('\n'.join(entries).encode('utf-8')).hexdigest()
+
+
+def ms_size(vis):
+
+    """
+    This function returns the size of the measurement set vis on disk
+    in bytes.
+
+    Example:
+        ms_size('calibrated_final_cont.ms') / 1e9 # in GB
+    """
+
+    size = 0
+    for (dirpath, dirnames, filenames) in os.walk(vis):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+
+    return size
+
+
+def ms_index_filename(vis):
+
+    """
+    This function returns the name of the sidecar file holding the
+    metadata index of vis. The file sits next to the ms rather than
+    inside it so that it doesn't change the ms itself.
+    """
+
+    return vis.rstrip('/') + '.metadata.json'
+
+
+def spw_range(spw):
+
+    """
+    This function returns the (lowest, highest) channel frequency of a
+    spw entry of the metadata index.
+    """
+
+    lastfreq = spw['chanfreq0'] + spw['chanwidth'] * (spw['nchan'] - 1)
+
+    return (min(spw['chanfreq0'], lastfreq), max(spw['chanfreq0'], lastfreq))
+
+
+def combined_spwmap(index):
+
+    """
+    This function returns the spwmap for applying calibration solved
+    with combine='spw' to the ms of the metadata index. gaincal labels
+    the combined solutions of each execution with the lowest target spw
+    of that execution, so each target spw is mapped to the lowest
+    target spw of its execution (e.g., [0,0,0,0,4,4,4,4] for two
+    executions with four spws each). Other spws are mapped to
+    themselves.
+
+    Example:
+        spwmap = combined_spwmap(get_ms_index('calibrated_final_cont.ms'))
+    """
+
+    targetspws = index['target_spws'] or [spw['id'] for spw in index['spws']]
+    spwmap = [spw['id'] for spw in index['spws']]
+    for obs in index['observations']:
+        obsspws = [spw for spw in obs['spws'] if spw in targetspws]
+        for spw in obsspws:
+            spwmap[spw] = min(obsspws)
+
+    return spwmap
+
+
+def _overlaps(range1, range2):
+
+    """
+    This function returns True if the frequency ranges range1 and
+    range2 (low, high) overlap.
+    """
+
+    return range1[0] <= range2[1] and range2[0] <= range1[1]
+
+
+def match_executions(lineindex, contindex):
+
+    """
+    This function matches the executions of two ms split from the same
+    data (e.g., the line and the continuum ms), given their metadata
+    indexes. The observation ids can differ between the two ms (split
+    renumbers them if an execution is left out), so the executions are
+    matched by project and by the time range of the OBSERVATION table,
+    which split leaves alone. It returns a dictionary mapping each
+    observation id of lineindex to the observation id of the matching
+    execution of contindex, and raises a ValueError if an execution has
+    no match.
+
+    Example:
+        obsmap = match_executions(get_ms_index('calibrated_final.ms.contsub'),
+                                  get_ms_index('calibrated_final_cont.ms'))
+    """
+
+    obsmap = {}
+    for obs in lineindex['observations']:
+        overlaps = []
+        for contobs in contindex['observations']:
+            if contobs['project'] != obs['project']:
+                continue
+            overlap = (min(obs['timerange'][1], contobs['timerange'][1]) -
+                       max(obs['timerange'][0], contobs['timerange'][0]))
+            if overlap >= 0:
+                overlaps.append((overlap, contobs['id']))
+        if not overlaps:
+            raise ValueError("Execution %d of %s (project %s) is not in %s" %
+                             (obs['id'], lineindex['vis'], obs['project'],
+                              contindex['vis']))
+        obsmap[obs['id']] = max(overlaps)[1]
+
+    return obsmap
+
+
+def line_spwmap(linevis, contvis):
+
+    """
+    This function returns the spwmap for applying the self-calibration
+    solutions of the continuum ms contvis (solved with combine='spw') to
+    the line ms linevis. Each spw of linevis is mapped to the solution
+    spw of the same execution in contvis (see combined_spwmap), so the
+    spw and observation ids of the two ms don't have to match. The
+    executions are matched by project and time range (see
+    match_executions) and checked by frequency: every target spw of an
+    execution of linevis has to overlap in frequency with one of the
+    spws of the matching execution of contvis, whose data the combined
+    solution was solved from. Both ms are described by their metadata
+    index, so neither ms is read if the indexes are up to date.
+
+    Example:
+        spwmap_line = line_spwmap('calibrated_final.ms.contsub',
+                                  'calibrated_final_cont.ms')
+    """
+
+    line = get_ms_index(linevis)
+    cont = get_ms_index(contvis)
+    obsmap = match_executions(line, cont)
+    contobs = dict((obs['id'], obs) for obs in cont['observations'])
+    contspws = dict((spw['id'], spw) for spw in cont['spws'])
+    linespws = dict((spw['id'], spw) for spw in line['spws'])
+    targetspws = line['target_spws'] or list(linespws)
+
+    spwmap = [spw['id'] for spw in line['spws']]
+    for obs in line['observations']:
+        obsspws = [spw for spw in obs['spws'] if spw in targetspws]
+        if not obsspws:
+            continue
+        solobs = obsmap[obs['id']]
+        solspws = [spw for spw in contobs[solobs]['spws']
+                   if spw in (cont['target_spws'] or contspws)]
+        if not solspws:
+            raise ValueError("Execution %d of %s has no target spws" %
+                             (solobs, contvis))
+
+        ranges = [spw_range(contspws[spw]) for spw in solspws]
+        for spw in obsspws:
+            if not any(_overlaps(spw_range(linespws[spw]), solrange)
+                       for solrange in ranges):
+                raise ValueError("Spw %d of execution %d of %s doesn't overlap "
+                                 "in frequency with the spws of execution %d "
+                                 "of %s, so it can't use its solutions." %
+                                 (spw, obs['id'], linevis, solobs, contvis))
+            spwmap[spw] = cont['spwmap'][min(solspws)]
+
+    return spwmap
+
+
+def build_ms_index(vis, indexfile=''):
+
+    """
+    This function reads the metadata of the measurement set vis once
+    and writes it to a compact JSON sidecar file (by default
+    vis + '.metadata.json'). It returns the index as a dictionary with
+    the following entries:
+
+        nrows         : number of rows in the main table
+        spws          : list of dictionaries (id, name, nchan, chanfreq0
+                        and chanwidth in Hz, meanfreq, bandwidth, band)
+        target_spws   : spws observed with the OBSERVE_TARGET intent
+        science_spws  : target spws with more than 4 channels
+        fields        : list of dictionaries (id, name, ra, dec [rad])
+        target_fields : fields observed with the OBSERVE_TARGET intent
+        antennas      : list of dictionaries (id, name, diameter [m])
+        observations  : list of dictionaries (id, spws, antennas,
+                        inttime [s], project, timerange [MJD s] from
+                        the OBSERVATION table), one per execution
+        common_antennas : antennas present in all of the executions
+        max_baseline  : longest baseline in m (not projected)
+        min_baseline  : shortest baseline in m (not projected)
+        baseline_75   : 75th percentile baseline in m (not projected)
+        array         : '12m', '7m', or 'mixed'
+        spwmap        : the spwmap for applying solutions made with
+                        combine='spw' (see combined_spwmap)
+
+    The individual channel frequencies are not stored, but can be
+    regenerated via chanfreq0 + i * chanwidth.
+
+    Example:
+        index = build_ms_index('calibrated_final.ms')
+    """
+
+    import numpy as np
+    from casatools import msmetadata, table
+
+    if not indexfile:
+        indexfile = ms_index_filename(vis)
+
+    index = {'version': INDEX_VERSION,
+             'vis': os.path.basename(vis.rstrip('/')),
+             'fingerprint': ms_fingerprint(vis, metadata_only=True)}
+
+    msmd = msmetadata()
+    msmd.open(vis)
+
+    index['nrows'] = int(msmd.nrows())
+
+    spws = []
+    names = msmd.namesforspws()
+    for spw in range(msmd.nspw()):
+        chanfreqs = msmd.chanfreqs(spw)
+        chanwidths = msmd.chanwidths(spw)
+        meanfreq = float(msmd.meanfreq(spw))
+        spws.append({'id': spw,
+                     'name': str(names[spw]),
+                     'nchan': int(msmd.nchan(spw)),
+                     'chanfreq0': float(chanfreqs[0]),
+                     'chanwidth': float(chanwidths[0]),
+                     'meanfreq': meanfreq,
+                     'bandwidth': float(msmd.bandwidths(spw)),
+                     'band': alma_band(meanfreq)})
+    index['spws'] = spws
+
+    targetspws = msmd.spwsforintent('OBSERVE_TARGET*')
+    index['target_spws'] = [int(spw) for spw in targetspws]
+    index['science_spws'] = [int(spw) for spw in targetspws
+                             if msmd.nchan(spw) > 4]
+
+    fields = []
+    fieldnames = msmd.fieldnames()
+    for fieldid in range(msmd.nfields()):
+        direction = msmd.phasecenter(fieldid)
+        fields.append({'id': fieldid,
+                       'name': str(fieldnames[fieldid]),
+                       'ra': float(direction['m0']['value']),
+                       'dec': float(direction['m1']['value'])})
+    index['fields'] = fields
+    index['target_fields'] = [int(f) for f in
+                              msmd.fieldsforintent('OBSERVE_TARGET*')]
+
+    antennas = []
+    antnames = msmd.antennanames()
+    for antid in range(msmd.nantennas()):
+        antennas.append({'id': antid,
+                         'name': str(antnames[antid]),
+                         'diameter': float(msmd.antennadiameter(antid)['value'])})
+    index['antennas'] = antennas
+
+    tb = table()
+    tb.open(os.path.join(vis, 'OBSERVATION'))
+    projects = tb.getcol('PROJECT')
+    timeranges = tb.getcol('TIME_RANGE')
+    tb.close()
+
+    observations = []
+    usedants = set()
+    for obsid in msmd.observationids():
+        obsspws = set()
+        obsants = set()
+        inttime = 0.0
+        for scan in msmd.scannumbers(obsid=obsid):
+            obsspws.update(int(s) for s in msmd.spwsforscan(scan, obsid=obsid))
+            obsants.update(int(a) for a in msmd.antennasforscan(scan, obsid=obsid))
+        obstargetspws = [s for s in sorted(obsspws) if s in index['science_spws']]
+        if obstargetspws:
+            targetscans = msmd.scansforspw(obstargetspws[0], obsid=obsid)
+            if len(targetscans) > 0:
+                inttime = float(msmd.exposuretime(scan=targetscans[0],
+                                                  spwid=obstargetspws[0],
+                                                  obsid=obsid)['value'])
+        usedants.update(obsants)
+        observations.append({'id': int(obsid),
+                             'spws': sorted(obsspws),
+                             'antennas': sorted(obsants),
+                             'inttime': inttime,
+                             'project': str(projects[obsid]),
+                             'timerange': [float(t) for t in timeranges[:, obsid]]})
+    index['observations'] = observations
+
+    msmd.close()
+
+    common = None
+    for obs in observations:
+        if common is None:
+            common = set(obs['antennas'])
+        else:
+            common &= set(obs['antennas'])
+    index['common_antennas'] = [antnames[a] for a in sorted(common or [])]
+
+    # Baseline lengths from the antenna positions of antennas with data.
+    tb.open(os.path.join(vis, 'ANTENNA'))
+    positions = tb.getcol('POSITION').T
+    tb.close()
+    used = sorted(usedants) if usedants else list(range(len(positions)))
+    positions = positions[used]
+    lengths = np.sqrt(((positions[:, np.newaxis, :] -
+                        positions[np.newaxis, :, :]) ** 2).sum(axis=-1))
+    lengths = lengths[np.triu_indices(len(positions), k=1)]
+    index['max_baseline'] = float(lengths.max()) if lengths.size else 0.0
+    index['min_baseline'] = float(lengths.min()) if lengths.size else 0.0
+    index['baseline_75'] = float(np.percentile(lengths, 75)) if lengths.size else 0.0
+
+    diameters = set(antennas[a]['diameter'] for a in used)
+    if diameters == set([12.0]):
+        index['array'] = '12m'
+    elif diameters == set([7.0]):
+        index['array'] = '7m'
+    else:
+        index['array'] = 'mixed'
+
+    index['spwmap'] = combined_spwmap(index)
+
+    with open(indexfile, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+
+    return index
+
+
+def get_ms_index(vis, indexfile=''):
+
+    """
+    This function returns the metadata index of vis (see
+    build_ms_index for the contents). The index is read from the
+    sidecar file if it exists and is up to date; otherwise it is
+    rebuilt from the ms and the sidecar file is rewritten.
+
+    Example:
+        index = get_ms_index('calibrated_final.ms')
+        sciencespws = index['science_spws']
+    """
+
+    if not indexfile:
+        indexfile = ms_index_filename(vis)
+
+    if os.path.isfile(indexfile):
+        with open(indexfile, 'r') as f:
+            index = json.load(f)
+        if (index.get('version') == INDEX_VERSION and
+                index.get('fingerprint') == ms_fingerprint(vis, metadata_only=True)):
+            return index
+
+    print("Building metadata index for " + vis)
+    return build_ms_index(vis, indexfile=indexfile)
+
+
+def print_ms_index(index):
+
+    """
+    This function prints a short summary of a metadata index: the
+    spectral windows, target fields, executions, common antennas,
+    and longest baseline. Use this instead of scanning through the
+    listobs output.
+
+    Example:
+        print_ms_index(get_ms_index('calibrated_final.ms'))
+    """
+
+    print("Measurement set: " + index['vis'])
+    print("  Rows: %d" % index['nrows'])
+    print("  Spectral windows:")
+    for spw in index['spws']:
+        flag = '*' if spw['id'] in index['science_spws'] else ' '
+        print("   %s %3d  nchan=%5d  mean=%10.5f GHz  chanwidth=%10.4f MHz  band=%d  %s" %
+              (flag, spw['id'], spw['nchan'], spw['meanfreq'] / 1.0e9,
+               spw['chanwidth'] / 1.0e6, spw['band'], spw['name']))
+    print("  (* = science spw)")
+    print("  Target fields: " +
+          ', '.join('%d (%s)' % (f, index['fields'][f]['name'])
+                    for f in index['target_fields']))
+    for obs in index['observations']:
+        print("  Execution %d: spws %s, %d antennas, integration %.3fs" %
+              (obs['id'], ','.join(map(str, obs['spws'])),
+               len(obs['antennas']), obs['inttime']))
+    print("  Common antennas: " + ','.join(index['common_antennas']))
+    print("  Self-cal spwmap (combine='spw'): " + str(index['spwmap']))
+    print("  Baselines: %.1fm - %.1fm (%s array)" %
+          (index['min_baseline'], index['max_baseline'], index['array']))
+
+
+def select_field_ids(index, field):
+
+    """
+    This function turns a field selection (field ids or ranges like
+    '4~150,152', a list of ids, or a field name) into a list of field
+    ids using the metadata index.
+
+    Example:
+        select_field_ids(get_ms_index('calibrated_final.ms'), '4~150')
+    """
+
+    if isinstance(field, int):
+        return [field]
+    if not isinstance(field, str):
+        return [int(f) for f in field]
+
+    ids = []
+    for sel in field.split(','):
+        sel = sel.strip()
+        if not sel:
+            continue
+        if '~' in sel and sel.replace('~', '').isdigit():
+            (first, last) = sel.split('~')
+            ids.extend(range(int(first), int(last) + 1))
+        elif sel.isdigit():
+            ids.append(int(sel))
+        else:
+            ids.extend(f['id'] for f in index['fields'] if f['name'] == sel)
+
+    return ids
+
@@ -0,0 +1,83 @@
+import os
+
+
+def _run_job(func, kwargs, logfile):
+
+    """
+    This function runs a single job inside a worker process. It points
+    the CASA logger of the worker at logfile before calling func so
+    that the output of simultaneous jobs does not end up interleaved in
+    a single log.
+    """
+
+    from casatasks import casalog
+
+    casalog.setlogfile(logfile)
+    return func(**kwargs)
+
+
+def run_casa_jobs(func, joblist, nprocs=4, logdir='parallel_logs'):
+
+    """
+    This function runs func once for each job in joblist using a pool
+    of at most nprocs worker processes. Each job is a tuple of
+    (jobname, kwargs) and func is called as func(**kwargs). The CASA
+    log for each job is written to logdir/jobname.log. It returns a
+    dictionary mapping each jobname to the value returned by func.
+
+    The func argument must be defined at the top level of a module
+    (not in the casa session or a script) so that it can be sent to
+    the worker processes. If nprocs is 1, the jobs are run one after
+    another in the current process and log to the main CASA logger.
+
+    If any of the jobs fail, the remaining jobs are still run to
+    completion and a RuntimeError listing the failed jobs is raised at
+    the end.
+
+    Example:
+        from prep_utils import split_science_spws
+        joblist = [(vis, {'vis': vis}) for vis in vislist]
+        results = run_casa_jobs(split_science_spws, joblist, nprocs=4)
+    """
+
+    import concurrent.futures
+    import multiprocessing
+
+    results = {}
+
+    if nprocs <= 1 or len(joblist) <= 1:
+        for (jobname, kwargs) in joblist:
+            print("Running " + jobname)
+            results[jobname] = func(**kwargs)
+        return results
+
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir)
+
+    # CASA tools are not fork safe, so always start fresh interpreters.
+    context = multiprocessing.get_context('spawn')
+    nworkers = min(nprocs, len(joblist))
+
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nworkers,
+                                                mp_context=context) as pool:
+        futures = {}
+        for (jobname, kwargs) in joblist:
+            logfile = os.path.abspath(os.path.join(logdir, jobname + '.log'))
+            print("Submitting " + jobname + " (log: " + logfile + ")")
+            futures[pool.submit(_run_job, func, kwargs, logfile)] = jobname
+
+        for future in concurrent.futures.as_completed(futures):
+            jobname = futures[future]
+            try:
+                results[jobname] = future.result()
+                print("Finished " + jobname)
+            except Exception as err:
+                print("FAILED " + jobname + ": " + str(err))
+                failed.append(jobname)
+
+    if failed:
+        raise RuntimeError("The following jobs failed (see logs in " +
+                           logdir + "): " + ', '.join(sorted(failed)))
+
+    return results
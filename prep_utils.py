@@ -0,0 +1,261 @@
+import os
+import time
+
+from ms_metadata import get_ms_index, spw_range
+from parallel_utils import run_casa_jobs
+from stage_cache import (input_fingerprint, record_stage, run_stage,
+                         stage_is_current)
+
+
+def get_science_spws(vis):
+
+    """
+    This function returns the science spectral windows of vis as a
+    comma separated string, e.g., '17,19,21,23'. The science spws are
+    the spws observed with the OBSERVE_TARGET intent that have more
+    than 4 channels (i.e., no channel average or WVR windows). They
+    are taken from the metadata index of vis (see ms_metadata.py), so
+    the ms is only read if the index is missing or out of date.
+
+    Example:
+        sciencespws = get_science_spws('uid___A002_Xc3412f_X53ff.ms')
+    """
+
+    return ','.join(map(str, get_ms_index(vis)['science_spws']))
+
+
+def split_science_spws(vis, outputvis='', usecache=True):
+
+    """
+    This function splits the science spws of vis into outputvis. If
+    outputvis is not given, it defaults to vis + '.split.cal' to match
+    the historic imaging procedure. The split is skipped if outputvis
+    is up to date (see stage_cache.py) unless usecache is False. It
+    returns the science spws as a comma separated string.
+
+    Example:
+        sciencespws = split_science_spws('uid___A002_Xc3412f_X53ff.ms')
+    """
+
+    if not outputvis:
+        outputvis = vis + '.split.cal'
+
+    sciencespws = get_science_spws(vis)
+    run_stage('split', usecache=usecache,
+              vis=vis, outputvis=outputvis, spw=sciencespws)
+
+    return sciencespws
+
+
+def split_executions(vislist, nprocs=4, logdir='split_logs', usecache=True):
+
+    """
+    This function creates a *.split.cal file for each ms in vislist
+    using a pool of at most nprocs processes, i.e., one process per
+    execution. The CASA log for each execution is written to
+    logdir/<ms name>.log. It returns a dictionary mapping each ms to
+    its science spws (as a comma separated string).
+
+    Example:
+        splitspws = split_executions(glob.glob('*[!_t].ms'), nprocs=4)
+    """
+
+    joblist = [(os.path.basename(vis), {'vis': vis, 'usecache': usecache})
+               for vis in vislist]
+    results = run_casa_jobs(split_science_spws, joblist,
+                            nprocs=nprocs, logdir=logdir)
+
+    return dict((vis, results[os.path.basename(vis)]) for vis in vislist)
+
+
+def split_target(vis, outputvis, intent='*TARGET*', usecache=True):
+
+    """
+    This function splits the data with the given intent (by default
+    the science targets) from vis into outputvis. The split is skipped
+    if outputvis is up to date (see stage_cache.py) unless usecache is
+    False.
+
+    Example:
+        split_target('uid___A002_Xc3412f_X53ff.ms.split.cal',
+                     'uid___A002_Xc3412f_X53ff.ms.split.cal.target')
+    """
+
+    run_stage('split', usecache=usecache,
+              vis=vis, intent=intent, outputvis=outputvis, datacolumn='data')
+
+
+def make_virtual_final_ms(vislist, outputvis='calibrated_final.ms',
+                          intent='*TARGET*', nprocs=1,
+                          logdir='split_logs', usecache=True, **kwargs):
+
+    """
+    This function builds outputvis as a multi-ms (a reference ms with
+    one sub-ms per execution) instead of concatenating the executions
+    and then splitting off the science targets. The target data of each
+    ms in vislist (typically the *.ms.split.cal files) are split into a
+    per-execution ms, using nprocs processes, and the per-execution ms
+    are then moved (not copied) into outputvis with virtualconcat. This
+    writes the target data to disk once instead of two or three times
+    (concat, split, and rename). Any extra keyword arguments (e.g.,
+    forcesingleephemfield) are passed on to virtualconcat.
+
+    If outputvis is up to date with the ms in vislist and the
+    parameters, nothing is done unless usecache is False.
+
+    Example:
+        make_virtual_final_ms(glob.glob('*.ms.split.cal'), nprocs=4)
+    """
+
+    from casatasks import rmtables, virtualconcat
+
+    params = {'vis': list(vislist), 'concatvis': outputvis,
+              'intent': intent}
+    params.update(kwargs)
+
+    if usecache and stage_is_current('virtualconcat', **params):
+        print("Skipping virtualconcat for " + outputvis +
+              ": products are up to date.")
+        return
+
+    starttime = time.time()
+    inputs = dict((vis, input_fingerprint('virtualconcat', params, vis))
+                  for vis in vislist)
+
+    targetlist = [vis + '.target' for vis in vislist]
+    joblist = [(os.path.basename(vis),
+                {'vis': vis, 'outputvis': target, 'intent': intent,
+                 'usecache': usecache})
+               for (vis, target) in zip(vislist, targetlist)]
+    run_casa_jobs(split_target, joblist, nprocs=nprocs, logdir=logdir)
+
+    rmtables(outputvis)
+    os.system('rm -rf ' + outputvis + '.flagversions ' + outputvis + '.flagsnapshots')
+    virtualconcat(vis=targetlist, concatvis=outputvis, keepcopy=False,
+                  **kwargs)
+
+    # the per-execution target ms now live inside outputvis
+    for target in targetlist:
+        for ext in ['.stage.json', '.metadata.json']:
+            if os.path.isfile(target + ext):
+                os.remove(target + ext)
+
+    record_stage('virtualconcat', params, time.time() - starttime,
+                 inputs=inputs)
+
+
+def regrid_spw_groups(vis):
+
+    """
+    This function returns the science spws of vis grouped by rest
+    frequency, as a list of comma separated strings, e.g., ['0,5,10',
+    '1,6,11']. Each group holds the spws of the different executions
+    that were observed with the same spectral setup (i.e., spws with
+    the same name). Spws without a name are grouped with the spws that
+    have the same number of channels and overlap in frequency.
+
+    Example:
+        spwgroups = regrid_spw_groups('calibrated_source.ms')
+    """
+
+    index = get_ms_index(vis)
+    spws = [spw for spw in index['spws'] if spw['id'] in index['science_spws']]
+
+    groups = []
+    for spw in spws:
+        for group in groups:
+            other = group[0]
+            if spw['name'] or other['name']:
+                same = spw['name'] == other['name']
+            else:
+                (low, high) = spw_range(spw)
+                (otherlow, otherhigh) = spw_range(other)
+                same = (spw['nchan'] == other['nchan'] and
+                        low < otherhigh and otherlow < high)
+            if same:
+                group.append(spw)
+                break
+        else:
+            groups.append([spw])
+
+    return [','.join(str(spw['id']) for spw in group) for group in groups]
+
+
+def regrid_spws(vis, outputvis, spw, usecache=True, **cvelpars):
+
+    """
+    This function regrids the spws in spw of vis into a single spw in
+    outputvis with cvel2. The remaining cvel2 parameters (field, mode,
+    width, start, nchan, restfreq, outframe, veltype) are passed on in
+    cvelpars. The regrid is skipped if outputvis is up to date (see
+    stage_cache.py) unless usecache is False.
+
+    Example:
+        regrid_spws('calibrated_source.ms', 'calibrated_source_regrid.ms',
+                    '0,5,10', field='4', mode='velocity', width='0.23km/s',
+                    restfreq='115.27120GHz', outframe='bary',
+                    veltype='radio')
+    """
+
+    run_stage('cvel2', usecache=usecache,
+              vis=vis, outputvis=outputvis, spw=spw, **cvelpars)
+
+
+def regrid_line_groups(vis, outputvis, restfreqs, spwgroups=[], fields=[],
+                       nprocs=4, logdir='regrid_logs', usecache=True,
+                       **cvelpars):
+
+    """
+    This function regrids each group of spws in spwgroups (by default
+    all the groups found by regrid_spw_groups) into a single spw, with
+    one cvel2 job per group, or per group and field if a list of fields
+    is given. The jobs are run in a pool of at most nprocs processes and
+    the CASA log of each job is written to logdir/<job name>.log. The
+    rest frequency of each group is given in restfreqs, in the same
+    order as spwgroups. The remaining cvel2 parameters (mode, width,
+    start, nchan, outframe, veltype, and field if fields is not given)
+    are the same for all jobs and passed on in cvelpars.
+
+    The output of each job is written to outputvis + '.<job name>' and
+    the outputs are then combined into outputvis with concat. The
+    per-job outputs are kept so that only the jobs whose parameters or
+    input have changed are re-run (see stage_cache.py) unless usecache
+    is False. It returns outputvis.
+
+    Example:
+        regrid_line_groups('calibrated_source.ms',
+                           'calibrated_source_regrid.ms',
+                           ['115.27120GHz', '110.20135GHz'],
+                           spwgroups=['0,5,10', '2,7,12'],
+                           fields=['4'], nprocs=2, mode='velocity',
+                           width='0.23km/s', outframe='bary',
+                           veltype='radio')
+    """
+
+    if not spwgroups:
+        spwgroups = regrid_spw_groups(vis)
+
+    if len(restfreqs) != len(spwgroups):
+        raise ValueError("Give one rest frequency per spw group: " +
+                         str(spwgroups))
+
+    joblist = []
+    for (spw, restfreq) in zip(spwgroups, restfreqs):
+        for field in fields or [None]:
+            jobname = 'spw' + spw.replace(',', '_')
+            pars = dict(cvelpars)
+            if field is not None:
+                jobname += '_field' + str(field)
+                pars['field'] = str(field)
+            pars.update({'vis': vis, 'outputvis': outputvis + '.' + jobname,
+                         'spw': spw, 'restfreq': restfreq,
+                         'usecache': usecache})
+            joblist.append((jobname, pars))
+
+    run_casa_jobs(regrid_spws, joblist, nprocs=nprocs, logdir=logdir)
+
+    run_stage('concat', usecache=usecache,
+              vis=[pars['outputvis'] for (jobname, pars) in joblist],
+              concatvis=outputvis)
+
+    return outputvis
@@ -0,0 +1,243 @@
+import math
+import os
+
+from cube_utils import (GRID_PADDING, GRIDDER_CFCACHE, available_memory,
+                        cube_memory, cube_nchunks)
+from imaging_params import fft_size
+from ms_metadata import get_ms_index
+
+# Number of full-size pixels in the convolution support of each gridder.
+GRIDDER_SUPPORT = {'standard': 7 * 7,
+                   'wproject': 15 * 15,
+                   'mosaic': 15 * 15,
+                   'awproject': 31 * 31}
+
+# Rough throughput of a single core: gridded visibility-channel
+# support points per second and FFT flops per second. These are only
+# meant to give the order of magnitude of the run time. Scale them to
+# match the wall times recorded in the *.stage.json files on your
+# machine if necessary.
+GRID_RATE = 2.0e8
+FFT_RATE = 1.0e9
+
+# Products written by tclean for each plane of an image: image,
+# residual, psf, model, pb, mask, weight, and image.pbcor.
+PRODUCT_PLANES = 8
+
+
+def _selected_spws(index, spw):
+
+    """
+    This function returns the spw entries of the metadata index selected
+    by spw (e.g., '1', '0,5,10', or '' for all science spws).
+    """
+
+    try:
+        ids = [int(sel.split(':')[0]) for sel in str(spw).split(',') if sel]
+    except ValueError:
+        ids = []
+    if not ids:
+        ids = index['science_spws']
+
+    return [entry for entry in index['spws'] if entry['id'] in ids]
+
+
+def _mfs_memory(imsize, nterms, gridder):
+
+    """
+    This function returns the peak memory in bytes of an mfs tclean with
+    imsize pixels and nterms Taylor terms: the image planes tclean keeps
+    in memory, the padded gridding and FFT planes, and the convolution
+    function cache of the gridder.
+    """
+
+    npix = imsize[0] * imsize[-1]
+    gridpix = npix * GRID_PADDING ** 2
+    planes = 4 * nterms + 2 * (2 * nterms - 1) + 2
+    grids = 2 * (2 * nterms - 1)
+
+    return (4.0 * npix * planes + 8.0 * gridpix * grids +
+            GRIDDER_CFCACHE.get(gridder, 0.0))
+
+
+def _mosaic_ntiles(index, imsize, cell, nterms, budget, margin=1.0,
+                   maxtiles=16):
+
+    """
+    This function returns the smallest number of tiles n along each axis
+    for which one tile of the mosaic_utils.image_mosaic_tiled layout
+    (ntiles=(n,n)) fits in budget bytes, and the imsize of such a tile,
+    or (0, None) if no layout up to maxtiles x maxtiles fits. Each tile
+    covers 1/n of imsize plus margin primary beam FWHMs of overlapping
+    pointings and a further FWHM on each side (see
+    mosaic_utils.mosaic_tiles).
+    """
+
+    from mosaic_utils import _to_rad, primary_beam_fwhm
+
+    cell = _to_rad(cell[0] if isinstance(cell, list) else cell)
+    pad = 2 * (margin + 1) * primary_beam_fwhm(index) / cell
+
+    for ntiles in range(2, maxtiles + 1):
+        tilesize = [fft_size(int(math.ceil(size / float(ntiles) + pad)))
+                    for size in (imsize[0], imsize[-1])]
+        if _mfs_memory(tilesize, nterms, 'mosaic') <= budget:
+            return (ntiles, tilesize)
+
+    return (0, None)
+
+
+def plan_tclean(vis, imagepars, memfraction=0.8, ncores=0):
+
+    """
+    This function estimates the peak memory, the disk space of the
+    products, and the run time of a tclean call before it is run, and
+    recommends a layout that fits the current machine. The tclean
+    parameters are given in imagepars (imsize, specmode, gridder,
+    deconvolver, nterms, nchan, spw, niter, perchanweightdensity,
+    weighting). The number of visibilities and channels are taken from
+    the metadata index of vis (see ms_metadata.py), so the ms is not
+    read.
+
+    The estimates are rough (within a factor of 2 or so) but good enough
+    to tell whether a job will fit in memory. The memory includes the
+    image planes tclean keeps in memory, the padded gridding and FFT
+    planes, the per-channel weight density grids of
+    perchanweightdensity=True, and the convolution function cache of
+    the mosaic and awproject gridders. Cubes use the same memory model
+    (cube_utils.cube_memory) and number of chunks (cube_utils.cube_nchunks)
+    as cube_utils.image_line_cube_chunked. Mosaics that don't fit get the
+    smallest number of tiles for mosaic_utils.image_mosaic_tiled whose
+    tiles fit. The available memory is taken as memfraction of the
+    memory currently free, and ncores (by default all cores of the
+    machine) is used to suggest how many jobs to run at the same time.
+
+    It returns a dictionary with the estimates (memory and disk in
+    bytes, runtime in seconds), the number of jobs that fit at the same
+    time, the suggested number of channel chunks for cubes, and the
+    recommendation as text, which is also printed.
+
+    Example:
+        plan = plan_tclean('calibrated_final.ms.contsub',
+                           {'imsize': [1000,1000], 'specmode': 'cube',
+                            'gridder': 'mosaic', 'nchan': 2000, 'spw': '1',
+                            'niter': 1000, 'perchanweightdensity': True})
+    """
+
+    index = get_ms_index(vis)
+
+    imsize = imagepars.get('imsize', 100)
+    if isinstance(imsize, int):
+        imsize = [imsize, imsize]
+    npix = imsize[0] * imsize[-1]
+    gridpix = npix * GRID_PADDING ** 2
+
+    specmode = imagepars.get('specmode', 'mfs')
+    gridder = imagepars.get('gridder', 'standard')
+    deconvolver = imagepars.get('deconvolver', 'hogbom')
+    nterms = imagepars.get('nterms', 2) if deconvolver == 'mtmfs' else 1
+    niter = imagepars.get('niter', 0)
+
+    spws = _selected_spws(index, imagepars.get('spw', ''))
+    datachans = sum(spw['nchan'] for spw in spws)
+    nchan = imagepars.get('nchan', -1)
+    if specmode == 'mfs':
+        nchan = 1
+    elif nchan <= 0:
+        nchan = max(spw['nchan'] for spw in spws)
+
+    # rows per spw, assuming all spws have the same number of rows, and
+    # two parallel-hand correlations.
+    nrows = index['nrows'] * len(spws) / float(max(len(index['spws']), 1))
+    nvischan = 2 * nrows * datachans / float(max(len(spws), 1))
+
+    # memory: image planes, gridding and FFT planes, weight density grids
+    weightdensity = (imagepars.get('perchanweightdensity', specmode != 'mfs') and
+                     imagepars.get('weighting', 'natural') != 'natural')
+    if specmode == 'mfs':
+        grids = 2 * (2 * nterms - 1)
+        memory = _mfs_memory(imsize, nterms, gridder)
+        if weightdensity:
+            memory += 4.0 * gridpix
+    else:
+        grids = 2
+        memory = cube_memory(imsize, nchan, gridder=gridder,
+                             perchanweightdensity=weightdensity)
+
+    # disk: all products of all planes and terms
+    if specmode == 'mfs':
+        disk = 4.0 * npix * PRODUCT_PLANES * (2 * nterms - 1)
+    else:
+        disk = 4.0 * npix * PRODUCT_PLANES * nchan
+
+    # run time: one major cycle for the psf and residual, and about one
+    # more per factor of 10 in niter; each grids the data twice.
+    nmajor = 1 + (int(math.ceil(math.log10(niter))) + 1 if niter > 0 else 0)
+    support = GRIDDER_SUPPORT.get(gridder, GRIDDER_SUPPORT['standard'])
+    gridtime = 2 * nmajor * nvischan * support * (2 * nterms - 1) / GRID_RATE
+    ffttime = (2 * nmajor * grids * nchan * 5 * gridpix *
+               math.log(gridpix, 2) / FFT_RATE)
+    runtime = gridtime + ffttime
+
+    budget = memfraction * available_memory()
+    ncores = ncores or os.cpu_count() or 1
+    njobs = max(0, min(ncores, int(budget // memory)))
+
+    plan = {'memory': memory,
+            'disk': disk,
+            'runtime': runtime,
+            'available_memory': budget,
+            'ncores': ncores,
+            'njobs': njobs,
+            'nchunks': 1}
+
+    if memory <= budget:
+        recommendation = ("Fits in memory. Up to %d jobs like this can run "
+                          "at the same time." % njobs)
+    elif specmode != 'mfs':
+        # one chunk per core, each within its share of the memory
+        try:
+            plan['nchunks'] = cube_nchunks(imsize, nchan, ncores, memfraction,
+                                           gridder=gridder,
+                                           perchanweightdensity=weightdensity)
+            recommendation = ("Does NOT fit in memory. Image the cube in %d "
+                              "channel chunks (cube_utils.image_line_cube_chunked "
+                              "with nchunks=%d, nprocs=%d) or reduce imsize." %
+                              (plan['nchunks'], plan['nchunks'], ncores))
+        except ValueError:
+            recommendation = ("Does NOT fit in memory, even one channel per "
+                              "core. Use fewer cores or reduce imsize.")
+    elif gridder == 'mosaic':
+        (ntiles, tilesize) = _mosaic_ntiles(index, imsize,
+                                            imagepars.get('cell', '1arcsec'),
+                                            nterms, budget)
+        if ntiles:
+            tilejobs = max(1, min(ncores, ntiles ** 2,
+                                  int(budget // _mfs_memory(tilesize, nterms,
+                                                            'mosaic'))))
+            plan['ntiles'] = (ntiles, ntiles)
+            recommendation = ("Does NOT fit in memory. Image the mosaic in "
+                              "tiles of about %s pixels "
+                              "(mosaic_utils.image_mosaic_tiled with "
+                              "ntiles=(%d,%d), nprocs=%d) or reduce imsize." %
+                              (tilesize, ntiles, ntiles, tilejobs))
+        else:
+            recommendation = ("Does NOT fit in memory, even in tiles. Reduce "
+                              "imsize or nterms, or run on a machine with "
+                              "more memory.")
+    else:
+        recommendation = ("Does NOT fit in memory. Reduce imsize or nterms, "
+                          "or run on a machine with more memory.")
+    plan['recommendation'] = recommendation
+
+    print("tclean plan for " + vis + " (" + specmode + ", " + gridder + ", " +
+          deconvolver + "):")
+    print("  imsize %s, %d image channel(s), %.3g visibility-channels" %
+          (imsize, nchan, nvischan))
+    print("  Peak memory ~%.2f GB (available %.1f GB), products ~%.2f GB on disk" %
+          (memory / 1.0e9, budget / 1.0e9, disk / 1.0e9))
+    print("  Run time ~%.0f min on one core (%d major cycles)" %
+          (runtime / 60.0, nmajor))
+    print("  " + recommendation)
+
+    return plan
@@ -38,22 +38,69 @@
 #>>> imaging procedure. If you already have a split.cal file, you can
 #>>> skip this step.
 
+#>>> The metadata of each ms (spws, fields, antennas, executions,
+#>>> baselines) can be read once and cached in a sidecar file
+#>>> <ms name>.metadata.json by get_ms_index from ms_metadata.py. The
+#>>> file is only rebuilt if the ms changes, so looking at it again
+#>>> does not re-read the ms tables. Use print_ms_index to get a quick
+#>>> summary of the ms instead of a listobs, e.g.,
+#>>>   from ms_metadata import get_ms_index, print_ms_index
+#>>>   print_ms_index(get_ms_index(vislist[0]))
+
+#>>> For projects with many executions, the executions can be split
+#>>> in parallel with one process per execution by setting nprocs
+#>>> greater than 1. Each process writes its own CASA log to
+#>>> split_logs/<ms name>.log. Keep nprocs at or below the number of
+#>>> cores on your machine.
+
+#>>> The split, concat, and cvel2 stages below can be cached with
+#>>> cached_task from stage_cache.py by setting usecache=True: each
+#>>> output is then recorded in a <output>.stage.json file together
+#>>> with the task parameters and a fingerprint of the input ms. If you
+#>>> re-run the script and nothing has changed, the stage is skipped.
+#>>> If the parameters or the input ms have changed, the old output is
+#>>> removed and the stage is re-run, so the rmtables calls before each
+#>>> stage are skipped. Set usecache back to False (the stock CASA
+#>>> tasks) in the script delivered to the PI.
+
+#>>> The optional modes (nprocs > 1, usecache=True, and
+#>>> virtualfinal=True) need the helper modules (ms_metadata.py,
+#>>> prep_utils.py, parallel_utils.py, and stage_cache.py) from the
+#>>> imaging script repository in your working directory or on your
+#>>> PYTHONPATH. With the defaults, the script only uses CASA tasks.
+
 import glob
 
-vislist = glob.glob('*[!_t].ms')  # match full ms, not target.ms
+usecache = False # set to True to skip stages whose outputs are up to date.
 
-for myvis in vislist:
+if usecache:
+    from stage_cache import cached_task
+    split = cached_task('split', usecache)
+    concat = cached_task('concat', usecache)
+    cvel2 = cached_task('cvel2', usecache)
+
+vislist = glob.glob('*[!_t].ms')  # match full ms, not target.ms
 
-    msmd.open(myvis)
-    targetspws = msmd.spwsforintent('OBSERVE_TARGET*')  
-    sciencespws = []                                      
-    for myspw in targetspws:                               
-        if msmd.nchan(myspw)>4:
-            sciencespws.append(myspw)
-    sciencespws = ','.join(map(str,sciencespws))
-    msmd.close()
+nprocs = 1 # number of executions to split at the same time.
+
+if nprocs > 1:
+    from prep_utils import split_executions
+    splitspws = split_executions(vislist, nprocs=nprocs, logdir='split_logs',
+                                 usecache=usecache)
+    sciencespws = splitspws[vislist[-1]]
+else:
+    for myvis in vislist:
+
+        msmd.open(myvis)
+        targetspws = msmd.spwsforintent('OBSERVE_TARGET*')  
+        sciencespws = []                                      
+        for myspw in targetspws:                               
+            if msmd.nchan(myspw)>4:
+                sciencespws.append(myspw)
+        sciencespws = ','.join(map(str,sciencespws))
+        msmd.close()
     
-    split(vis=myvis,outputvis=myvis+'.split.cal',spw=sciencespws)
+        split(vis=myvis,outputvis=myvis+'.split.cal',spw=sciencespws)
 
 
 ########################################
@@ -137,13 +184,34 @@ es.generateReducScript(['uid_FIRST-EB.ms.split.cal','uid_SECOND-EB.ms.split.cal'
 # multiple spws associated with a single rest frequency will not be
 # regridded to a single spectral window in the ms.
 
-concatvis='calibrated.ms'
-
-rmtables(concatvis)
-os.system('rm -rf ' + concatvis + '.flagversions')
-concat(vis=vislist,
-       #forcesingleephemfield='Uranus', # uncomment this line and insert source name if imaging an ephemeris object
-       concatvis=concatvis)
+#>>> For large projects, the concat, the split of the science targets,
+#>>> and the rename below can be replaced by a single step by setting
+#>>> virtualfinal=True. The target data of each execution are then
+#>>> split into a separate ms (in parallel if nprocs > 1) and these
+#>>> are moved, not copied, into calibrated_final.ms, which becomes a
+#>>> multi-ms: a reference ms with one sub-ms per execution in
+#>>> calibrated_final.ms/SUBMSS. The data are written to disk once
+#>>> instead of three times, and CASA tasks use the multi-ms like any
+#>>> other ms. If virtualfinal=True, skip the "Splitting off science
+#>>> target data" and "Rename and backup data set" steps below (other
+#>>> than the backup).
+
+virtualfinal = False # set to True to build calibrated_final.ms as a multi-ms.
+
+if virtualfinal:
+    from prep_utils import make_virtual_final_ms
+    make_virtual_final_ms(vislist, outputvis='calibrated_final.ms',
+                          #forcesingleephemfield='Uranus', # uncomment this line and insert source name if imaging an ephemeris object
+                          nprocs=nprocs, usecache=usecache)
+else:
+    concatvis='calibrated.ms'
+
+    if not usecache:
+        rmtables(concatvis)
+        os.system('rm -rf ' + concatvis + '.flagversions')
+    concat(vis=vislist,
+           #forcesingleephemfield='Uranus', # uncomment this line and insert source name if imaging an ephemeris object
+           concatvis=concatvis)
 
 
 ###################################
@@ -159,12 +227,14 @@ concat(vis=vislist,
 #>>> scriptForFluxCalibration.py, need to get datacolumn='corrected'
 
 sourcevis='calibrated_source.ms'
-rmtables(sourcevis)
-os.system('rm -rf ' + sourcevis + '.flagversions')
-split(vis=concatvis,
-      intent='*TARGET*', # split off the target sources
-      outputvis=sourcevis,
-      datacolumn='data')
+if not virtualfinal:
+    if not usecache:
+        rmtables(sourcevis)
+        os.system('rm -rf ' + sourcevis + '.flagversions')
+    split(vis=concatvis,
+          intent='*TARGET*', # split off the target sources
+          outputvis=sourcevis,
+          datacolumn='data')
 
 ###############################################################
 # Regridding spectral windows [OPTIONAL]
@@ -179,6 +249,9 @@ split(vis=concatvis,
 #>>> parameters later when you clean to avoid clean regridding the image
 #>>> a second time.
 
+#>>> If you set virtualfinal=True above, regrid calibrated_final.ms
+#>>> instead (sourcevis='calibrated_final.ms').
+
 sourcevis='calibrated_source.ms'
 regridvis='calibrated_source_regrid.ms'
 veltype = 'radio' # Keep set to radio. See notes in imaging section.
@@ -191,8 +264,9 @@ restfreq='115.27120GHz' # rest frequency of primary line of interest.
 field = '4' # select science fields.
 spw = '0,5,10' # spws associated with a single rest frequency. Do not attempt to combine spectral windows associated with different rest frequencies. This will take a long time to regrid and most likely isn't what you want.
 
-rmtables(regridvis)
-os.system('rm -rf ' + regridvis + '.flagversions')
+if not usecache:
+    rmtables(regridvis)
+    os.system('rm -rf ' + regridvis + '.flagversions')
     
 cvel2(vis=sourcevis,
       field=field,
@@ -209,6 +283,25 @@ cvel2(vis=sourcevis,
 #>>> If you have multiple sets of spws that you wish you combine, just
 #>>> repeat the above process with spw set to the other values.
 
+#>>> Alternatively, regrid all the sets of spws at once (instead of
+#>>> the cvel2 call above). The spws are grouped by spectral setup
+#>>> (one group per rest frequency) using the metadata of sourcevis;
+#>>> print regrid_spw_groups(sourcevis) to check the groups and give
+#>>> the rest frequency of each group in restfreqs, in the same order.
+#>>> One cvel2 job is run per group (and per field if fields is given)
+#>>> using nprocs processes, with the logs in regrid_logs/, and the
+#>>> results are combined into regridvis.
+
+# from prep_utils import regrid_line_groups, regrid_spw_groups
+# print(regrid_spw_groups(sourcevis))
+# regrid_line_groups(sourcevis, regridvis,
+#                    ['115.27120GHz','110.20135GHz'], # rest frequency of each group
+#                    #spwgroups=['0,5,10','2,7,12'], # uncomment to override the groups
+#                    fields=[field], # or [] to regrid all fields together
+#                    nprocs=nprocs, usecache=usecache,
+#                    mode=mode, nchan=nchan, width=width, start=start,
+#                    outframe=outframe, veltype=veltype)
+
 ############################################
 # Rename and backup data set
 
@@ -231,3 +324,8 @@ cvel2(vis=sourcevis,
 # Output a listobs file
 
 listobs(vis='calibrated_final.ms',listfile='calibrated_final.ms.listobs.txt') 
+
+#>>> To cache the metadata of the final ms for the imaging (see the
+#>>> metadata section of the imaging script), run
+#>>>   from ms_metadata import get_ms_index, print_ms_index
+#>>>   print_ms_index(get_ms_index('calibrated_final.ms'))
@@ -51,6 +51,68 @@ if casalith.compare_version("<",[6,2,1,7]):
     print("Please use CASA version greater than or equal to 6.2.1.7 with this script")
 
 
+########################################
+# Measurement set metadata
+
+#>>> The metadata of calibrated_final.ms (spws, channel widths, fields,
+#>>> antennas, executions, and baseline lengths) can be cached in the
+#>>> sidecar file calibrated_final.ms.metadata.json with get_ms_index
+#>>> from ms_metadata.py. The file is only rebuilt if the ms changes.
+#>>> Use it instead of re-running listobs, plotants, or
+#>>> au.commonAntennas while you work out the parameters below. This
+#>>> needs the helper modules from the imaging script repository
+#>>> (ms_metadata.py, etc.) in your working directory or on your
+#>>> PYTHONPATH, which PIs won't have, so only run it by hand:
+#>>>
+#>>>   from ms_metadata import get_ms_index, print_ms_index
+#>>>   finalindex = get_ms_index('calibrated_final.ms')
+#>>>   print_ms_index(finalindex)
+
+#>>> The split, uvcontsub, and tclean stages below can be cached with
+#>>> cached_task from stage_cache.py by setting usecache=True: each
+#>>> output is then recorded in a <output>.stage.json file together
+#>>> with the task parameters and a fingerprint of the input ms. If you
+#>>> re-run the script and nothing has changed for a stage, it is
+#>>> skipped. If the parameters or the input ms have changed, the old
+#>>> output (images, ms, and flagversions) is removed and the stage is
+#>>> re-run, so the rmtables calls before each stage are skipped. Note
+#>>> that any task that writes to the input ms (flagdata, applycal,
+#>>> etc.) will cause the stages that read it to re-run. This needs the
+#>>> helper modules, so set usecache back to False (the stock CASA
+#>>> tasks) in the script delivered to the PI.
+
+#>>> With usecache=True and reclean=True, a tclean that is re-run with
+#>>> only its deconvolution parameters changed (niter, threshold, mask,
+#>>> automask parameters, etc.) on the same ms with the same imaging
+#>>> parameters (imsize, cell, weighting, gridder, ...) continues from
+#>>> the existing .psf, .residual, and .model (calcpsf=False,
+#>>> calcres=False) instead of starting from scratch. This is what you
+#>>> want when adding more iterations or cleaning deeper with a saved
+#>>> mask. To start a clean over from scratch, remove its images first.
+
+usecache = False # set to True to skip stages whose outputs are up to date.
+reclean = True # continue cleans whose imaging parameters are unchanged.
+
+if usecache:
+    from stage_cache import cached_task
+    split = cached_task('split', usecache)
+    uvcontsub = cached_task('uvcontsub', usecache)
+    tclean = cached_task('tclean', usecache, reclean=reclean)
+
+#>>> While imaging, you can save flag versions as compressed
+#>>> differences from the first saved version in <vis>.flagsnapshots
+#>>> instead of full copies of the flags in <vis>.flagversions, with
+#>>> the same parameters as flagmanager (mode='list' shows the size of
+#>>> each version):
+#>>>
+#>>> from flag_snapshots import snapshot_flagmanager
+#>>> snapshot_flagmanager(vis=finalvis,mode='save',versionname='before_cont_flags')
+#>>>
+#>>> Snapshots can only be restored with snapshot_flagmanager, not with
+#>>> the CASA flagmanager, so the script delivered to the PI uses
+#>>> flagmanager.
+
+
 ##################################################
 # Create an Averaged Continuum MS
 
@@ -105,6 +167,22 @@ plotms(vis=finalvis, xaxis='channel', yaxis='amplitude',
 #>>> different for different sources. Thus you would need to repeat the
 #>>> process below for each source.
 
+#>>> Instead of paging through the plotms output, you can find the line
+#>>> channels automatically with find_line_free_channels from
+#>>> continuum_utils.py. It reads the time- and baseline-averaged
+#>>> spectra of all spws in one pass over the data (restricted to
+#>>> baselines shorter than maxuv meters, if set) and finds the line
+#>>> channels by robust sigma clipping around a fitted continuum. It
+#>>> prints the flagchannels string for the continuum averaging below and
+#>>> the matching fitspw string for the continuum subtraction. Check the
+#>>> result against the plotms output and cut and paste the strings into
+#>>> flagchannels and fitspw below since PIs won't have the helper
+#>>> modules. Use the field parameter (e.g., field='3') to find the
+#>>> channels for one source at a time. Run it by hand with
+#>>>
+#>>>   from continuum_utils import find_line_free_channels
+#>>>   find_line_free_channels(finalvis, maxuv=100.0, nsigma=4.0)
+
 
 # Set spws to be used to form continuum
 contspws = '0,1,2,3'
@@ -114,7 +192,17 @@ contspws = '0,1,2,3'
 flagmanager(vis=finalvis,mode='save',
             versionname='before_cont_flags')
 
-initweights(vis=finalvis,wtmode='weight',dowtsp=True)
+#>>> With usecache=True, initweights is only run if finalvis doesn't
+#>>> have channelized weights yet. Rewriting the weights of finalvis on
+#>>> every run would make the split below out of date every time.
+
+hasweightspectrum = False
+if usecache:
+    tb.open(finalvis)
+    hasweightspectrum = 'WEIGHT_SPECTRUM' in tb.colnames()
+    tb.close()
+if not hasweightspectrum:
+    initweights(vis=finalvis,wtmode='weight',dowtsp=True)
 
 # Flag the "line channels"
 flagchannels='2:1201~2199,3:1201~2199' # In this example , spws 2&3 have a line between channels 1201 and 2199 and spectral windows 0 and 1 are line-free.
@@ -130,8 +218,9 @@ plotms(vis=finalvis,yaxis='amp',xaxis='channel',
 
 # Average the channels within spws
 contvis='calibrated_final_cont.ms'
-rmtables(contvis)
-os.system('rm -rf ' + contvis + '.flagversions')
+if not usecache:
+    rmtables(contvis)
+    os.system('rm -rf ' + contvis + '.flagversions')
 
 #>>> Note that to mitigate bandwidth smearing, please keep the width
 #>>> of averaged channels less than 125MHz in Band 3, 4, and 6, and 250MHz
@@ -143,12 +232,46 @@ os.system('rm -rf ' + contvis + '.flagversions')
 #>>> 95%. See the "for continuum" header for more information on the imaging
 #>>> wiki for more infomration.
 
+#>>> The function continuum_widths from continuum_utils.py computes the
+#>>> largest width for each spw that obeys these limits, given the
+#>>> channel width and band of each spw, and prints the width
+#>>> parameter. Flagged line channels don't limit the width, since
+#>>> split with channelized weights leaves them out of each average.
+#>>> Averaging as much as allowed keeps the continuum ms small, which
+#>>> directly sets the cost of every continuum and self-calibration
+#>>> clean. Run it by hand and paste the printed widths into the split
+#>>> below for the PI:
+#>>>
+#>>>   from continuum_utils import continuum_widths
+#>>>   continuum_widths(finalvis, contspws)
+
+#>>> For compact configurations and ACA data, the continuum ms can also
+#>>> be averaged in time. The function continuum_timebin computes the
+#>>> longest averaging time (a multiple of the integration time) that
+#>>> keeps the time smearing loss of peak flux below maxloss at the edge
+#>>> of the primary beam (or at fovradius arcsec for mosaics), using the
+#>>> longest baseline and highest frequency. It prints the expected
+#>>> reduction in data volume and the peak flux loss. The averaging
+#>>> time is capped at maxtimebin (30s by default) so that you can
+#>>> still self-calibrate on short solution intervals. This makes each
+#>>> round of self-calibration considerably faster. Note that
+#>>> solint='int' in the self-calibration then refers to the averaged
+#>>> integrations.
+
+averagetime = False # set to True to also average the continuum in time.
+
+conttimebin = '0s'
+if averagetime:
+    from continuum_utils import continuum_timebin
+    conttimebin = continuum_timebin(finalvis, contspws, maxloss=0.05)
+
 #>>> Note that in CASA 5.1, split2 is now split. Previously split2 was
 #>>> needed to deal correctly with channelized weights.
 split(vis=finalvis,
      spw=contspws,      
      outputvis=contvis,
       width=[256,8,8,8], # number of channels to average together. The final channel width should be less than 125MHz in Bands 3, 4, and 6 and 250MHz in Band 7.
+      timebin=conttimebin, # averaging time, '0s' for no time averaging.
      datacolumn='data')
 
 
@@ -192,7 +315,9 @@ field='0' # science field(s). For a mosaic, select all mosaic fields. DO NOT LEA
 #>>> part of the beam. You can estimate the beam size using the following
 #>>> equation: 206265.0/(longest baseline in wavelengths).  To determine
 #>>> the longest baseline, use plotms with xaxis='uvwave' and
-#>>> yaxis='amp'. Divide the estimated beam size by five to eight to get
+#>>> yaxis='amp'. The longest (unprojected) baseline in meters is also
+#>>> stored in finalindex['max_baseline'] (see the metadata section at
+#>>> the top). Divide the estimated beam size by five to eight to get
 #>>> your cell size. It's better to error on the side of slightly too
 #>>> many cells per beam than too few. Once you have made an image,
 #>>> please re-assess the cell size based on the beam of the image. You can
@@ -225,6 +350,19 @@ field='0' # science field(s). For a mosaic, select all mosaic fields. DO NOT LEA
 #>>> into account the projection of the baselines, so the plotms
 #>>> method is more accurate.
 
+#>>> The cell and imsize can also be computed directly from the data
+#>>> with pick_cell_imsize from imaging_params.py. It reads the UVW
+#>>> column to find the longest projected baseline of the selected
+#>>> spws and fields, uses cellsperbeam pixels across the resulting
+#>>> beam, and sizes the image from the primary beam (and the extent of
+#>>> the pointings for a mosaic). The imsize is rounded up to a size
+#>>> with only factors of 2, 3, and 5, which is much faster to grid and
+#>>> FFT than an arbitrary size. If you pick the imsize by hand, round
+#>>> it with fft_size(imsize). Note the values for the PI.
+
+# from imaging_params import fft_size, pick_cell_imsize
+# (cell, imsize) = pick_cell_imsize(finalvis, field=field, cellsperbeam=5)
+
 cell='1arcsec' # cell size for imaging.
 imsize = [128,128] # size of image in pixels.
 
@@ -251,6 +389,24 @@ robust=0.5
 niter=1000
 threshold = '0.0mJy'
 
+#>>> To clean without interaction, set autoclean=True. Every tclean
+#>>> below (continuum, self-calibration, and line) then runs with
+#>>> interactive=False and auto-multithresh masking, using presets for
+#>>> the array (7m or 12m) and baseline lengths with an adjustment for
+#>>> Bands 8-10 (see auto_clean.py). The threshold is set to nsigma
+#>>> times the noise of a quick dirty image (imagename_dirty; only the
+#>>> first few channels for cubes), and niter is raised so that the
+#>>> threshold stops clean. The threshold, number of iterations, and
+#>>> final RMS of each image are written to imagename.clean.json and
+#>>> clean_summary.txt, so you don't need to note them for the PI.
+
+autoclean = False # set to True to clean non-interactively.
+nsigma = 4.0 # clean threshold in units of the noise when autoclean=True
+
+if autoclean:
+    from auto_clean import autoclean_task
+    tclean = autoclean_task(nsigma=nsigma, usecache=usecache, reclean=reclean)
+
 #>>> Guidelines for setting robust:
 
 #>>> Robust < 0.0 is not recommended for mosaics with poor-uv
@@ -262,6 +418,19 @@ threshold = '0.0mJy'
 #>>> weighting) to avoid upweighting points that are going to be
 #>>> downweighted by uv-taper.
 
+#>>> Before each tclean, you can check whether it will fit in memory on
+#>>> this machine, how much disk space the products need, and roughly
+#>>> how long it will take with plan_tclean from resource_planner.py.
+#>>> It uses the metadata index, so it doesn't read the data. If the job
+#>>> doesn't fit, it recommends imaging a cube in channel chunks
+#>>> (cube_utils.py) or a mosaic in tiles (mosaic_utils.py), and it
+#>>> reports how many jobs like it can run at the same time.
+
+# from resource_planner import plan_tclean
+# plan_tclean(finalvis, {'imsize': imsize, 'gridder': gridder,
+#                        'specmode': 'cube', 'spw': spw, 'nchan': nchan,
+#                        'weighting': 'briggsbwtaper', 'niter': niter})
+
 #############################################
 # Imaging the Continuuum
 
@@ -291,12 +460,15 @@ contimagename = ''
 #clearcal(vis=contvis)
 #delmod(vis=contvis)
 
-for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
-    rmtables(contimagename+ext)
+if not usecache:
+    for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
+        rmtables(contimagename+ext)
 
 #>>> If you're going be be imaging with nterms>1, then you also need
 #>>> to removed the *.tt0, and *.tt1 images in additional to those
-#>>> listed above.
+#>>> listed above. With usecache=True, older images with the same name
+#>>> (including the *.tt0 and *.tt1 images) are removed automatically
+#>>> before tclean re-images.
 
 #>>> If the fractional bandwidth for the aggregate continuum is
 #>>> greater than 10%, set deconvolver='mtmfs' to use multi-term,
@@ -337,10 +509,35 @@ tclean(vis=contvis,
 
 # If you'd like to redo your clean, but don't want to make a new mask
 # use the following commands to save your original mask. This is an optional step.
+# With usecache=True and reclean=True, re-running the tclean above
+# with mask=contmaskname or a larger niter continues from the existing
+# psf and residual.
 #contmaskname = 'cont.mask'
 ##rmtables(contmaskname) # if you want to delete the old mask
 #os.system('cp -ir ' + contimagename + '.mask ' + contmaskname)
 
+#>>> Large mosaics can be imaged in overlapping spatial tiles instead,
+#>>> one process per tile, with image_mosaic_tiled from
+#>>> mosaic_utils.py. The mosaic fields are split into ntiles tiles,
+#>>> each tile is imaged with gridder='mosaic' using the pointings in
+#>>> and around it, and the tiles are combined by primary-beam-weighted
+#>>> linear mosaicking into contimagename.image, .pb, and .image.pbcor
+#>>> on the imsize/cell/phasecenter grid given below. The tiles are
+#>>> restored with a common beam before they are combined. The result
+#>>> differs from a single tclean near the tile edges, by an amount that
+#>>> depends on the data: compare the two with compare_images (e.g., on
+#>>> a cut-down imsize) before relying on it. Do not use interactive
+#>>> cleaning.
+
+# from mosaic_utils import image_mosaic_tiled
+# image_mosaic_tiled(contvis, contimagename,
+#                    {'field': field, 'phasecenter': phasecenter,
+#                     'imsize': imsize, 'cell': cell,
+#                     'weighting': weighting, 'robust': robust,
+#                     'niter': niter, 'threshold': threshold,
+#                     'mosweight': True, 'interactive': False},
+#                    ntiles=(2,2), nprocs=4)
+
 ##############################################
 # Self-calibration on the continuum [OPTIONAL]
 
@@ -367,8 +564,8 @@ refant = 'DV09' # reference antenna.
 #>>> Choose a reference antenna that's in the array. The tasks plotants
 #>>> and listobs/vishead can tell you what antennas are in the array. For
 #>>> data sets with multiple executions, you will want to choose an antenna
-#>>> that's present in all the executions. The task au.commonAntennas()
-#>>> can help with this.
+#>>> that's present in all the executions. The antennas present in
+#>>> all executions are listed in finalindex['common_antennas'].
 
 #>>> Indicate the spectral window mapping below. The spwmap map
 #>>> variable is a list that consists of n entries where n is the
@@ -385,6 +582,18 @@ refant = 'DV09' # reference antenna.
 
 spwmap = [0,0,0,0] # mapping self-calibration solutions to individual spectral windows.
 
+#>>> To check the map, compare it with the one built from the
+#>>> executions and spws of contvis, which is stored in its metadata
+#>>> index (see ms_metadata.py). check_spwmap stops with an error if a
+#>>> spw would be mapped to a spw of another execution. (run_selfcal,
+#>>> below, does this check itself before the first gaincal, and checks
+#>>> the map against the calibration tables before every applycal.)
+#>>>
+#>>> from ms_metadata import get_ms_index
+#>>> print('spwmap = ' + str(get_ms_index(contvis)['spwmap']))
+#>>> from selfcal import check_spwmap
+#>>> check_spwmap(contvis, spwmap)
+
 # save initial flags in case you don't like the final
 # self-calibration. The task applycal will flag data that doesn't have
 # solutions.
@@ -404,8 +613,9 @@ delmod(vis=contvis,otf=True,scr=True)
 
 # shallow clean on the continuum
 
-for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
-    rmtables(contimagename + '_p0'+ ext)
+if not usecache:
+    for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
+        rmtables(contimagename + '_p0'+ ext)
 
 tclean(vis=contvis,
        imagename=contimagename + '_p0',
@@ -437,278 +647,184 @@ tclean(vis=contvis,
 #>>> if you don't see this in the CASA logger, you should call TCLEAN again 
 #>>> with niter=0, calcpsf=False, calcres=False to populate the modelcolumn
 
-# per scan solution
-rmtables('pcal1')
-gaincal(vis=contvis,
-        caltable='pcal1',
-        field=field,
-        gaintype='T',
-        refant=refant, 
-        calmode='p',
-        combine='spw', 
-        solint='inf',
-        minsnr=3.0,
-        minblperant=6)
-
-#>>> If many of the above many solutions are flagged, consider setting
+#>>> The self-calibration rounds are listed in selfcalrounds and run
+#>>> one after another by the loop below. Each round solves for the
+#>>> gains with gaincal (gaintype='T', combine='spw'), plots the
+#>>> solutions and waits for you to check them, applies them with
+#>>> applycal, saves the flags as 'after_<table>', and cleans deeper
+#>>> with savemodel='modelcolumn'. Phase-only rounds write the tables
+#>>> pcal1, pcal2, ... and the images _p1, _p2, .... The amplitude round
+#>>> writes apcal and _ap and is solved and applied on top of the last
+#>>> phase-only table with solnorm=True. If a round doesn't improve the
+#>>> image, remove it (and the rounds after it) from selfcalrounds,
+#>>> restore the flags from the previous round, and re-run the loop.
+#>>>
+#>>> If many solutions of a round are flagged, consider setting
 #>>> minsnr=1.5 and comparing the solutions. For low (<~500) dynamic
 #>>> range cases, including a bit more random noise in the solution
 #>>> has only a small effect on the image.
-
-# Check the solution
-plotms(vis='pcal1',
-       xaxis='time',
-       yaxis='phase',
-       iteraxis='antenna',
-       plotrange=[0,0,-180,180])
-
-# apply the calibration to the data for next round of imaging
-applycal(vis=contvis,
-         field=field,
-         spwmap=spwmap, 
-         gaintable=['pcal1'],
-         gainfield='',
-         calwt=False, 
-         flagbackup=False,
-         interp='linearperobs')
-
-# Save the flags in case you need to go back to this step. 
-flagmanager(vis=contvis,mode='save',versionname='after_pcal1')
-
-# clean deeper
-for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
-    rmtables(contimagename + '_p1'+ ext)
-
-tclean(vis=contvis,
-       imagename=contimagename + '_p1',
-       field=field,
-       # phasecenter=phasecenter, # uncomment if mosaic or imaging an ephemeris object
-       # mosweight = True, # uncomment if mosaic
-       specmode='mfs',
-       deconvolver='hogbom',
-       # Uncomment the below to image with nterms>1.
-       #deconvolver='mtmfs',
-       #nterms=2,
-       imsize = imsize, 
-       cell= cell, 
-       weighting = weighting, 
-       robust=robust,
-       niter=niter, 
-       threshold=threshold, 
-       interactive=True,
-       gridder=gridder,
-       #pbcor = True, #if final image
-       savemodel='modelcolumn',
-       usepointing=False)
-
-#>>> Note number of iterations performed.
-
-
-#>>> Note: before proceeding, you should verify that TCLEAN saved the MODEL 
-#>>> column. If it did, you will see a message like
-#>>> INFO .... ------ Predict Model ------
-#>>> INFO ... Saving model column
-#>>> if you don't see this in the CASA logger, you should call TCLEAN again 
-#>>> with niter=0, calcpsf=False, calcres=False to populate the modelcolumn
-
-# shorter solution
-rmtables('pcal2')
-gaincal(vis=contvis,
-        field=field,
-        caltable='pcal2',
-        gaintype='T',
-        refant=refant, 
-        calmode='p',
-        combine='spw', 
-        solint='30.25s', # solint=30.25s gets you five 12m integrations, while solint=50.5s gets you five 7m integration
-        minsnr=3.0,
-        minblperant=6)
-
-# Check the solution
-plotms(vis='pcal2',
-       xaxis='time',
-       yaxis='phase',
-       iteraxis='antenna',
-       plotrange=[0,0,-180,180])
-
-# apply the calibration to the data for next round of imaging
-applycal(vis=contvis,
-         spwmap=spwmap, 
-         field=field,
-         gaintable=['pcal2'],
-         gainfield='',
-         calwt=False, 
-         flagbackup=False,
-         interp='linearperobs')
-
-# Save the flags in case you need to go back to this step. 
-flagmanager(vis=contvis,mode='save',versionname='after_pcal2')
-
-# clean deeper
-for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
-    rmtables(contimagename + '_p2'+ ext)
-
-tclean(vis=contvis,
-       imagename=contimagename + '_p2',
-       field=field,
-       # phasecenter=phasecenter, # uncomment if mosaic or imaging an ephemeris object
-       # mosweight = True, # uncomment if mosaic
-       specmode='mfs',
-       deconvolver='hogbom',
-       # Uncomment the below to image with nterms>1.
-       #deconvolver='mtmfs',
-       #nterms=2,
-       imsize = imsize, 
-       cell= cell, 
-       weighting = weighting, 
-       robust=robust,
-       niter=niter, 
-       threshold=threshold, 
-       interactive=True,
-       gridder=gridder,
-       #pbcor = True, #if final image
-       savemodel='modelcolumn',
-       usepointing=False)
-
-#>>> Note number of iterations performed.
-
-#>>> Note: before proceeding, you should verify that TCLEAN saved the MODEL 
-#>>> column. If it did, you will see a message like
-#>>> INFO .... ------ Predict Model ------
-#>>> INFO ... Saving model column
-#>>> if you don't see this in the CASA logger, you should call TCLEAN again 
-#>>> with niter=0, calcpsf=False, calcres=False to populate the modelcolumn
-
-# shorter solution
-rmtables('pcal3')
-gaincal(vis=contvis,
-        field=field,
-        caltable='pcal3',
-        gaintype='T',
-        refant=refant, 
-        calmode='p',
-        combine='spw', 
-        solint='int',
-        minsnr=3.0,
-        minblperant=6)
-
-# Check the solution
-plotms(vis='pcal3',
-       xaxis='time',
-       yaxis='phase',
-       iteraxis='antenna',
-       plotrange=[0,0,-180,180])
-
-# apply the calibration to the data for next round of imaging
-applycal(vis=contvis,
-         spwmap=spwmap,
-         field=field,
-         gaintable=['pcal3'],
-         gainfield='',
-         calwt=False, 
-         flagbackup=False,
-         interp='linearperobs')
-
-# Save the flags in case you need to go back to this step. 
-flagmanager(vis=contvis,mode='save',versionname='after_pcal3')
-
-# do the amplitude self-calibration.
-for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
-    rmtables(contimagename + '_p3'+ ext)
-
-tclean(vis=contvis,
-       imagename=contimagename + '_p3',
-       field=field,
-       # phasecenter=phasecenter, # uncomment if mosaic or imaging an ephemeris object
-       # mosweight = True, # uncomment if mosaic
-       specmode='mfs',
-       deconvolver='hogbom',
-       # Uncomment the below to image with nterms>1.
-       #deconvolver='mtmfs',
-       #nterms=2,
-       imsize = imsize, 
-       cell= cell, 
-       weighting = weighting, 
-       robust=robust,
-       niter=niter, 
-       threshold=threshold, 
-       interactive=True,
-       gridder=gridder,
-       #pbcor = True, #if final image
-       savemodel='modelcolumn',
-       usepointing=False)
-
-
-#>>> Note number of iterations performed.
-
-#>>> Note: before proceeding, you should verify that TCLEAN saved the MODEL 
-#>>> column. If it did, you will see a message like
-#>>> INFO .... ------ Predict Model ------
-#>>> INFO ... Saving model column
-#>>> if you don't see this in the CASA logger, you should call TCLEAN again 
-#>>> with niter=0, calcpsf=False, calcres=False to populate the modelcolumn
-
-
-rmtables('apcal')
-gaincal(vis=contvis,
-        field=field,
-        caltable='apcal',
-        gaintype='T',
-        refant=refant,
-        calmode='ap',
-        combine='spw',
-        solint='inf',
-        minsnr=3.0,
-        minblperant=6,
-#        uvrange='>50m', # may need to use to exclude extended emission
-        gaintable='pcal3',
-        spwmap=spwmap,
-        solnorm=True)
-
-plotms(vis='apcal',
-       xaxis='time',
-       yaxis='amp',
-       iteraxis='antenna',
-       plotrange=[0,0,0.2,1.8])
-
-applycal(vis=contvis,
-         spwmap=[spwmap,spwmap], # select which spws to apply the solutions for each table
-         field=field,
-         gaintable=['pcal3','apcal'],
-         gainfield='',
-         calwt=False,
-         flagbackup=False,
-         interp=['linearperobs','linearperobs'])
-
-# Save the flags in case you need to go back to this step. 
-flagmanager(vis=contvis,mode='save',versionname='after_apcal')
-
-# Make amplitude and phase self-calibrated image.
-for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
-    rmtables(contimagename + '_ap'+ ext)
-
-
-tclean(vis=contvis,
-       imagename=contimagename + '_ap',
-       field=field,
-       # phasecenter=phasecenter, # uncomment if mosaic or imaging an ephemeris object
-       # mosweight = True, # uncomment if mosaic
-       specmode='mfs',
-       deconvolver='hogbom',
-       # Uncomment the below to image with nterms>1.
-       #deconvolver='mtmfs',
-       #nterms=2,
-       imsize = imsize, 
-       cell= cell, 
-       weighting = weighting, 
-       robust=robust,
-       niter=niter, 
-       threshold=threshold, 
-       interactive=True,
-       gridder=gridder,
-       savemodel='modelcolumn',
-       pbcor=True,
-       usepointing=False) # apply the primary beam correction since this is the last image.
+#>>>
+#>>> Before each clean of the loop, verify that TCLEAN saved the MODEL
+#>>> column of the previous round as described above.
+
+# Self-calibration rounds: (solint, calmode). solint=30.25s gets you
+# five 12m integrations, while solint=50.5s gets you five 7m
+# integrations.
+selfcalrounds = [('inf','p'),
+                 ('30.25s','p'),
+                 ('int','p'),
+                 ('inf','ap')]
+
+phasetable = ''
+nphase = 0
+for (iround, (solint, calmode)) in enumerate(selfcalrounds):
+    if calmode == 'ap':
+        # solve and apply on top of the last phase-only solutions
+        caltable = 'apcal'
+        suffix = '_ap'
+        gaintables = [phasetable, caltable]
+        calpars = {'gaintable': phasetable, 'spwmap': spwmap, 'solnorm': True}
+        # calpars['uvrange'] = '>50m' # may need to use to exclude extended emission
+    else:
+        nphase += 1
+        caltable = 'pcal%d' % nphase
+        suffix = '_p%d' % nphase
+        gaintables = [caltable]
+        calpars = {}
+
+    rmtables(caltable)
+    gaincal(vis=contvis,
+            caltable=caltable,
+            field=field,
+            gaintype='T',
+            refant=refant, 
+            calmode=calmode,
+            combine='spw', 
+            solint=solint,
+            minsnr=3.0,
+            minblperant=6,
+            **calpars)
+
+    # Check the solution before it is applied
+    if calmode == 'ap':
+        plotms(vis=caltable,
+               xaxis='time',
+               yaxis='amp',
+               iteraxis='antenna',
+               plotrange=[0,0,0.2,1.8])
+    else:
+        plotms(vis=caltable,
+               xaxis='time',
+               yaxis='phase',
+               iteraxis='antenna',
+               plotrange=[0,0,-180,180])
+    input("Check the solutions in " + caltable + " and push enter to continue")
+
+    # apply the calibration to the data for next round of imaging
+    applycal(vis=contvis,
+             field=field,
+             spwmap=[spwmap]*len(gaintables), # select which spws to apply the solutions for each table
+             gaintable=gaintables,
+             gainfield='',
+             calwt=False, 
+             flagbackup=False,
+             interp=['linearperobs']*len(gaintables))
+
+    # Save the flags in case you need to go back to this step. 
+    flagmanager(vis=contvis,mode='save',versionname='after_'+caltable)
+
+    if calmode == 'p':
+        phasetable = caltable
+
+    # clean deeper
+    if not usecache:
+        for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
+            rmtables(contimagename + suffix + ext)
+
+    tclean(vis=contvis,
+           imagename=contimagename + suffix,
+           field=field,
+           # phasecenter=phasecenter, # uncomment if mosaic or imaging an ephemeris object
+           # mosweight = True, # uncomment if mosaic
+           specmode='mfs',
+           deconvolver='hogbom',
+           # Uncomment the below to image with nterms>1.
+           #deconvolver='mtmfs',
+           #nterms=2,
+           imsize = imsize, 
+           cell= cell, 
+           weighting = weighting, 
+           robust=robust,
+           niter=niter, 
+           threshold=threshold, 
+           interactive=True,
+           gridder=gridder,
+           savemodel='modelcolumn',
+           pbcor=(iround == len(selfcalrounds) - 1), # only the final image
+           usepointing=False)
+
+#>>> Note number of iterations performed and the RMS of each round.
+
+# calibration tables to apply to the line data
+selfcaltables = gaintables
+
+#>>> Instead of the commands above (from saving the 'before_selfcal'
+#>>> flags to the end of the loop), the rounds can be run by
+#>>> run_selfcal from selfcal.py. This needs the helper modules, so
+#>>> don't leave it in the script delivered to the PI. After each
+#>>> round, the RMS and peak SNR of the new image are compared to the
+#>>> previous image. If neither improves by more than minimprovement
+#>>> (a fraction), the round is undone and no further rounds are run,
+#>>> so you don't pay for extra rounds that don't help. The RMS, peak
+#>>> SNR, fraction of flagged solutions, and wall time of each round
+#>>> are written to contimagename + '_selfcal_summary.txt'. With
+#>>> inspect=plot_solutions, the solutions of each round are plotted
+#>>> and run_selfcal waits for you to check them before they are
+#>>> applied, as in the loop above; leave it out to run unattended
+#>>> (e.g., with autoclean=True).
+#>>>
+#>>> The model of each round is saved as a MODEL_DATA column for small
+#>>> ms and as a virtual model for large ms (above 10 GB), which avoids
+#>>> writing a column as large as the data every round. After each
+#>>> clean, run_selfcal checks that the model was actually saved and
+#>>> re-saves it with a prediction-only tclean if it wasn't, so you
+#>>> don't need to check the logger for this.
+#>>>
+#>>> With warmstart=True, the clean of each round starts from the
+#>>> model and mask of the previous round (tclean startmodel), so it
+#>>> only has to clean the change in the model. This saves a lot of
+#>>> time on bright sources. Set it to False to clean each round from
+#>>> scratch, e.g., if the first model has artifacts you want to lose.
+
+# from selfcal import plot_solutions, run_selfcal
+# selfcalpars = {'field': field,
+#                # 'phasecenter': phasecenter, # uncomment if mosaic or imaging an ephemeris object
+#                # 'mosweight': True, # uncomment if mosaic
+#                'deconvolver': 'hogbom',
+#                # Uncomment the below to image with nterms>1.
+#                #'deconvolver': 'mtmfs',
+#                #'nterms': 2,
+#                'imsize': imsize,
+#                'cell': cell,
+#                'weighting': weighting,
+#                'robust': robust,
+#                'niter': niter,
+#                'threshold': threshold,
+#                'interactive': True,
+#                'autoclean': nsigma if autoclean else 0,
+#                'gridder': gridder}
+# selfcalsummary = run_selfcal(vis=contvis,
+#                              imagename=contimagename,
+#                              imagepars=selfcalpars,
+#                              refant=refant,
+#                              spwmap=spwmap,
+#                              rounds=selfcalrounds,
+#                              minsnr=3.0,
+#                              minimprovement=0.02,
+#                              warmstart=True,
+#                              savemodel='', # '' to choose from the ms size, or 'modelcolumn'/'virtual'
+#                              inspect=plot_solutions)
+# selfcaltables = selfcalsummary['gaintables']
 
 #>>> Note final RMS and number of clean iterations. Compare the RMS to
 #>>> the RMS from the earlier, pre-selfcal image.
@@ -738,8 +854,11 @@ clearcal(vis=contvis)
 #>>> subtract the continuum from the line data. You should not continuum
 #>>> subtract if the line of interest is in absorption.
 
-#>>> You can use au.invertChannelRanges(flagchannels,vis=finalvis) to
-#>>> get the fitspw below. You will need to insert any continuum spws
+#>>> If you ran find_line_free_channels in the continuum section, paste
+#>>> the fitspw string it printed below; it already includes the
+#>>> line-free spws. You can also use
+#>>> au.invertChannelRanges(flagchannels,vis=finalvis) to get the fitspw
+#>>> below. You will need to insert any continuum spws
 #>>> that weren't included in flagchannels. For example, if your continuum
 #>>> spws are '0,1,2' and flagchannels='1:260~500', au.invertChannelRanges will return
 #>>> '1:0~259,1:501~3839'. The fitspw parameter should be '0,1:0~259,1:501~3839,2'
@@ -764,6 +883,22 @@ uvcontsub(vis=finalvis,
 #>>> turn. However, if the fields have different line-free channels, you
 #>>> will need to do the continuum subtraction separately for each field.
 
+#>>> Alternatively, uv_contsub from uv_contsub.py does the same fit
+#>>> (solint='int') reading the ms in chunks of rows, with all spectra
+#>>> of a chunk fitted at once, so its memory use is bounded (memory, in
+#>>> bytes) whatever the size of the ms. Give fitspw as a dictionary of
+#>>> field ids and line-free channels (with '' for all other fields) to
+#>>> subtract fields with different line-free channels in one pass. With
+#>>> outputvis='' the result is written to the CORRECTED_DATA column of
+#>>> finalvis instead of a new ms (image it with datacolumn='corrected'
+#>>> and don't applycal to it afterwards). The spectra it can't fit are
+#>>> then flagged in finalvis, so its flags are first saved as
+#>>> 'before_uv_contsub'; restore them with flagmanager afterwards.
+
+# from uv_contsub import uv_contsub
+# uv_contsub(finalvis, fitspw, linespw, fitorder=1,
+#            outputvis=finalvis+'.contsub', memory=2.0e9)
+
 # NOTE: Imaging the continuum produced by uvcontsub with
 # want_cont=True will lead to extremely poor continuum images because
 # of bandwidth smearing effects. For imaging the continuum, you should
@@ -777,18 +912,33 @@ uvcontsub(vis=finalvis,
 #linevis = finalvis+'.contsub' # if continuum subtracted
 # linevis = finalvis  #  if not continuum subtracted
 
+#>>> selfcaltables was set by the self-calibration above. If you're
+#>>> running this section on its own, get the accepted tables from the
+#>>> self-calibration summary:
+#>>>   from selfcal import read_selfcal_tables
+#>>>   selfcaltables = read_selfcal_tables(contimagename + '_selfcal_summary.txt')
+
 # save original flags in case you don't like the self-cal
 flagmanager(vis=linevis,mode='save',versionname='before_selfcal',merge='replace')
 
 spwmap_line = [0] # Mapping self-calibration solution to the individual line spectral windows.
+
+#>>> To check spwmap_line, compare it with the map that line_spwmap
+#>>> builds by matching the executions of linevis and contvis (by
+#>>> project and time range) and checking that every line spw overlaps
+#>>> in frequency with the spws its solutions were solved from.
+#>>>
+#>>> from ms_metadata import line_spwmap
+#>>> print('spwmap_line = ' + str(line_spwmap(linevis, contvis)))
+
 applycal(vis=linevis,
-         spwmap=[spwmap_line, spwmap_line], # entering the appropriate spwmap_line value for each spw in the input dataset
+         spwmap=[spwmap_line]*len(selfcaltables), # entering the appropriate spwmap_line value for each spw in the input dataset
          field=field,
-         gaintable=['pcal3','apcal'],
+         gaintable=selfcaltables, # e.g., ['pcal3','apcal']
          gainfield='',
          calwt=False,
          flagbackup=False,
-         interp=['linearperobs','linearperobs'])
+         interp=['linearperobs']*len(selfcaltables))
 
 # Save results of self-cal in a new ms and reset the image name.
 split(vis=linevis,
@@ -805,6 +955,20 @@ clearcal(linevis)
 #>>> return the flags to their original state, run the following command
 #>>> flagmanager(vis=linevis, mode='restore',versionname='before_selfcal')
 
+#>>> Alternatively, apply_and_split from selfcal.py replaces the
+#>>> flagmanager, applycal, split, and clearcal calls above with a single
+#>>> pass of mstransform with on-the-fly calibration (the same as
+#>>> applycal with calwt=False, gainfield='', and interp='linearperobs',
+#>>> followed by split(datacolumn='corrected')). The calibration library
+#>>> it uses is written to linevis+'.selfcal.callib'. linevis itself is
+#>>> not modified: its corrected data column and flags are left alone,
+#>>> and data without good gaincal solutions are flagged in
+#>>> linevis+'.selfcal' only. The spwmap is checked against the tables
+#>>> before the data are read.
+#>>>
+#>>> from selfcal import apply_and_split
+#>>> apply_and_split(linevis, linevis+'.selfcal', selfcaltables, spwmap_line, field=field)
+
 linevis=linevis+'.selfcal'
 
 ##############################################
@@ -864,8 +1028,9 @@ nchan = 100  # number of channels. See science goals for appropriate value.
 #clearcal(vis=linevis)
 #delmod(vis=linevis)
 
-for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
-    rmtables(lineimagename + ext)
+if not usecache:
+    for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt','.weight']:
+        rmtables(lineimagename + ext)
 
 tclean(vis=linevis,
        imagename=lineimagename, 
@@ -907,6 +1072,45 @@ tclean(vis=linevis,
 ## rmtables(linemaskname) # uncomment if you want to overwrite the mask.
 # os.system('cp -ir ' + lineimagename + '.mask ' + linemaskname)
 
+#>>> If you have several line spws or rest frequencies to image, the
+#>>> cubes can be made at the same time (instead of repeating the tclean
+#>>> above) with image_line_cubes from cube_utils.py. Give one entry per
+#>>> cube in lines. Each cube is made in its own process with its own
+#>>> log (line_logs/<imagename>.log) and its products are written to
+#>>> line_cubes/<imagename>/. At most nprocs cubes run at once, fewer
+#>>> if the cubes would not fit in memory. Do not use interactive
+#>>> cleaning. Export the cubes with
+#>>>     from imaging_stages import export_images
+#>>>     export_images(patterns=['line_cubes/*/*.pbcor','line_cubes/*/*.pb'])
+
+# from cube_utils import image_line_cubes
+# lines = [{'imagename': lineimagename, 'spw': spw, 'restfreq': restfreq,
+#           'start': start, 'width': width, 'nchan': nchan,
+#           'outframe': outframe, 'veltype': veltype},
+#          # add one entry per line spw / rest frequency
+#         ]
+# cubepars = {'field': field, 'imsize': imsize, 'cell': cell,
+#             'gridder': gridder, 'robust': robust, 'niter': niter,
+#             'threshold': threshold, 'interactive': False}
+# lineimages = image_line_cubes(linevis, lines, cubepars, nprocs=4)
+
+#>>> Very large cubes (e.g., thousands of channels with imsize > 1000)
+#>>> can be imaged in channel chunks instead, one process per chunk,
+#>>> with image_line_cube_chunked. The start, width, and nchan grid is
+#>>> split into contiguous chunks (made in lineimagename_chunks/), all
+#>>> chunks are restored with the common beam of the whole cube, and the
+#>>> chunks are put back together into lineimagename.image, .pb, and
+#>>> .image.pbcor. By default the cube is split into nprocs chunks, or
+#>>> more if a chunk would not fit in memory. Give start and width
+#>>> explicitly. The chunks are imaged with weighting='briggs' rather
+#>>> than briggsbwtaper, whose taper would change with the bandwidth of
+#>>> each chunk.
+
+# from cube_utils import image_line_cube_chunked
+# image_line_cube_chunked(linevis, lineimagename, cubepars, spw, restfreq,
+#                         start, width, nchan, outframe=outframe,
+#                         veltype=veltype, nprocs=4)
+
 ##############################################
 # Export the images
 
@@ -920,6 +1124,20 @@ myimages = glob.glob("*.pb")
 for image in myimages:
     exportfits(imagename=image, fitsimage=image+'.fits',overwrite=True) 
 
+#>>> To export the images in parallel, nprocs at a time, skipping
+#>>> images whose FITS file is newer than the image (set overwrite=True
+#>>> to export them again), use export_fits from fits_export.py instead
+#>>> of the loops above. By default the FITS files are 32-bit floats as
+#>>> above. For smaller files, set bitpix=16 (16-bit scaled integers,
+#>>> error at most (max-min)/131068), or compress='RICE_1' for
+#>>> tile-compressed .fits.fz files (needs astropy; error at most half
+#>>> the quantization step of the noisiest tile). The .pb images are
+#>>> always exported losslessly. The size and error bound of each file
+#>>> are printed.
+#>>>
+#>>> from fits_export import export_fits
+#>>> export_fits(patterns=['*.pbcor','*.pb'], bitpix=-32, compress='', nprocs=4)
+
 ##############################################
 # Create Diagnostic PNGs
 
@@ -942,6 +1160,115 @@ for limage in mylineimages:
     os.system("rm -rf "+mom8+".png")
     imview(raster={'file':mom8,'range':[mymin,mymax]},out=mom8+'.png')
 
+#>>> To make the PNGs in parallel, nprocs at a time, use
+#>>> make_diagnostic_pngs from diagnostic_pngs.py instead of the loops
+#>>> above (needs matplotlib). It makes <image>.png for the continuum
+#>>> images and <image>.mom8.png (the peak over the channels, as from
+#>>> immoments moments=[8]) for the cubes. Each image is read one plane
+#>>> at a time, without writing a .mom8 image, and its statistics
+#>>> (peak, rms, noise, and per-channel peak and noise) are cached in
+#>>> <image>.stats.json. PNGs and statistics are only redone if the
+#>>> image has changed. Use get_image_stats(image) from
+#>>> diagnostic_pngs.py instead of imstat to reuse the statistics.
+#>>>
+#>>> from diagnostic_pngs import make_diagnostic_pngs
+#>>> imagestats = make_diagnostic_pngs(contpattern='*mfs*manual.image',
+#>>>                                   linepattern='*cube*manual.image', nprocs=4)
+
+
+##############################################
+# Running the imaging as stages [OPTIONAL]
+
+#>>> Instead of pasting the sections above into CASA one at a time,
+#>>> you can run them as named stages once you have set the parameters
+#>>> in each section (contspws, flagchannels, imaging parameters,
+#>>> refant, fitspw, linespw, line imaging parameters). Each
+#>>> stage declares the files it reads and writes and is only started
+#>>> once the stages writing its inputs have finished. Completed stages
+#>>> are recorded in imaging_stages.checkpoint.json, so if the run
+#>>> crashes or is interrupted, re-running this section resumes at the
+#>>> stage that failed. A stage is re-run if its parameters change.
+#>>>
+#>>> With nprocs=2, independent stages run at the same time, e.g.,
+#>>> the continuum self-calibration and the continuum subtraction of
+#>>> finalvis. Each stage then logs to stage_logs/<stage name>.log.
+#>>> Set autoclean=True (or interactive=False in imagepars) when using
+#>>> nprocs>1. Remove
+#>>> stages from the list that you don't need (e.g., selfcal and
+#>>> lineselfcal if you aren't self-calibrating).
+
+runstages = False # set to True to run the stages below.
+
+if runstages:
+    import imaging_stages
+    from stage_runner import make_stage, run_stages
+
+    finalvis = 'calibrated_final.ms'
+    contvis = 'calibrated_final_cont.ms'
+    linevis = finalvis + '.contsub.selfcal'
+    selfcalsummaryfile = contimagename + '_selfcal_summary.txt'
+
+    imagepars = {'field': field,
+                 'imsize': imsize,
+                 'cell': cell,
+                 'gridder': gridder,
+                 # 'phasecenter': phasecenter, # uncomment if mosaic or imaging an ephemeris object
+                 # 'mosweight': True, # uncomment if mosaic
+                 'weighting': weighting,
+                 'robust': robust,
+                 'niter': niter,
+                 'threshold': threshold,
+                 'interactive': not autoclean,
+                 'autoclean': nsigma if autoclean else 0}
+
+    # continuum imaging parameters. With deconvolver='mtmfs', the
+    # continuum images are the Taylor term images (.image.tt0, ...).
+    contimagepars = dict(imagepars, deconvolver='hogbom')
+    # contimagepars = dict(imagepars, deconvolver='mtmfs', nterms=2) # uncomment if the fractional bandwidth is greater than 10%
+    contimage = imaging_stages.restored_image(contimagename, contimagepars)
+
+    stages = [
+        make_stage('contsplit', imaging_stages.split_continuum,
+                   inputs=[finalvis], outputs=[contvis],
+                   finalvis=finalvis, contvis=contvis, contspws=contspws,
+                   width=[256,8,8,8], # same width as the split above
+                   timebin=conttimebin,
+                   flagchannels=flagchannels),
+        make_stage('contimage', imaging_stages.image_continuum,
+                   inputs=[contvis], outputs=[contimage],
+                   contvis=contvis, contimagename=contimagename,
+                   imagepars=contimagepars),
+        make_stage('selfcal', imaging_stages.selfcal_continuum,
+                   inputs=[contvis], after=['contimage'],
+                   outputs=[contvis+'.selfcal',selfcalsummaryfile],
+                   contvis=contvis, contimagename=contimagename,
+                   imagepars=contimagepars, refant=refant,
+                   spwmap=[], # from the metadata index of contvis
+                   rounds=selfcalrounds, warmstart=True),
+        make_stage('contsub', imaging_stages.subtract_continuum,
+                   inputs=[finalvis], after=['contsplit'],
+                   outputs=[finalvis+'.contsub'],
+                   finalvis=finalvis, fitspw=fitspw, linespw=linespw),
+        make_stage('lineselfcal', imaging_stages.apply_selfcal_to_line,
+                   inputs=[finalvis+'.contsub',selfcalsummaryfile],
+                   outputs=[linevis],
+                   linevis=finalvis+'.contsub', field=field,
+                   spwmap_line=[], # matched to the executions of contvis
+                   selfcalsummary=selfcalsummaryfile),
+        make_stage('lineimage', imaging_stages.image_line,
+                   inputs=[linevis], outputs=[lineimagename+'.image'],
+                   linevis=linevis, lineimagename=lineimagename,
+                   imagepars=imagepars, spw=spw, restfreq=restfreq,
+                   start=start, width=width, nchan=nchan,
+                   outframe=outframe, veltype=veltype),
+        make_stage('export', imaging_stages.export_images,
+                   after=['contimage','selfcal','lineimage']),
+        make_stage('pngs', imaging_stages.make_pngs,
+                   after=['contimage','selfcal','lineimage']),
+        ]
+
+    run_stages(stages, checkpoint='imaging_stages.checkpoint.json', nprocs=1)
+
 
 ##############################################
 # Analysis
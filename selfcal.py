@@ -0,0 +1,642 @@
+import json
+import os
+import time
+
+from imaging_stages import _tclean_mfs
+from ms_metadata import combined_spwmap, get_ms_index, ms_size, select_field_ids
+from stage_cache import run_stage
+
+# Default self-calibration rounds: (solint, calmode). solint='30.25s'
+# gets you five 12m integrations, while solint='50.5s' gets you five 7m
+# integrations.
+DEFAULT_ROUNDS = [('inf', 'p'),
+                  ('30.25s', 'p'),
+                  ('int', 'p'),
+                  ('inf', 'ap')]
+
+# Largest ms (in bytes) for which the self-calibration model is written
+# to the MODEL_DATA column. Larger ms use a virtual model, which is
+# predicted on the fly when gaincal reads it instead of writing a
+# column as big as the data every round.
+MODEL_COLUMN_MAXSIZE = 10.0e9
+
+# Number of rows per field read by model_is_saved to check that the
+# MODEL_DATA column isn't empty, spread evenly over the field.
+MODEL_CHECK_ROWS = 1000
+
+
+def image_stats(imagename):
+
+    """
+    This function returns the peak, rms, and peak signal-to-noise of
+    a clean image. The peak is measured on the restored image and the
+    rms is a robust estimate (1.4826 x median absolute deviation) from
+    the residual image, so it isn't biased by the source. Works for
+    both hogbom (.image) and mtmfs (.image.tt0) images.
+
+    Example:
+        (peak, rms, snr) = image_stats(contimagename + '_p0')
+    """
+
+    from casatasks import imstat
+
+    suffix = '' if os.path.exists(imagename + '.image') else '.tt0'
+    peak = float(imstat(imagename + '.image' + suffix)['max'][0])
+    rms = 1.4826 * float(imstat(imagename + '.residual' + suffix)['medabsdevmed'][0])
+    snr = peak / rms if rms > 0 else 0.0
+
+    return (peak, rms, snr)
+
+
+def flagged_fraction(caltable):
+
+    """
+    This function returns the fraction of flagged solutions in a
+    calibration table.
+
+    Example:
+        flagged_fraction('pcal1')
+    """
+
+    from casatools import table
+
+    tb = table()
+    tb.open(caltable)
+    flags = tb.getcol('FLAG')
+    tb.close()
+
+    return float(flags.mean()) if flags.size else 1.0
+
+
+def _round_names(rounds):
+
+    """
+    This function returns the calibration table and image suffix for
+    each round, following the naming of the imaging script: pcal1,
+    pcal2, ... and _p1, _p2, ... for phase rounds, and apcal and _ap
+    (apcal2 and _ap2, etc. for later rounds) for amplitude rounds.
+    """
+
+    names = []
+    nphase = 0
+    namp = 0
+    for selfcalround in rounds:
+        if selfcalround[1] == 'ap':
+            namp += 1
+            count = '' if namp == 1 else str(namp)
+            names.append(('apcal' + count, '_ap' + count))
+        else:
+            nphase += 1
+            names.append(('pcal%d' % nphase, '_p%d' % nphase))
+
+    return names
+
+
+def plot_solutions(caltable, calmode):
+
+    """
+    This function plots the solutions of the self-calibration table
+    caltable with plotms (phases for calmode='p', amplitudes for
+    calmode='ap', one page per antenna) and waits for you to check
+    them. Pass it as the inspect argument of run_selfcal to check each
+    round before its solutions are applied.
+
+    Example:
+        plot_solutions('pcal1', 'p')
+    """
+
+    from casaplotms import plotms
+
+    if calmode == 'ap':
+        plotms(vis=caltable, xaxis='time', yaxis='amp',
+               iteraxis='antenna', plotrange=[0, 0, 0.2, 1.8])
+    else:
+        plotms(vis=caltable, xaxis='time', yaxis='phase',
+               iteraxis='antenna', plotrange=[0, 0, -180, 180])
+    input("Check the solutions in " + caltable + " and push enter to continue")
+
+
+def write_selfcal_summary(summary, summaryfile):
+
+    """
+    This function writes the per-round self-calibration summary
+    returned by run_selfcal to summaryfile (a text table) and
+    summaryfile + '.json'. The JSON file also lists the calibration
+    tables to apply to the line data.
+    """
+
+    lines = ['%-8s %-8s %-4s %-8s %12s %12s %10s %9s %9s %s' %
+             ('round', 'table', 'mode', 'solint', 'peak(Jy)', 'rms(Jy)',
+              'peakSNR', 'flagged', 'time(s)', 'status')]
+    for entry in summary['rounds']:
+        lines.append('%-8s %-8s %-4s %-8s %12.5g %12.5g %10.1f %9s %9.1f %s' %
+                     (entry['image'], entry['caltable'] or '-',
+                      entry['calmode'] or '-', entry['solint'] or '-',
+                      entry['peak'], entry['rms'], entry['snr'],
+                      '-' if entry['flagged'] is None else
+                      '%.1f%%' % (100.0 * entry['flagged']),
+                      entry['walltime'], entry['status']))
+    lines.append('Final calibration tables: ' + ','.join(summary['gaintables']))
+
+    with open(summaryfile, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    with open(summaryfile + '.json', 'w') as f:
+        json.dump(summary, f, indent=1)
+
+    print('\n'.join(lines))
+
+
+def read_selfcal_tables(summaryfile):
+
+    """
+    This function returns the list of calibration tables accepted by
+    run_selfcal, read from the JSON summary file.
+
+    Example:
+        selfcaltables = read_selfcal_tables(contimagename + '_selfcal_summary.txt')
+    """
+
+    with open(summaryfile + '.json', 'r') as f:
+        return json.load(f)['gaintables']
+
+
+def model_storage(vis, imagepars):
+
+    """
+    This function chooses how tclean saves the self-calibration model
+    of vis: 'modelcolumn' (a physical MODEL_DATA column) for ms smaller
+    than MODEL_COLUMN_MAXSIZE or for gridders that can't make virtual
+    models (awproject); 'virtual' otherwise. The gaincal access pattern
+    doesn't change the choice: each round of run_selfcal reads the model
+    exactly once, in its gaincal, so a virtual model is predicted once
+    per round, just as a column is written once and read once. Only the
+    size of vis decides.
+
+    Example:
+        savemodel = model_storage('calibrated_final_cont.ms', imagepars)
+    """
+
+    if imagepars.get('gridder', 'standard') == 'awproject':
+        return 'modelcolumn'
+    if ms_size(vis) < MODEL_COLUMN_MAXSIZE:
+        return 'modelcolumn'
+
+    return 'virtual'
+
+
+def model_is_saved(vis, field, savemodel):
+
+    """
+    This function returns True if tclean saved a model for the fields
+    in field (e.g., '0' or '4~150') of vis: for savemodel='modelcolumn',
+    the MODEL_DATA column exists; for savemodel='virtual', a model is
+    defined for each of the fields. It only returns False if the column
+    or the model definitions are missing, so remove the old model with
+    delmod before the clean (as run_selfcal does) to catch a clean that
+    didn't save its model. A warning is printed if the
+    model is zero in MODEL_CHECK_ROWS rows spread over each field (e.g.,
+    a clean that found no components, which is a valid model) or if a
+    virtual model is hidden by a MODEL_DATA column, which gaincal would
+    read instead.
+    """
+
+    from casatools import table
+
+    fields = select_field_ids(get_ms_index(vis), field)
+
+    tb = table()
+    tb.open(vis)
+    hascolumn = 'MODEL_DATA' in tb.colnames()
+    try:
+        if savemodel == 'modelcolumn':
+            if not hascolumn:
+                return False
+            for fieldid in fields:
+                subtb = tb.query('FIELD_ID == %d' % fieldid, columns='MODEL_DATA')
+                nrows = subtb.nrows()
+                if nrows:
+                    rowincr = max(1, nrows // MODEL_CHECK_ROWS)
+                    model = subtb.getcol('MODEL_DATA', 0, -1, rowincr)
+                    if not abs(model).max() > 0:
+                        print("WARNING: the model of field %d of %s is zero. "
+                              "Check that the clean found any emission." %
+                              (fieldid, vis))
+                subtb.close()
+            return True
+
+        if hascolumn:
+            print("WARNING: " + vis + " has a MODEL_DATA column, which is "
+                  "used instead of the virtual model. Remove it with "
+                  "delmod(vis=vis, scr=True).")
+        keywords = tb.keywordnames()
+    finally:
+        tb.close()
+
+    # virtual models are referenced in the main table keywords or in
+    # the SOURCE_MODEL column of the SOURCE subtable.
+    if all('definedmodel_field_%d' % fieldid in keywords for fieldid in fields):
+        return True
+
+    tb.open(os.path.join(vis, 'SOURCE'))
+    try:
+        if 'SOURCE_MODEL' not in tb.colnames():
+            return False
+        return any(tb.getcell('SOURCE_MODEL', row) for row in range(tb.nrows()))
+    finally:
+        tb.close()
+
+
+def _clean_and_save_model(vis, imagename, imagepars, savemodel, usecache=True,
+                          **kwargs):
+
+    """
+    This function runs the tclean of a self-calibration round with
+    savemodel and checks that the model was saved (see model_is_saved).
+    If it wasn't (e.g., because the clean was interrupted or skipped),
+    the model is saved again from the existing model image with a
+    prediction-only tclean (niter=0, calcres=False, calcpsf=False). A
+    RuntimeError is raised if the model is still missing after that.
+    """
+
+    from casatasks import tclean
+
+    _tclean_mfs(vis, imagename, imagepars, usecache=usecache,
+                savemodel=savemodel, **kwargs)
+
+    field = imagepars['field']
+    if model_is_saved(vis, field, savemodel):
+        return
+
+    print("The model of " + imagename + " wasn't saved. Saving it now.")
+    pars = {'specmode': 'mfs', 'deconvolver': 'hogbom', 'usepointing': False}
+    pars.update(imagepars)
+    pars.pop('autoclean', None)
+    pars.update({'niter': 0, 'calcres': False, 'calcpsf': False,
+                 'restart': True, 'interactive': False,
+                 'savemodel': savemodel})
+    tclean(vis=vis, imagename=imagename, **pars)
+
+    if not model_is_saved(vis, field, savemodel):
+        raise RuntimeError("Could not save the model of " + imagename +
+                           " to " + vis + " (savemodel=" + savemodel + ")")
+
+
+def _solution_spws(caltable):
+
+    """
+    This function returns the set of (observation id, spw id) pairs
+    that have solutions in the calibration table caltable.
+    """
+
+    from casatools import table
+
+    tb = table()
+    tb.open(caltable)
+    pairs = set(zip(tb.getcol('OBSERVATION_ID').tolist(),
+                    tb.getcol('SPECTRAL_WINDOW_ID').tolist()))
+    tb.close()
+
+    return pairs
+
+
+def check_spwmap(vis, spwmap, gaintables=[], obsmap=None):
+
+    """
+    This function checks spwmap before it is used to solve or apply
+    combine='spw' self-calibration solutions on vis, so that a wrong map
+    doesn't waste a pass over the data (or flag everything). Without
+    gaintables, each target spw of vis has to be mapped to a spw of the
+    same execution, as in combined_spwmap (see ms_metadata.py). With
+    gaintables, each target spw has to be mapped to a spw that has
+    solutions for its execution in every table (the execution
+    obsmap[N] of the tables for execution N of vis if the tables were
+    solved on another ms, see ms_metadata.match_executions). Spws
+    beyond the end of spwmap map to themselves, like in applycal. A
+    ValueError describing the problem is raised if the check fails.
+
+    Example:
+        check_spwmap('calibrated_final.ms.contsub', [0,4], ['pcal3','apcal'])
+    """
+
+    index = get_ms_index(vis)
+    targetspws = index['target_spws'] or [spw['id'] for spw in index['spws']]
+    solutions = dict((caltable, _solution_spws(caltable))
+                     for caltable in gaintables)
+
+    problems = []
+    for obs in index['observations']:
+        for spw in obs['spws']:
+            if spw not in targetspws:
+                continue
+            mapped = spwmap[spw] if spw < len(spwmap) else spw
+            if not gaintables and mapped not in obs['spws']:
+                problems.append("spw %d of execution %d is mapped to spw %d "
+                                "of another execution" % (spw, obs['id'], mapped))
+            solobs = (obsmap or {}).get(obs['id'], obs['id'])
+            for (caltable, pairs) in sorted(solutions.items()):
+                if (solobs, mapped) not in pairs:
+                    problems.append("spw %d of execution %d is mapped to spw "
+                                    "%d, which has no solutions for that "
+                                    "execution in %s" %
+                                    (spw, obs['id'], mapped, caltable))
+
+    if problems:
+        message = "Bad spwmap %s for %s:\n  " % (list(spwmap), vis)
+        message += '\n  '.join(problems)
+        if not gaintables:
+            message += "\nThe spwmap for combine='spw' is %s" % combined_spwmap(index)
+        raise ValueError(message)
+
+
+def _apply_tables(vis, field, spwmap, gaintables):
+
+    """
+    This function applies the given self-calibration tables to vis, or
+    resets the corrected data column if there are no tables.
+    """
+
+    from casatasks import applycal, clearcal
+
+    if not gaintables:
+        clearcal(vis=vis)
+        return
+
+    check_spwmap(vis, spwmap, gaintables)
+    applycal(vis=vis, field=field, spwmap=[spwmap] * len(gaintables),
+             gaintable=gaintables, gainfield='', calwt=False,
+             flagbackup=False, interp=['linearperobs'] * len(gaintables))
+
+
+def write_callib(callibfile, vis, gaintables, spwmap, field='', obsmap=None):
+
+    """
+    This function writes a calibration library file (see the CASA
+    docallib parameter) that applies gaintables to the field of vis
+    like the applycal calls of the imaging script: calwt=False, the same
+    spwmap for each table, gainfield='', and interp='linearperobs'.
+
+    The calibration library has no per-observation interpolation, so
+    there is one entry per table and execution instead: the entry for
+    the data of execution obs='N' maps them to the solutions of
+    execution obsmap[N] (a dictionary, by default N), so they are only
+    interpolated linearly in time between the solutions of that one
+    execution. This is what linearperobs does: it interpolates linearly
+    within each execution and never across executions.
+
+    Example:
+        write_callib('calibrated_final.ms.contsub.selfcal.callib',
+                     'calibrated_final.ms.contsub', ['pcal3', 'apcal'],
+                     [0,0,0,0], field='0')
+    """
+
+    obsids = [obs['id'] for obs in get_ms_index(vis)['observations']]
+    if obsmap is None:
+        obsmap = {}
+
+    lines = []
+    for caltable in gaintables:
+        for obsid in obsids:
+            # obsmap is indexed by the observation id of the data; only
+            # the selected execution obsid matters for this entry.
+            obslist = list(range(obsid + 1))
+            obslist[obsid] = obsmap.get(obsid, obsid)
+            line = ("obs='%d' caltable='%s' calwt=False tinterp='linear' "
+                    "spwmap=[%s] obsmap=[%s]" %
+                    (obsid, caltable, ','.join(map(str, spwmap)),
+                     ','.join(map(str, obslist))))
+            if field != '':
+                line = "field='%s' " % field + line
+            lines.append(line)
+
+    with open(callibfile, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def apply_and_split(vis, outputvis, gaintables, spwmap, field='', obsmap=None):
+
+    """
+    This function writes vis with the self-calibration tables gaintables
+    applied to outputvis in a single pass with mstransform and on the fly
+    calibration (docallib=True, see write_callib). This replaces
+    applycal, split(datacolumn='corrected'), and clearcal: the DATA
+    column of vis is read once, and neither its CORRECTED_DATA column nor
+    its flags are written, so there's nothing to reset if you're unhappy
+    with the self-calibration. Data without good solutions are flagged
+    in outputvis only. The spwmap is checked against the tables first
+    (see check_spwmap). If the tables were solved on an ms with other
+    observation ids, give obsmap (see ms_metadata.match_executions).
+
+    Example:
+        apply_and_split('calibrated_final.ms.contsub',
+                        'calibrated_final.ms.contsub.selfcal',
+                        ['pcal3', 'apcal'], [0,0,0,0], field='0')
+    """
+
+    if not gaintables:
+        run_stage('split', usecache=False, vis=vis, outputvis=outputvis,
+                  datacolumn='data')
+        return
+
+    check_spwmap(vis, spwmap, gaintables, obsmap=obsmap)
+    callibfile = outputvis.rstrip('/') + '.callib'
+    write_callib(callibfile, vis, gaintables, spwmap, field=field,
+                 obsmap=obsmap)
+
+    run_stage('mstransform', usecache=False, vis=vis, outputvis=outputvis,
+              datacolumn='corrected', docallib=True, callib=callibfile)
+
+
+def _warm_start_pars(previmage, imagepars):
+
+    """
+    This function returns the extra tclean parameters that seed a clean
+    with the model (and, for user masks, the mask) of the image
+    previmage: startmodel is the previous model (one per Taylor term
+    for mtmfs) and mask is a copy of the previous mask.
+    """
+
+    if os.path.exists(previmage + '.model'):
+        pars = {'startmodel': previmage + '.model'}
+    else:
+        nterms = imagepars.get('nterms', 2)
+        pars = {'startmodel': [previmage + '.model.tt%d' % term
+                               for term in range(nterms)]}
+
+    if (imagepars.get('usemask', 'user') == 'user' and
+            not imagepars.get('autoclean') and
+            os.path.exists(previmage + '.mask') and
+            not imagepars.get('mask')):
+        pars['mask'] = previmage + '.mask'
+
+    return pars
+
+
+def run_selfcal(vis, imagename, imagepars, refant, spwmap,
+                rounds=DEFAULT_ROUNDS, minsnr=3.0, minblperant=6,
+                minimprovement=0.02, warmstart=False, savemodel='',
+                summaryfile='', inspect=None, usecache=True):
+
+    """
+    This function self-calibrates the continuum ms vis. It saves the
+    current flags as 'before_selfcal', removes any old models, makes
+    the initial model image imagename + '_p0' and then, for each round
+    in rounds, solves for the gains with gaincal, applies them with
+    applycal, saves the flags with flagmanager, and re-images with
+    tclean, saving the model. Each round is a tuple of (solint,
+    calmode) with an optional dictionary of extra gaincal parameters,
+    e.g., ('inf', 'ap', {'uvrange': '>50m'}). Phase rounds are applied on
+    their own; amplitude rounds are solved and applied on top of the
+    latest phase round.
+
+    After each round, the peak, rms, and peak SNR of the new image are
+    compared with those of the previous image. If neither the rms has
+    dropped nor the peak SNR has risen by more than minimprovement
+    (a fraction), the round is rejected: its flags are restored, the
+    previous calibration is re-applied, and no further rounds are run.
+
+    The imaging parameters in imagepars (field, imsize, cell, gridder,
+    weighting, robust, niter, threshold, interactive, etc.) are used
+    for every tclean. The last accepted image is primary beam corrected.
+
+    The model is saved as a MODEL_DATA column or as a virtual model as
+    chosen by model_storage from the size of vis, unless savemodel is
+    given ('modelcolumn' or 'virtual'). The model of the previous round
+    is removed with delmod before each clean. After the clean, the model
+    is checked and saved again if it is missing (see model_is_saved), so
+    a clean that was skipped or interrupted can't leave gaincal with the
+    model of the previous round.
+
+    If warmstart is True, the clean of each round starts from the model
+    of the last accepted image (tclean startmodel) and reuses its mask,
+    so it only needs to find the changes to the model instead of
+    rebuilding all the clean components from scratch.
+
+    If inspect is given, it is called as inspect(caltable, calmode)
+    after the gaincal of each round, before the solutions are applied,
+    e.g., inspect=plot_solutions to check the solutions of each round
+    with plotms before the next one is solved.
+
+    If spwmap is empty, the combine='spw' spwmap is taken from the
+    metadata index of vis (see ms_metadata.combined_spwmap). The spwmap
+    is checked before any gaincal or applycal is run (see check_spwmap).
+
+    A per-round summary of peak, rms, peak SNR, fraction of flagged
+    solutions, and wall time is written to summaryfile (by default
+    imagename + '_selfcal_summary.txt') and returned together with the
+    list of accepted calibration tables.
+
+    Example:
+        summary = run_selfcal('calibrated_final_cont.ms', contimagename,
+                              imagepars, 'DV09', [0,0,0,0],
+                              rounds=[('inf','p'),('30.25s','p'),
+                                      ('int','p'),('inf','ap')])
+        selfcaltables = summary['gaintables']
+    """
+
+    from casatasks import delmod, flagmanager, gaincal, impbcor, rmtables
+
+    field = imagepars['field']
+    if not spwmap:
+        spwmap = get_ms_index(vis)['spwmap']
+    check_spwmap(vis, spwmap)
+    if not summaryfile:
+        summaryfile = imagename + '_selfcal_summary.txt'
+    if not savemodel:
+        savemodel = model_storage(vis, imagepars)
+    print("Saving the self-calibration models as savemodel='" + savemodel + "'")
+
+    # save initial flags in case you don't like the final
+    # self-calibration and get rid of any old models.
+    flagmanager(vis=vis, mode='save', versionname='before_selfcal',
+                merge='replace')
+    delmod(vis=vis, otf=True, scr=True)
+
+    summary = {'vis': vis, 'savemodel': savemodel, 'rounds': [],
+               'gaintables': []}
+
+    starttime = time.time()
+    _clean_and_save_model(vis, imagename + '_p0', imagepars, savemodel,
+                          usecache=usecache)
+    (peak, rms, snr) = image_stats(imagename + '_p0')
+    summary['rounds'].append({'image': '_p0', 'caltable': '', 'solint': '',
+                              'calmode': '', 'peak': peak, 'rms': rms,
+                              'snr': snr, 'flagged': None,
+                              'walltime': time.time() - starttime,
+                              'status': 'initial'})
+
+    phasetable = ''
+    gaintables = []
+    flagversion = 'before_selfcal'
+    lastimage = imagename + '_p0'
+
+    for (selfcalround, (caltable, suffix)) in zip(rounds, _round_names(rounds)):
+        solint = selfcalround[0]
+        calmode = selfcalround[1]
+        extrapars = dict(selfcalround[2]) if len(selfcalround) > 2 else {}
+
+        starttime = time.time()
+        rmtables(caltable)
+        calpars = {'minsnr': minsnr, 'minblperant': minblperant}
+        if calmode == 'ap' and phasetable:
+            calpars.update({'gaintable': phasetable, 'spwmap': spwmap,
+                            'solnorm': True})
+        calpars.update(extrapars)
+        gaincal(vis=vis, caltable=caltable, field=field, gaintype='T',
+                refant=refant, calmode=calmode, combine='spw',
+                solint=solint, **calpars)
+        if inspect:
+            inspect(caltable, calmode)
+
+        if calmode == 'ap' and phasetable:
+            newtables = [phasetable, caltable]
+        else:
+            newtables = [caltable]
+        _apply_tables(vis, field, spwmap, newtables)
+
+        flagmanager(vis=vis, mode='save', versionname='after_' + caltable)
+
+        # remove the model of the previous round so that model_is_saved
+        # only passes if this round's clean saved its model.
+        delmod(vis=vis, otf=True, scr=True)
+        warmpars = _warm_start_pars(lastimage, imagepars) if warmstart else {}
+        _clean_and_save_model(vis, imagename + suffix, imagepars, savemodel,
+                              usecache=usecache, **warmpars)
+        (newpeak, newrms, newsnr) = image_stats(imagename + suffix)
+
+        improved = (newrms < rms * (1.0 - minimprovement) or
+                    newsnr > snr * (1.0 + minimprovement))
+
+        summary['rounds'].append({'image': suffix, 'caltable': caltable,
+                                  'solint': solint, 'calmode': calmode,
+                                  'peak': newpeak, 'rms': newrms,
+                                  'snr': newsnr,
+                                  'flagged': flagged_fraction(caltable),
+                                  'walltime': time.time() - starttime,
+                                  'status': 'accepted' if improved else 'rejected'})
+
+        if not improved:
+            print("Self-cal round " + caltable + " did not improve the image. " +
+                  "Restoring the calibration from the previous round and stopping.")
+            flagmanager(vis=vis, mode='restore', versionname=flagversion)
+            _apply_tables(vis, field, spwmap, gaintables)
+            break
+
+        (peak, rms, snr) = (newpeak, newrms, newsnr)
+        gaintables = newtables
+        if calmode == 'p':
+            phasetable = caltable
+        flagversion = 'after_' + caltable
+        lastimage = imagename + suffix
+
+    # primary beam correct the final image
+    suffix = '' if os.path.exists(lastimage + '.image') else '.tt0'
+    rmtables(lastimage + '.image.pbcor' + suffix)
+    impbcor(imagename=lastimage + '.image' + suffix,
+            pbimage=lastimage + '.pb' + suffix,
+            outfile=lastimage + '.image.pbcor' + suffix)
+
+    summary['gaintables'] = gaintables
+    summary['finalimage'] = lastimage
+    write_selfcal_summary(summary, summaryfile)
+
+    return summary
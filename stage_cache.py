@@ -0,0 +1,387 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from ms_metadata import ms_data_fingerprint
+
+# Version of the stage records. Bump this if the key changes so that
+# old records are ignored.
+STAGE_VERSION = 2
+
+# Parameter giving the output of each of the cached tasks.
+TASK_OUTPUTS = {'split': 'outputvis',
+                'concat': 'concatvis',
+                'cvel2': 'outputvis',
+                'mstransform': 'outputvis',
+                'uvcontsub': 'vis',
+                'uvcontsubstream': 'outputvis',
+                'tclean': 'imagename',
+                'virtualconcat': 'concatvis'}
+
+# Default datacolumn of the cached tasks that read a single data
+# column. The other tasks copy all the columns of their inputs.
+TASK_DATACOLUMN = {'split': 'corrected',
+                   'cvel2': 'corrected',
+                   'mstransform': 'corrected',
+                   'tclean': 'corrected',
+                   'uvcontsubstream': 'data'}
+
+# Products written by tclean.
+IMAGE_EXTS = ['.image', '.mask', '.model', '.image.pbcor', '.psf',
+              '.residual', '.pb', '.sumwt', '.weight']
+
+# tclean parameters that only affect the deconvolution (minor cycles)
+# and restoration. If only these change, a clean can be continued from
+# its existing psf, residual, and model (see can_reclean).
+TCLEAN_DECONVOLUTION_PARAMS = ['niter', 'threshold', 'nsigma', 'cycleniter',
+                               'cyclefactor', 'minpsffraction',
+                               'maxpsffraction', 'gain', 'interactive',
+                               'mask', 'usemask', 'pbmask',
+                               'sidelobethreshold', 'noisethreshold',
+                               'lownoisethreshold', 'negativethreshold',
+                               'smoothfactor', 'minbeamfrac',
+                               'cutthreshold', 'growiterations',
+                               'dogrowprune', 'minpercentchange',
+                               'fastnoise', 'verbose', 'restoringbeam',
+                               'pbcor', 'restoration', 'savemodel',
+                               'scales', 'smallscalebias', 'calcres',
+                               'calcpsf', 'restart']
+
+# Products tclean needs to continue a clean without regridding.
+RECLEAN_EXTS = ['.psf', '.residual', '.model', '.sumwt']
+
+
+def stage_outputs(taskname, params):
+
+    """
+    This function returns the list of products written by the task
+    taskname when called with the parameters params. For tclean this
+    includes the *.tt0, *.tt1, ... images written for nterms>1.
+    """
+
+    if taskname not in TASK_OUTPUTS:
+        raise ValueError("Don't know the outputs of task " + taskname)
+
+    output = params[TASK_OUTPUTS[taskname]]
+
+    if taskname == 'uvcontsub':
+        return [output + '.contsub']
+
+    if taskname == 'tclean':
+        outputs = [output + ext for ext in IMAGE_EXTS]
+        if params.get('deconvolver') == 'mtmfs':
+            for term in range(params.get('nterms', 2)):
+                for ext in ['.image', '.model', '.image.pbcor', '.psf',
+                            '.residual', '.sumwt', '.weight']:
+                    outputs.append(output + ext + '.tt%d' % term)
+            outputs.extend([output + '.alpha', output + '.alpha.error'])
+        return outputs
+
+    return [output]
+
+
+def stage_inputs(params):
+
+    """
+    This function returns the list of input measurement sets given in
+    the vis parameter of a task (a single ms or a list of ms).
+    """
+
+    vis = params.get('vis', [])
+    if isinstance(vis, str):
+        vis = [vis]
+
+    return [v for v in vis if v]
+
+
+def input_fingerprint(taskname, params, vis):
+
+    """
+    This function returns the fingerprint of the input measurement set
+    vis of a stage: only the subtables and the columns that taskname
+    reads with params are included, and the flags are hashed by content
+    (see ms_metadata.ms_data_fingerprint). Flagging the line channels
+    of an ms and restoring its flags, or writing columns the task
+    doesn't read (e.g., MODEL_DATA), therefore doesn't make the stage
+    out of date.
+    """
+
+    datacolumn = ''
+    if taskname in TASK_DATACOLUMN:
+        datacolumn = str(params.get('datacolumn', TASK_DATACOLUMN[taskname]))
+        if datacolumn.lower() not in ['data', 'corrected', 'model']:
+            datacolumn = ''
+
+    return ms_data_fingerprint(vis, datacolumn)
+
+
+def stage_key(taskname, params):
+
+    """
+    This function returns a hash of the task name and the full set of
+    task parameters. Parameter order doesn't matter.
+    """
+
+    text = json.dumps([STAGE_VERSION, taskname, params],
+                      sort_keys=True, default=repr)
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def stage_record_filename(taskname, params):
+
+    """
+    This function returns the name of the sidecar file that records the
+    last successful run of a stage. It sits next to the main output of
+    the stage, e.g., calibrated_final_cont.ms.stage.json.
+    """
+
+    return stage_outputs(taskname, params)[0].rstrip('/') + '.stage.json'
+
+
+def stage_is_current(taskname, **params):
+
+    """
+    This function returns True if the products of running taskname
+    with params are up to date, i.e., the stage was last run with
+    exactly the same parameters, the input measurement sets haven't
+    changed since then, and the products still exist.
+
+    Example:
+        stage_is_current('split', vis='calibrated_final.ms',
+                         outputvis='calibrated_final_cont.ms',
+                         spw='0,1,2,3', width=[256,8,8,8],
+                         datacolumn='data')
+    """
+
+    recordfile = stage_record_filename(taskname, params)
+    if not os.path.isfile(recordfile):
+        return False
+
+    with open(recordfile, 'r') as f:
+        record = json.load(f)
+
+    if record.get('key') != stage_key(taskname, params):
+        return False
+
+    for vis in stage_inputs(params):
+        if not os.path.exists(vis):
+            return False
+        if record['inputs'].get(vis) != input_fingerprint(taskname, params, vis):
+            return False
+
+    # tclean writes either .image or .image.tt0 depending on deconvolver.
+    if taskname == 'tclean':
+        imagename = params['imagename']
+        return (os.path.exists(imagename + '.image') or
+                os.path.exists(imagename + '.image.tt0'))
+
+    return all(os.path.exists(output) for output in
+               stage_outputs(taskname, params))
+
+
+def imaging_key(params):
+
+    """
+    This function returns a hash of the tclean parameters that affect
+    the psf and residual images (vis, field, spw, imsize, cell,
+    weighting, gridder, specmode, etc.), i.e., all parameters except
+    those in TCLEAN_DECONVOLUTION_PARAMS.
+    """
+
+    imagingpars = dict((key, value) for (key, value) in params.items()
+                       if key not in TCLEAN_DECONVOLUTION_PARAMS)
+
+    return stage_key('tclean-imaging', imagingpars)
+
+
+def can_reclean(params):
+
+    """
+    This function returns True if the tclean with params can be run by
+    continuing the previous clean of the same image: the previous run
+    used the same ms, with the same fingerprint, and the same imaging
+    parameters (only the parameters in TCLEAN_DECONVOLUTION_PARAMS,
+    like niter, threshold, or mask, differ), and its psf, residual,
+    model, and sumwt images still exist.
+
+    Example:
+        can_reclean({'vis': contvis, 'imagename': contimagename,
+                     'niter': 2000, 'mask': 'cont.mask', ...})
+    """
+
+    recordfile = stage_record_filename('tclean', params)
+    if not os.path.isfile(recordfile):
+        return False
+
+    with open(recordfile, 'r') as f:
+        record = json.load(f)
+
+    if record.get('imagingkey') != imaging_key(params):
+        return False
+
+    for vis in stage_inputs(params):
+        if not os.path.exists(vis):
+            return False
+        if record['inputs'].get(vis) != input_fingerprint('tclean', params, vis):
+            return False
+
+    imagename = params['imagename']
+    suffix = '' if os.path.exists(imagename + '.psf') else '.tt0'
+
+    return all(os.path.exists(imagename + ext + suffix) for ext in RECLEAN_EXTS)
+
+
+def remove_stage_outputs(taskname, params):
+
+    """
+    This function removes the products of a stage along with their
+    flag versions and the stage record, just like the rmtables and
+    'rm -rf *.flagversions' calls in the templates.
+    """
+
+    from casatasks import rmtables
+
+    for output in stage_outputs(taskname, params):
+        if os.path.exists(output):
+            rmtables(output)
+        if os.path.exists(output):
+            shutil.rmtree(output)
+        for ext in ['.flagversions', '.flagsnapshots']:
+            if os.path.exists(output + ext):
+                shutil.rmtree(output + ext)
+
+    recordfile = stage_record_filename(taskname, params)
+    if os.path.isfile(recordfile):
+        os.remove(recordfile)
+
+
+def run_stage(taskname, usecache=True, reclean=False, **params):
+
+    """
+    This function runs the CASA task taskname with params unless its
+    products are already up to date (see stage_is_current), in which
+    case the stage is skipped. Before a stage is re-run, its old
+    products are removed. After a successful run, the parameters and
+    the fingerprints of the input measurement sets are recorded in a
+    *.stage.json file next to the output. If usecache is False, the
+    old products are always removed and the stage is always re-run.
+
+    If reclean is True and only the deconvolution parameters of a
+    tclean have changed (e.g., more iterations, a lower threshold, or
+    a saved mask; see can_reclean), the old products are kept and the
+    clean is continued from the existing psf, residual, and model with
+    calcpsf=False and calcres=False. This skips the gridding for the
+    psf and the dirty image.
+
+    The input fingerprints (see input_fingerprint) are taken after the
+    task has run since some tasks (e.g., tclean with
+    savemodel='modelcolumn') write to their input ms. Any later change
+    to the data the stage reads, like new flags or a different
+    calibration, will cause the stage to be re-run.
+
+    A skipped tclean with savemodel='modelcolumn' or 'virtual' still
+    writes its model to the ms, from the existing model image with a
+    prediction-only tclean (niter=0, calcres=False, calcpsf=False), so
+    that a following gaincal doesn't use the model of another clean.
+
+    It returns the return value of the task, or None if the stage was
+    skipped.
+
+    Example:
+        run_stage('concat', vis=vislist, concatvis='calibrated.ms')
+    """
+
+    import casatasks
+
+    output = params[TASK_OUTPUTS[taskname]]
+
+    if usecache and stage_is_current(taskname, **params):
+        print("Skipping " + taskname + " for " + output +
+              ": products are up to date.")
+        if taskname == 'tclean' and params.get('savemodel', 'none') != 'none':
+            print("Saving the model of " + output + " to " + str(params['vis']))
+            savepars = dict(params)
+            savepars.update({'niter': 0, 'calcres': False, 'calcpsf': False,
+                             'restart': True, 'interactive': False})
+            casatasks.tclean(**savepars)
+        return None
+
+    runpars = dict(params)
+    if usecache and reclean and taskname == 'tclean' and can_reclean(params):
+        print("Continuing the previous clean of " + output +
+              " from its psf, residual, and model")
+        runpars.update({'calcpsf': False, 'calcres': False, 'restart': True})
+    else:
+        remove_stage_outputs(taskname, params)
+
+    print("Running " + taskname + " for " + output)
+    starttime = time.time()
+    result = getattr(casatasks, taskname)(**runpars)
+
+    if taskname != 'tclean' and not all(os.path.exists(out) for out in
+                                        stage_outputs(taskname, params)):
+        print("WARNING: " + taskname + " did not produce " + output +
+              ". Check the logger.")
+        return result
+
+    record_stage(taskname, params, time.time() - starttime)
+
+    return result
+
+
+def record_stage(taskname, params, walltime=0.0, inputs={}):
+
+    """
+    This function writes the *.stage.json record of a successful run
+    of a stage (see run_stage). The fingerprints of the input
+    measurement sets are taken now. If a stage consumes its inputs
+    (e.g., virtualconcat with keepcopy=False), pass their fingerprints
+    taken before the run in inputs instead.
+    """
+
+    if not inputs:
+        inputs = dict((vis, input_fingerprint(taskname, params, vis))
+                      for vis in stage_inputs(params))
+
+    record = {'task': taskname,
+              'key': stage_key(taskname, params),
+              'params': json.loads(json.dumps(params, default=repr)),
+              'inputs': inputs,
+              'walltime': walltime,
+              'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    if taskname == 'tclean':
+        record['imagingkey'] = imaging_key(params)
+    with open(stage_record_filename(taskname, params), 'w') as f:
+        json.dump(record, f, indent=1)
+
+
+def cached_task(taskname, usecache=True, reclean=False):
+
+    """
+    This function returns a version of the CASA task taskname that
+    removes the old products of the task before running it and skips
+    the task entirely if its products are up to date (see run_stage).
+    The returned function takes the same keyword parameters as the
+    task. If usecache is False, the task is always run. If reclean is
+    True, a tclean whose deconvolution parameters changed is continued
+    instead of re-run from scratch (see run_stage).
+
+    Example:
+        split = cached_task('split')
+        split(vis=finalvis, outputvis=contvis, spw=contspws,
+              width=[256,8,8,8], datacolumn='data')
+    """
+
+    import casatasks
+
+    def task(**params):
+        return run_stage(taskname, usecache=usecache, reclean=reclean,
+                         **params)
+
+    task.__name__ = taskname
+    task.__doc__ = getattr(casatasks, taskname).__doc__
+
+    return task
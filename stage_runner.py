@@ -0,0 +1,265 @@
+import json
+import os
+import time
+import traceback
+
+from parallel_utils import _run_job
+from stage_cache import stage_key
+
+
+def make_stage(name, func, inputs=[], outputs=[], after=[], **kwargs):
+
+    """
+    This function returns the description of a single stage for
+    run_stages. The stage runs func(**kwargs). The inputs and outputs
+    are the files (ms, images, calibration tables) that the stage
+    reads and writes. A stage depends on any other stage that writes
+    one of its inputs, and on any stage listed in after. The latter is
+    for stages that have to wait for another stage without reading its
+    outputs, e.g., because the other stage temporarily modifies a
+    shared ms.
+
+    The func argument must be defined at the top level of a module
+    (e.g., imaging_stages.py) so that the stage can be run in a
+    separate process.
+
+    Example:
+        make_stage('contsub', imaging_stages.subtract_continuum,
+                   inputs=['calibrated_final.ms'],
+                   outputs=['calibrated_final.ms.contsub'],
+                   after=['contsplit'],
+                   finalvis='calibrated_final.ms', fitspw=fitspw,
+                   linespw=linespw)
+    """
+
+    return {'name': name,
+            'func': func,
+            'inputs': list(inputs),
+            'outputs': list(outputs),
+            'after': list(after),
+            'kwargs': kwargs}
+
+
+def stage_dependencies(stages):
+
+    """
+    This function returns a dictionary mapping each stage name to the
+    set of stage names it depends on. It raises a ValueError if a stage
+    depends on an unknown stage, if two stages write the same output,
+    or if the dependencies contain a cycle.
+    """
+
+    names = [stage['name'] for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Stage names must be unique")
+
+    producers = {}
+    for stage in stages:
+        for output in stage['outputs']:
+            if output in producers:
+                raise ValueError("Both " + producers[output] + " and " +
+                                 stage['name'] + " write " + output)
+            producers[output] = stage['name']
+
+    depends = {}
+    for stage in stages:
+        deps = set(stage['after'])
+        for name in deps:
+            if name not in names:
+                raise ValueError(stage['name'] + " runs after unknown stage " + name)
+        for infile in stage['inputs']:
+            if infile in producers and producers[infile] != stage['name']:
+                deps.add(producers[infile])
+        depends[stage['name']] = deps
+
+    stage_order(stages, depends)
+
+    return depends
+
+
+def stage_order(stages, depends):
+
+    """
+    This function returns the stage names in an order in which they
+    can be run one after another. Stages keep the order in which they
+    were given unless a dependency requires otherwise. It raises a
+    ValueError if the dependencies contain a cycle.
+    """
+
+    order = []
+    remaining = [stage['name'] for stage in stages]
+    while remaining:
+        ready = [name for name in remaining if depends[name] <= set(order)]
+        if not ready:
+            raise ValueError("Stage dependencies contain a cycle: " +
+                             ', '.join(remaining))
+        order.append(ready[0])
+        remaining.remove(ready[0])
+
+    return order
+
+
+def read_checkpoint(checkpoint):
+
+    """
+    This function returns the contents of a checkpoint file written by
+    run_stages, i.e., a dictionary mapping each completed stage to its
+    key, completion date, and wall time. It returns an empty
+    dictionary if the checkpoint doesn't exist.
+    """
+
+    if not os.path.isfile(checkpoint):
+        return {}
+
+    with open(checkpoint, 'r') as f:
+        return json.load(f)
+
+
+def _write_checkpoint(checkpoint, completed):
+
+    """
+    This function atomically writes the checkpoint file so that an
+    interrupted run never leaves a partial checkpoint behind.
+    """
+
+    tmpfile = checkpoint + '.tmp'
+    with open(tmpfile, 'w') as f:
+        json.dump(completed, f, indent=1, sort_keys=True)
+    os.replace(tmpfile, checkpoint)
+
+
+def _stage_key(stage):
+
+    """
+    This function returns the key recorded in the checkpoint for a
+    stage. It changes if the function or any of the parameters of the
+    stage change.
+    """
+
+    func = stage['func']
+    return stage_key(func.__module__ + '.' + func.__name__, stage['kwargs'])
+
+
+def run_stages(stages, checkpoint='imaging_stages.checkpoint.json',
+               nprocs=1, logdir='stage_logs', restart=False):
+
+    """
+    This function runs a list of stages (see make_stage) in dependency
+    order. Each completed stage is recorded in the checkpoint file. If
+    the run crashes or is interrupted, running it again resumes at the
+    first stage that didn't complete. A stage that completed earlier
+    is re-run if its parameters have changed, if any of its outputs
+    have been removed, or if a stage it depends on is re-run. Set
+    restart=True to ignore the checkpoint and run all stages.
+
+    If nprocs is greater than 1, independent stages (e.g., continuum
+    self-calibration and continuum subtraction of the line data) are
+    run at the same time in separate processes. The CASA log of each
+    stage is then written to logdir/<stage name>.log. Do not use
+    interactive cleaning with nprocs > 1.
+
+    If a stage fails, its traceback is printed, the stages already
+    running are allowed to finish, no new stages are started, and a
+    RuntimeError is raised.
+
+    Example:
+        run_stages(stages, nprocs=2)
+    """
+
+    import concurrent.futures
+    import multiprocessing
+
+    depends = stage_dependencies(stages)
+    bystage = dict((stage['name'], stage) for stage in stages)
+
+    completed = {} if restart else read_checkpoint(checkpoint)
+
+    order = stage_order(stages, depends)
+
+    # Decide which of the previously completed stages are still valid,
+    # working through the stages in dependency order.
+    valid = set()
+    for name in order:
+        stage = bystage[name]
+        record = completed.get(name)
+        if (record and record['key'] == _stage_key(stage) and
+                depends[name] <= valid and
+                all(os.path.exists(out) for out in stage['outputs'])):
+            valid.add(name)
+            print("Skipping stage " + name + ": completed on " + record['date'])
+        else:
+            completed.pop(name, None)
+
+    # forget about stages that are no longer defined
+    for name in list(completed):
+        if name not in bystage:
+            del completed[name]
+    _write_checkpoint(checkpoint, completed)
+
+    todo = [name for name in order if name not in valid]
+    failed = []
+
+    def ready_stages(running):
+        return [name for name in todo if name not in running and
+                depends[name] <= set(completed)]
+
+    if nprocs <= 1:
+        for name in todo:
+            stage = bystage[name]
+            print("Running stage " + name)
+            starttime = time.time()
+            try:
+                stage['func'](**stage['kwargs'])
+            except Exception:
+                print("Stage " + name + " FAILED:\n" + traceback.format_exc())
+                failed.append(name)
+                break
+            completed[name] = {'key': _stage_key(stage),
+                               'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                               'walltime': time.time() - starttime}
+            _write_checkpoint(checkpoint, completed)
+    else:
+        if not os.path.isdir(logdir):
+            os.makedirs(logdir)
+
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nprocs,
+                                                    mp_context=context) as pool:
+            running = {}
+            starttimes = {}
+            while True:
+                if not failed:
+                    for name in ready_stages(running.values()):
+                        stage = bystage[name]
+                        logfile = os.path.abspath(os.path.join(logdir, name + '.log'))
+                        print("Running stage " + name + " (log: " + logfile + ")")
+                        starttimes[name] = time.time()
+                        future = pool.submit(_run_job, stage['func'],
+                                             stage['kwargs'], logfile)
+                        running[future] = name
+                if not running:
+                    break
+
+                finished, notdone = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    todo.remove(name)
+                    try:
+                        future.result()
+                    except Exception:
+                        print("Stage " + name + " FAILED:\n" +
+                              traceback.format_exc())
+                        failed.append(name)
+                        continue
+                    print("Finished stage " + name)
+                    completed[name] = {'key': _stage_key(bystage[name]),
+                                       'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                       'walltime': time.time() - starttimes[name]}
+                    _write_checkpoint(checkpoint, completed)
+
+    if failed:
+        raise RuntimeError("Stage(s) " + ', '.join(failed) + " failed. " +
+                           "Fix the problem and re-run to resume.")
+
+    return completed
@@ -0,0 +1,99 @@
+import pytest
+
+import auto_clean
+from auto_clean import (AUTO_NITER, AUTOMASK_PRESETS,
+                        HIGH_FREQ_LOWNOISETHRESHOLD, auto_clean_pars,
+                        automask_preset, autoclean_task)
+
+
+def test_autoclean_task_passes_reclean(monkeypatch):
+
+    calls = []
+
+    def run_stage(taskname, usecache=True, reclean=False, **params):
+        calls.append((taskname, usecache, reclean, params['threshold']))
+
+    monkeypatch.setattr(auto_clean, 'auto_clean_pars',
+                        lambda vis, imagename, params, nsigma, usecache:
+                        (dict(params, threshold='%gmJy' % nsigma), 1.0e-3))
+    monkeypatch.setattr(auto_clean, 'run_stage', run_stage)
+    monkeypatch.setattr(auto_clean, 'record_clean',
+                        lambda imagename, pars, result, rms: {})
+
+    autoclean_task(nsigma=3.0, usecache=True, reclean=True)(
+        vis='cont.ms', imagename='cont')
+    autoclean_task(nsigma=4.0, usecache=False)(vis='cont.ms', imagename='cont')
+
+    assert calls == [('tclean', True, True, '3mJy'),
+                     ('tclean', False, False, '4mJy')]
+
+
+def _index(array='12m', baseline_75=200.0, bands=(6,)):
+
+    """
+    This function returns a metadata index with the array, 75th
+    percentile baseline, and science spw bands the presets look at.
+    """
+
+    return {'array': array,
+            'baseline_75': baseline_75,
+            'spws': [{'id': i, 'band': band} for (i, band) in enumerate(bands)],
+            'science_spws': list(range(len(bands)))}
+
+
+def test_automask_preset_by_array_and_baselines(monkeypatch):
+
+    for (index, preset) in [(_index('7m'), '7m'),
+                            (_index('mixed'), '7m'),
+                            (_index(baseline_75=200.0), '12m-compact'),
+                            (_index(baseline_75=300.0), '12m-compact'),
+                            (_index(baseline_75=400.0), '12m-extended'),
+                            (_index(baseline_75=3000.0), '12m-extended')]:
+        monkeypatch.setattr(auto_clean, 'get_ms_index', lambda vis: index)
+        pars = automask_preset('cont.ms', specmode='cube')
+        for key in AUTOMASK_PRESETS[preset]:
+            assert pars[key] == pytest.approx(AUTOMASK_PRESETS[preset][key])
+        assert pars['usemask'] == 'auto-multithresh'
+        assert pars['fastnoise'] is False
+
+
+def test_automask_preset_interpolates_and_adjusts(monkeypatch):
+
+    compact = AUTOMASK_PRESETS['12m-compact']
+    extended = AUTOMASK_PRESETS['12m-extended']
+
+    monkeypatch.setattr(auto_clean, 'get_ms_index',
+                        lambda vis: _index(baseline_75=350.0))
+    pars = automask_preset('cont.ms')
+    assert pars['sidelobethreshold'] == pytest.approx(
+        0.5 * (compact['sidelobethreshold'] + extended['sidelobethreshold']))
+    # continuum images don't mask negative emission
+    assert pars['negativethreshold'] == 0.0
+    assert pars['fastnoise'] is True
+
+    # Bands 8-10 only
+    monkeypatch.setattr(auto_clean, 'get_ms_index',
+                        lambda vis: _index(bands=(9, 8)))
+    assert automask_preset('cont.ms')['lownoisethreshold'] == \
+        HIGH_FREQ_LOWNOISETHRESHOLD
+    monkeypatch.setattr(auto_clean, 'get_ms_index',
+                        lambda vis: _index(bands=(7, 8)))
+    assert automask_preset('cont.ms')['lownoisethreshold'] == \
+        compact['lownoisethreshold']
+
+
+def test_auto_clean_pars_threshold(monkeypatch):
+
+    monkeypatch.setattr(auto_clean, 'get_ms_index', lambda vis: _index('7m'))
+    monkeypatch.setattr(auto_clean, 'estimate_noise',
+                        lambda vis, imagename, params, usecache: 2.5e-4)
+
+    (pars, rms) = auto_clean_pars('cont.ms', 'cont',
+                                  {'niter': 1000, 'interactive': True,
+                                   'mask': 'cont.mask'}, nsigma=4.0)
+
+    assert rms == 2.5e-4
+    assert pars['threshold'] == '1mJy'
+    assert pars['niter'] == AUTO_NITER
+    assert pars['interactive'] is False
+    assert pars['usemask'] == 'auto-multithresh'
@@ -0,0 +1,43 @@
+import numpy as np
+
+from continuum_utils import channel_ranges, find_line_channels
+
+
+def test_channel_ranges():
+
+    mask = np.zeros(20, dtype=bool)
+    mask[2:6] = True
+    mask[9] = True
+    mask[15:] = True
+
+    assert channel_ranges(mask) == '2~5;9;15~19'
+    assert channel_ranges(np.zeros(5, dtype=bool)) == ''
+
+
+def test_find_line_channels_synthetic_spectrum():
+
+    rng = np.random.default_rng(1)
+    nchan = 512
+    chans = np.arange(nchan)
+    spectrum = 1.0 + 1.0e-4 * chans + rng.normal(0.0, 0.01, nchan)
+    spectrum[200:240] += 0.5  # emission line
+    spectrum[400:410] -= 0.3  # absorption line
+
+    line = find_line_channels(spectrum, nsigma=5.0, grow=0)
+
+    assert line[200:240].all()
+    assert line[400:410].all()
+    assert not line[:190].any()
+    assert not line[250:390].any()
+    assert not line[420:].any()
+
+
+def test_find_line_channels_ignores_invalid_channels():
+
+    rng = np.random.default_rng(2)
+    spectrum = 1.0 + rng.normal(0.0, 0.01, 256)
+    spectrum[100:120] += 1.0
+    valid = np.ones(256, dtype=bool)
+    valid[100:120] = False
+
+    assert not find_line_channels(spectrum, valid).any()
@@ -0,0 +1,46 @@
+import pytest
+
+import cube_utils
+from cube_utils import cube_chunks, cube_memory, cube_nchunks
+
+
+def test_cube_chunks_velocity_start():
+
+    assert cube_chunks('-100km/s', '2km/s', 100, 4) == \
+        [('-100km/s', 25), ('-50km/s', 25), ('0km/s', 25), ('50km/s', 25)]
+
+
+def test_cube_chunks_uneven_frequency_chunks():
+
+    chunks = cube_chunks('230.5GHz', '0.25GHz', 10, 3)
+
+    assert chunks == [('230.5GHz', 4), ('231.5GHz', 4), ('232.5GHz', 2)]
+    assert sum(nchan for (start, nchan) in chunks) == 10
+
+
+def test_cube_chunks_channel_start():
+
+    assert cube_chunks(10, '', 9, 3) == [(10, 3), (13, 3), (16, 3)]
+    assert cube_chunks(0, 2, 6, 2) == [(0, 3), (6, 3)]
+
+
+def test_cube_chunks_needs_explicit_grid():
+
+    with pytest.raises(ValueError):
+        cube_chunks('', '2km/s', 100, 4)
+    with pytest.raises(ValueError):
+        cube_chunks('-100km/s', '', 100, 4)
+
+
+
+def test_cube_nchunks_fit_budget(monkeypatch):
+
+    monkeypatch.setattr(cube_utils, 'available_memory', lambda: 40.0e9)
+
+    assert cube_nchunks([500, 500], 100, 4) == 4
+    nchunks = cube_nchunks([2000, 2000], 4000, 4)
+    assert nchunks > 4
+    nchan = -(-4000 // nchunks)
+    assert cube_memory([2000, 2000], nchan) <= 0.8 * 40.0e9 / 4
+    with pytest.raises(ValueError):
+        cube_nchunks([20000, 20000], 4000, 4, gridder='awproject')
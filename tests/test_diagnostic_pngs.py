@@ -0,0 +1,142 @@
+import os
+import sys
+import types
+
+import numpy as np
+import pytest
+
+import diagnostic_pngs
+from diagnostic_pngs import (compute_image_stats, get_image_stats,
+                             image_stats_filename, make_diagnostic_pngs)
+
+
+def _fake_casatools(monkeypatch, images):
+
+    """
+    This function replaces casatools by an image tool that reads the
+    (pixels, mask, axistypes) of each image name from images.
+    """
+
+    class coordsys(object):
+
+        def __init__(self, axistypes):
+            self.axistypes = axistypes
+
+        def axiscoordinatetypes(self):
+            return list(self.axistypes)
+
+    class image(object):
+
+        def open(self, imagename):
+            (self.pixels, self.mask, self.axistypes) = images[imagename]
+
+        def shape(self):
+            return list(self.pixels.shape)
+
+        def coordsys(self):
+            return coordsys(self.axistypes)
+
+        def getchunk(self, blc, trc, getmask=False):
+            region = tuple(slice(b, t + 1) for (b, t) in zip(blc, trc))
+            return (self.mask if getmask else self.pixels)[region].copy()
+
+        def close(self):
+            pass
+
+    casatools = types.ModuleType('casatools')
+    casatools.image = image
+    monkeypatch.setitem(sys.modules, 'casatools', casatools)
+
+
+def test_compute_image_stats_of_a_cube(monkeypatch):
+
+    rng = np.random.RandomState(3)
+    pixels = rng.normal(0.0, 0.01, (8, 6, 1, 5))
+    pixels[2, 3, 0, 1] = 1.0
+    pixels[4, 4, 0, 3] = np.nan
+    mask = np.ones(pixels.shape, dtype=bool)
+    mask[:, :, 0, 4] = False
+    mask[0, 0, 0, 0] = False
+    _fake_casatools(monkeypatch, {'cube.image': (
+        pixels, mask, ['Direction', 'Direction', 'Stokes', 'Spectral'])})
+
+    (stats, peakmap) = compute_image_stats('cube.image')
+
+    good = mask & np.isfinite(pixels)
+    values = pixels[good]
+    assert stats['nchan'] == 5
+    assert stats['npts'] == values.size
+    assert stats['max'] == pytest.approx(1.0)
+    assert stats['min'] == pytest.approx(values.min())
+    assert stats['mean'] == pytest.approx(values.mean())
+    assert stats['rms'] == pytest.approx(np.sqrt(np.mean(values ** 2)))
+    assert stats['chanmax'][1] == pytest.approx(1.0)
+    assert stats['chanmax'][4] is None and stats['chanrms'][4] is None
+    assert stats['noise'] == pytest.approx(np.median(stats['chanrms'][:4]))
+    assert 0.005 < stats['noise'] < 0.02
+
+    expected = np.where(good, pixels, -np.inf).max(axis=(2, 3))
+    assert peakmap.shape == (8, 6)
+    assert np.isnan(peakmap[0, 0]) == (not good[0, 0].any())
+    assert np.allclose(peakmap, expected)
+
+
+def test_compute_image_stats_without_spectral_axis(monkeypatch):
+
+    pixels = np.arange(12.0).reshape(4, 3)
+    _fake_casatools(monkeypatch, {'cont.image': (
+        pixels, np.ones((4, 3), dtype=bool), ['Direction', 'Direction'])})
+
+    (stats, peakmap) = compute_image_stats('cont.image')
+
+    assert stats['nchan'] == 1
+    assert stats['max'] == 11.0 and stats['npts'] == 12
+    assert np.array_equal(peakmap, pixels)
+
+
+def test_get_image_stats_is_cached(monkeypatch, tmp_path):
+
+    image = str(tmp_path / 'cont.image')
+    os.makedirs(image)
+    with open(os.path.join(image, 'table.f0'), 'w') as f:
+        f.write('pixels')
+    calls = []
+
+    def compute(imagename):
+        calls.append(imagename)
+        return ({'max': float(len(calls))}, np.zeros((2, 2)))
+
+    monkeypatch.setattr(diagnostic_pngs, 'compute_image_stats', compute)
+
+    assert get_image_stats(image) == {'max': 1.0}
+    assert get_image_stats(image + '/') == {'max': 1.0}
+    assert os.path.isfile(image_stats_filename(image))
+    assert os.path.isfile(image + '.peak.npy')
+    assert calls == [image]
+
+    with open(os.path.join(image, 'table.f0'), 'w') as f:
+        f.write('new pixels')
+    assert get_image_stats(image) == {'max': 2.0}
+    assert get_image_stats(image, usecache=False) == {'max': 3.0}
+
+
+def test_make_diagnostic_pngs_jobs(monkeypatch, tmp_path):
+
+    monkeypatch.chdir(tmp_path)
+    for image in ['a_mfs_manual.image', 'b_cube_manual.image',
+                  'c_cube_auto.image']:
+        os.makedirs(image)
+    jobs = {}
+
+    def run_casa_jobs(func, joblist, nprocs=4, logdir=''):
+        jobs.update(joblist)
+        return dict((jobname, {'max': 1.0}) for (jobname, pars) in joblist)
+
+    monkeypatch.setattr(diagnostic_pngs, 'run_casa_jobs', run_casa_jobs)
+
+    results = make_diagnostic_pngs()
+
+    assert sorted(jobs) == ['a_mfs_manual.image.png',
+                            'b_cube_manual.image.mom8.png']
+    assert jobs['b_cube_manual.image.mom8.png']['image'] == 'b_cube_manual.image'
+    assert sorted(results) == ['a_mfs_manual.image', 'b_cube_manual.image']
@@ -0,0 +1,133 @@
+import os
+import sys
+import types
+
+import pytest
+
+import fits_export
+from fits_export import (_fits_header, export_fits, export_image,
+                         fits_filename, fits_is_current)
+
+
+def _write_fits(fitsimage, cards):
+
+    """
+    This function writes a FITS file with the primary header cards
+    (a list of (key, value) pairs) and a single block of data.
+    """
+
+    header = ''.join(('%-8s= %20s' % (key, value)).ljust(80)
+                     for (key, value) in cards)
+    header += 'END'.ljust(80)
+    header = header.ljust(2880 * (len(header) // 2880 + 1))
+    with open(fitsimage, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(b'\0' * 2880)
+
+
+def _make_image(image, mtime):
+
+    """
+    This function makes a fake CASA image directory with its files
+    modified at mtime.
+    """
+
+    os.makedirs(os.path.join(image, 'logtable'))
+    for name in ['table.dat', 'table.f0', 'table.lock', 'logtable/table.dat',
+                 'logtable', '']:
+        filepath = os.path.join(image, name)
+        if not os.path.exists(filepath):
+            open(filepath, 'w').close()
+        os.utime(filepath, (mtime, mtime))
+
+
+def test_fits_header_and_filename(tmp_path):
+
+    fitsimage = str(tmp_path / 'cont.fits')
+    _write_fits(fitsimage, [('SIMPLE', 'T'), ('BITPIX', 16),
+                            ('BSCALE', '1.5E-05'), ('BUNIT', "'Jy/beam'")])
+
+    header = _fits_header(fitsimage)
+
+    assert header == {'SIMPLE': 'T', 'BITPIX': '16', 'BSCALE': '1.5E-05',
+                      'BUNIT': 'Jy/beam'}
+    assert fits_filename('cont.image.pbcor') == 'cont.image.pbcor.fits'
+    assert fits_filename('cont.pb', 'RICE_1') == 'cont.pb.fits.fz'
+
+
+def test_fits_is_current(tmp_path):
+
+    image = str(tmp_path / 'cont.image.pbcor')
+    fitsimage = image + '.fits'
+    _make_image(image, 1000.0)
+    assert not fits_is_current(image, fitsimage)
+
+    _write_fits(fitsimage, [('SIMPLE', 'T')])
+    os.utime(fitsimage, (2000.0, 2000.0))
+    assert fits_is_current(image, fitsimage)
+
+    # opening the image touches its lock file only
+    os.utime(os.path.join(image, 'table.lock'), (3000.0, 3000.0))
+    assert fits_is_current(image, fitsimage)
+
+    os.utime(os.path.join(image, 'logtable', 'table.dat'), (3000.0, 3000.0))
+    assert not fits_is_current(image, fitsimage)
+
+
+def test_export_fits_keeps_primary_beams_lossless(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    for image in ['cont.image.pbcor', 'cont.pb', 'line.image.pbcor', 'line.pb']:
+        _make_image(image, 1000.0)
+    _write_fits('line.image.pbcor.fits.fz', [('SIMPLE', 'T')])
+    os.utime('line.image.pbcor.fits.fz', (2000.0, 2000.0))
+
+    jobs = {}
+
+    def run_casa_jobs(func, joblist, nprocs=4, logdir=''):
+        jobs.update(joblist)
+        return dict((jobname, {'fitsimage': pars['fitsimage'], 'size': 0,
+                               'errorbound': 0.0})
+                    for (jobname, pars) in joblist)
+
+    monkeypatch.setattr(fits_export, 'run_casa_jobs', run_casa_jobs)
+
+    export_fits(compress='RICE_1', quantize_level=8.0)
+
+    assert sorted(jobs) == ['cont.image.pbcor', 'cont.pb', 'line.pb']
+    assert jobs['cont.image.pbcor']['compress'] == 'RICE_1'
+    assert jobs['cont.image.pbcor']['quantize_level'] == 8.0
+    for pb in ['cont.pb', 'line.pb']:
+        assert jobs[pb]['compress'] == 'GZIP_2'
+        assert jobs[pb]['quantize_level'] == 0.0
+        assert jobs[pb]['fitsimage'] == pb + '.fits.fz'
+
+    jobs.clear()
+    export_fits(bitpix=16, overwrite=True)
+    assert len(jobs) == 4
+    assert jobs['cont.image.pbcor']['bitpix'] == 16
+    assert jobs['cont.pb']['bitpix'] == -32
+
+
+def test_export_image_16bit_error_bound(tmp_path, monkeypatch):
+
+    def exportfits(imagename, fitsimage, bitpix, overwrite):
+        _write_fits(fitsimage, [('SIMPLE', 'T'), ('BITPIX', bitpix),
+                                ('BSCALE', '2.0E-06')])
+
+    casatasks = types.ModuleType('casatasks')
+    casatasks.exportfits = exportfits
+    monkeypatch.setitem(sys.modules, 'casatasks', casatasks)
+    image = str(tmp_path / 'cont.image.pbcor')
+
+    result = export_image(image, bitpix=16)
+
+    assert result['fitsimage'] == image + '.fits'
+    assert result['errorbound'] == pytest.approx(1.0e-6)
+    assert result['size'] == 2 * 2880
+    assert os.listdir(str(tmp_path)) == ['cont.image.pbcor.fits']
+
+    with pytest.raises(ValueError):
+        export_image(image, compress='LZW')
+    with pytest.raises(ValueError):
+        export_image(image, bitpix=8)
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+import flag_snapshots
+from flag_snapshots import _decode_runs, _encode_runs, restore_flags, save_flags
+
+
+def test_runs_round_trip():
+
+    rng = np.random.RandomState(1)
+    for diff in [np.zeros(100, dtype=bool), np.ones(100, dtype=bool),
+                 rng.rand(1000) < 0.01, rng.rand(1000) < 0.5,
+                 np.array([True]), np.array([], dtype=bool)]:
+        assert np.array_equal(_decode_runs(_encode_runs(diff), len(diff)), diff)
+
+
+def test_runs_are_compact():
+
+    diff = np.zeros(100000, dtype=bool)
+    diff[500:1500] = True
+
+    assert list(_encode_runs(diff)) == [500, 1500]
+
+
+def _fake_ms(monkeypatch, chunks):
+
+    """
+    This function replaces the FLAG column access of flag_snapshots by
+    the dictionary chunks, which restore_flags writes back to.
+    """
+
+    def read_flags(vis, chunksize):
+        for key in sorted(chunks):
+            yield (key, chunks[key].copy())
+
+    def write_flags(vis, chunkflags, chunksize):
+        for key in sorted(chunks):
+            chunks[key] = chunkflags(key, len(chunks[key]))
+
+    monkeypatch.setattr(flag_snapshots, '_read_flags', read_flags)
+    monkeypatch.setattr(flag_snapshots, '_write_flags', write_flags)
+
+
+def test_save_and_restore(monkeypatch, tmp_path):
+
+    rng = np.random.RandomState(2)
+    chunks = {'dd0_row0': rng.rand(4000) < 0.1, 'dd1_row0': rng.rand(250) < 0.1}
+    original = dict((key, flags.copy()) for (key, flags) in chunks.items())
+    _fake_ms(monkeypatch, chunks)
+    vis = str(tmp_path / 'test.ms')
+
+    save_flags(vis, 'original')
+    chunks['dd0_row0'][100:900] = True
+    chunks['dd1_row0'][:] = False
+    changed = dict((key, flags.copy()) for (key, flags) in chunks.items())
+    save_flags(vis, 'changed')
+
+    restore_flags(vis, 'original')
+    for key in original:
+        assert np.array_equal(chunks[key], original[key])
+
+    restore_flags(vis, 'changed')
+    for key in changed:
+        assert np.array_equal(chunks[key], changed[key])
+
+
+def test_save_rejects_changed_rows(monkeypatch, tmp_path):
+
+    chunks = {'dd0_row0': np.zeros(100, dtype=bool)}
+    _fake_ms(monkeypatch, chunks)
+    vis = str(tmp_path / 'test.ms')
+    save_flags(vis, 'original')
+
+    chunks['dd0_row0'] = np.zeros(120, dtype=bool)
+    with pytest.raises(ValueError):
+        save_flags(vis, 'changed')
+    assert not (tmp_path / 'test.ms.flagsnapshots' / 'changed.npz').exists()
+    assert not (tmp_path / 'test.ms.flagsnapshots' / 'changed.npz.tmp').exists()
+
+
+def test_base_name_is_reserved(monkeypatch, tmp_path):
+
+    chunks = {'dd0_row0': np.zeros(100, dtype=bool)}
+    _fake_ms(monkeypatch, chunks)
+    vis = str(tmp_path / 'test.ms')
+
+    with pytest.raises(ValueError):
+        save_flags(vis, 'base')
+    assert not (tmp_path / 'test.ms.flagsnapshots' / 'base.npz').exists()
+
+    save_flags(vis, 'original')
+    chunks['dd0_row0'][10:20] = True
+    with pytest.raises(ValueError):
+        save_flags(vis, 'base')
+
+    restore_flags(vis, 'original')
+    assert not chunks['dd0_row0'].any()
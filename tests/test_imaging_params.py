@@ -0,0 +1,81 @@
+import pytest
+
+import imaging_params
+from imaging_params import _round_down, fft_size, pick_cell_imsize
+
+
+def _is_smooth(n):
+
+    for factor in (2, 3, 5):
+        while n % factor == 0:
+            n //= factor
+
+    return n == 1
+
+
+def test_fft_size_examples():
+
+    assert fft_size(1001) == 1024
+    assert fft_size(130) == 144
+    assert fft_size(128) == 128
+    assert fft_size(1) == 2
+
+
+def test_fft_size_is_smallest_even_smooth_size():
+
+    for n in range(2, 3000, 7):
+        size = fft_size(n)
+        assert size >= n
+        assert size % 2 == 0
+        assert _is_smooth(size)
+        assert not any(m % 2 == 0 and _is_smooth(m) for m in range(n, size))
+
+
+def test_round_down_never_rounds_up():
+
+    assert _round_down(0.1289) == 0.12
+    assert _round_down(0.12) == 0.12
+    assert _round_down(0.0996) == 0.099
+    assert _round_down(1.95) == 1.9
+    for value in (0.0123456, 0.456, 3.1415, 27.99):
+        assert _round_down(value) <= value
+
+
+def _fake_ms(monkeypatch, maxuv):
+
+    """
+    This function replaces the metadata index of imaging_params by a
+    single 12m field observed in spws 0 and 1 at 100 GHz, and the
+    longest projected baselines by maxuv.
+    """
+
+    index = {'array': '12m',
+             'spws': [{'id': 0, 'meanfreq': 100.0e9, 'bandwidth': 2.0e9},
+                      {'id': 1, 'meanfreq': 100.0e9, 'bandwidth': 2.0e9}],
+             'fields': [{'id': 0, 'ra': 1.0, 'dec': -0.5}],
+             'target_fields': [0]}
+
+    monkeypatch.setattr(imaging_params, 'get_ms_index', lambda vis: index)
+    monkeypatch.setattr(imaging_params, 'max_uv_distance',
+                        lambda vis, spws='', field='': dict(maxuv))
+
+
+def test_pick_cell_imsize_skips_spws_without_data(monkeypatch):
+
+    _fake_ms(monkeypatch, {0: 0.0, 1: 206265.0})
+
+    (cell, imsize) = pick_cell_imsize('calibrated_final.ms')
+
+    assert cell == '0.2arcsec'
+    assert imsize[0] == imsize[1] == fft_size(6300 / 99.0 / 0.2)
+
+
+def test_pick_cell_imsize_without_data(monkeypatch):
+
+    _fake_ms(monkeypatch, {0: 0.0, 1: 0.0})
+    with pytest.raises(ValueError):
+        pick_cell_imsize('calibrated_final.ms', spws='0,1')
+
+    _fake_ms(monkeypatch, {})
+    with pytest.raises(ValueError):
+        pick_cell_imsize('calibrated_final.ms')
@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+
+import mosaic_utils
+from imaging_params import fft_size
+from mosaic_utils import (_beam_matrix, combine_tiles, common_beam,
+                          mosaic_tiles, primary_beam_fwhm)
+
+ARCSEC = np.pi / 180 / 3600
+
+
+def _fake_mosaic(monkeypatch, nx, ny, spacing):
+
+    """
+    This function replaces the metadata index of mosaic_utils by an
+    nx x ny grid of pointings spaced by spacing primary beam FWHMs
+    around ra=dec=0, and the angle conversion by one that only knows
+    arcsec. It returns the index.
+    """
+
+    index = {'spws': [{'id': 0, 'meanfreq': 100.0e9}],
+             'science_spws': [0],
+             'antennas': [{'diameter': 12.0}, {'diameter': 7.0}],
+             'fields': []}
+    fwhm = primary_beam_fwhm(index)
+    for j in range(ny):
+        for i in range(nx):
+            index['fields'].append({'id': len(index['fields']),
+                                    'name': 'mosaic',
+                                    'ra': i * spacing * fwhm,
+                                    'dec': j * spacing * fwhm})
+
+    monkeypatch.setattr(mosaic_utils, 'get_ms_index', lambda vis: index)
+    monkeypatch.setattr(mosaic_utils, '_to_rad',
+                        lambda angle: float(angle.replace('arcsec', '')) * ARCSEC)
+
+    return index
+
+
+def test_primary_beam_uses_smallest_antenna():
+
+    index = {'spws': [{'id': 0, 'meanfreq': 100.0e9},
+                      {'id': 1, 'meanfreq': 1.0e9}],
+             'science_spws': [0],
+             'antennas': [{'diameter': 12.0}, {'diameter': 7.0}]}
+
+    assert primary_beam_fwhm(index) == pytest.approx(1.13 * 299792458.0 /
+                                                     100.0e9 / 7.0)
+
+
+def test_mosaic_tiles_cover_the_pointings(monkeypatch):
+
+    index = _fake_mosaic(monkeypatch, 6, 4, 0.5)
+    fwhm = primary_beam_fwhm(index)
+    cell = 1.0
+    margin = 0.25
+
+    tiles = mosaic_tiles('mosaic.ms', '0~23', {'cell': ['%garcsec' % cell]},
+                         ntiles=(3, 2), margin=margin)
+
+    assert len(tiles) == 6
+    fieldcount = np.zeros(len(index['fields']), dtype=int)
+    for tile in tiles:
+        ids = [int(f) for f in tile['field'].split(',')]
+        fieldcount[ids] += 1
+        (frame, ra, dec) = tile['phasecenter'].split()
+        (ra, dec) = (float(ra.replace('rad', '')), float(dec.replace('rad', '')))
+        assert frame == 'J2000'
+        for f in ids:
+            # each pointing and a primary beam FWHM around it is in the image
+            x = abs(index['fields'][f]['ra'] - ra) + fwhm
+            y = abs(index['fields'][f]['dec'] - dec) + fwhm
+            assert x <= tile['imsize'][0] / 2 * cell * ARCSEC
+            assert y <= tile['imsize'][1] / 2 * cell * ARCSEC
+        assert [fft_size(n) for n in tile['imsize']] == tile['imsize']
+
+    # every pointing is imaged, and the pointings on the tile boundaries
+    # are shared by neighboring tiles
+    assert fieldcount.min() >= 1
+    assert fieldcount.max() > 1
+    assert all(len(tile['field'].split(',')) < len(index['fields'])
+               for tile in tiles)
+
+
+def test_mosaic_tiles_wide_margin_images_everything(monkeypatch):
+
+    index = _fake_mosaic(monkeypatch, 3, 3, 0.5)
+
+    tiles = mosaic_tiles('mosaic.ms', '0~8', {'cell': '2arcsec'},
+                         ntiles=(2, 2), margin=1.0)
+
+    assert len(tiles) == 4
+    assert all(tile['field'] == '0,1,2,3,4,5,6,7,8' for tile in tiles)
+
+    with pytest.raises(ValueError):
+        mosaic_tiles('mosaic.ms', '100', {'cell': '2arcsec'})
+
+
+def test_combine_tiles_recovers_the_sky():
+
+    (y, x) = np.mgrid[0:64, 0:96].astype(float)
+    sky = np.zeros((64, 96))
+    sky[20, 30] = 1.0
+    sky[40, 50:70] = 0.5
+
+    pbs = []
+    for xc in [30.0, 65.0]:
+        pb = np.exp(-((x - xc) ** 2 + (y - 32.0) ** 2) / (2 * 15.0 ** 2))
+        pbs.append(np.where(pb >= 0.2, pb, 0.0))
+    images = [pb * sky for pb in pbs]
+
+    (pbcor, pbout) = combine_tiles(images, pbs)
+
+    covered = (pbs[0] > 0) | (pbs[1] > 0)
+    assert np.allclose(pbcor[covered], sky[covered])
+    assert np.all(pbcor[~covered] == 0) and np.all(pbout[~covered] == 0)
+    assert np.allclose(pbout[covered],
+                       (pbs[0] ** 2 + pbs[1] ** 2)[covered] /
+                       (pbs[0] + pbs[1])[covered])
+    # where only one tile has weight, the mosaic is that tile
+    only = (pbs[0] > 0) & (pbs[1] == 0)
+    assert np.allclose(pbout[only], pbs[0][only])
+    assert np.allclose((pbcor * pbout)[only], images[0][only])
+
+
+def test_common_beam_encloses_all_beams():
+
+    beams = [(1.0, 0.5, 0.0), (1.0, 0.5, 90.0), (0.8, 0.7, 45.0)]
+
+    common = common_beam(beams)
+
+    for beam in beams:
+        values = np.linalg.eigvalsh(_beam_matrix(common) - _beam_matrix(beam))
+        assert values.min() >= -1e-9
+    # the smallest enclosing beam is round with a FWHM of 1
+    assert common[0] * common[1] <= 1.05
+
+
+def test_common_beam_of_enclosed_beams():
+
+    assert common_beam([(0.6, 0.4, 30.0)] * 3) == \
+        pytest.approx((0.6, 0.4, 30.0))
+    assert common_beam([(0.5, 0.3, -60.0), (0.6, 0.4, -60.0),
+                        (0.4, 0.35, 10.0)]) == \
+        pytest.approx((0.6, 0.4, -60.0))
+    assert common_beam([(0.6, 0.4, 90.0)]) == pytest.approx((0.6, 0.4, 90.0))
@@ -0,0 +1,87 @@
+import pytest
+
+import ms_metadata
+from ms_metadata import line_spwmap, match_executions
+
+
+def _spw(spwid, freq):
+
+    """
+    This function returns the index entry of a 100 channel spw starting
+    at freq.
+    """
+
+    return {'id': spwid, 'chanfreq0': freq, 'chanwidth': 1.0e6, 'nchan': 100}
+
+
+def _index(vis, observations, spws):
+
+    """
+    This function returns a metadata index with the entries used by
+    line_spwmap, with all spws as target spws.
+    """
+
+    return {'vis': vis, 'observations': observations, 'spws': spws,
+            'target_spws': [spw['id'] for spw in spws],
+            'spwmap': ms_metadata.combined_spwmap(
+                {'observations': observations, 'spws': spws,
+                 'target_spws': [spw['id'] for spw in spws]})}
+
+
+# Two executions of the same project. The continuum ms has both
+# executions with four spws each; the line ms only has the second
+# execution, which split renumbered as observation 0, with one spw.
+CONT = _index('cont.ms',
+              [{'id': 0, 'spws': [0, 1, 2, 3], 'project': 'uid://A',
+                'timerange': [100.0, 200.0]},
+               {'id': 1, 'spws': [4, 5, 6, 7], 'project': 'uid://A',
+                'timerange': [300.0, 400.0]}],
+              [_spw(0, 230e9), _spw(1, 232e9), _spw(2, 245e9), _spw(3, 247e9),
+               _spw(4, 230e9), _spw(5, 232e9), _spw(6, 245e9), _spw(7, 247e9)])
+
+
+def test_match_executions_by_time_range():
+
+    line = _index('line.ms',
+                  [{'id': 0, 'spws': [0], 'project': 'uid://A',
+                    'timerange': [300.0, 400.0]}],
+                  [_spw(0, 245.02e9)])
+
+    assert match_executions(line, CONT) == {0: 1}
+
+
+def test_match_executions_needs_the_same_project():
+
+    line = _index('line.ms',
+                  [{'id': 0, 'spws': [0], 'project': 'uid://B',
+                    'timerange': [300.0, 400.0]}],
+                  [_spw(0, 245.02e9)])
+
+    with pytest.raises(ValueError):
+        match_executions(line, CONT)
+
+
+def test_line_spwmap(monkeypatch):
+
+    line = _index('line.ms',
+                  [{'id': 0, 'spws': [0, 1], 'project': 'uid://A',
+                    'timerange': [300.0, 400.0]}],
+                  [_spw(0, 245.02e9), _spw(1, 232.05e9)])
+    indexes = {'line.ms': line, 'cont.ms': CONT}
+    monkeypatch.setattr(ms_metadata, 'get_ms_index', lambda vis: indexes[vis])
+
+    assert line_spwmap('line.ms', 'cont.ms') == [4, 4]
+
+
+def test_line_spwmap_checks_every_spw(monkeypatch):
+
+    # the second spw doesn't overlap any spw of the continuum execution
+    line = _index('line.ms',
+                  [{'id': 0, 'spws': [0, 1], 'project': 'uid://A',
+                    'timerange': [300.0, 400.0]}],
+                  [_spw(0, 245.02e9), _spw(1, 260.0e9)])
+    indexes = {'line.ms': line, 'cont.ms': CONT}
+    monkeypatch.setattr(ms_metadata, 'get_ms_index', lambda vis: indexes[vis])
+
+    with pytest.raises(ValueError):
+        line_spwmap('line.ms', 'cont.ms')
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from parallel_utils import run_casa_jobs
+
+# A stand-in for casatasks in the worker processes: its casalog writes
+# the name of the log file of each job to that file.
+FAKE_CASATASKS = '''
+class casalog(object):
+
+    @staticmethod
+    def setlogfile(logfile):
+        with open(logfile, 'w') as f:
+            f.write(logfile)
+'''
+
+
+def square(x):
+
+    """
+    This function is a job that returns x squared, or raises a
+    ValueError for negative x.
+    """
+
+    if x < 0:
+        raise ValueError("negative")
+    return x * x
+
+
+def test_run_casa_jobs_serial():
+
+    joblist = [('job%d' % x, {'x': x}) for x in range(3)]
+
+    assert run_casa_jobs(square, joblist, nprocs=1) == \
+        {'job0': 0, 'job1': 1, 'job2': 4}
+    with pytest.raises(ValueError):
+        run_casa_jobs(square, [('bad', {'x': -1})], nprocs=1)
+
+
+def test_run_casa_jobs_in_processes(tmp_path, monkeypatch):
+
+    (tmp_path / 'casatasks.py').write_text(FAKE_CASATASKS)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    logdir = str(tmp_path / 'logs')
+
+    results = run_casa_jobs(square, [('job%d' % x, {'x': x}) for x in range(4)],
+                            nprocs=2, logdir=logdir)
+
+    assert results == {'job0': 0, 'job1': 1, 'job2': 4, 'job3': 9}
+    assert sorted(os.listdir(logdir)) == ['job%d.log' % x for x in range(4)]
+
+    # the other jobs still run when one fails
+    with pytest.raises(RuntimeError) as err:
+        run_casa_jobs(square, [('bad', {'x': -1}), ('good', {'x': 5})],
+                      nprocs=2, logdir=logdir)
+    assert 'bad' in str(err.value) and 'good' not in str(err.value)
+    assert os.path.isfile(os.path.join(logdir, 'good.log'))
@@ -0,0 +1,98 @@
+import pytest
+
+import cube_utils
+import mosaic_utils
+import resource_planner
+from cube_utils import GRID_PADDING, GRIDDER_CFCACHE, cube_memory, cube_nchunks
+from resource_planner import _mfs_memory, plan_tclean
+
+ARCSEC = 3.141592653589793 / 180 / 3600
+
+
+@pytest.fixture
+def machine(monkeypatch):
+
+    """
+    This fixture replaces the metadata index of resource_planner by a
+    12m ms with four 100 GHz spws of 1920 and 128 channels, and sets
+    the available memory to 10 GB.
+    """
+
+    index = {'nrows': 1000000,
+             'spws': [{'id': i, 'nchan': nchan, 'meanfreq': 100.0e9}
+                      for (i, nchan) in enumerate([1920, 128, 128, 128])],
+             'science_spws': [0, 1, 2, 3],
+             'antennas': [{'diameter': 12.0}]}
+
+    monkeypatch.setattr(resource_planner, 'get_ms_index', lambda vis: index)
+    monkeypatch.setattr(resource_planner, 'available_memory', lambda: 10.0e9)
+    monkeypatch.setattr(cube_utils, 'available_memory', lambda: 10.0e9)
+    monkeypatch.setattr(mosaic_utils, '_to_rad',
+                        lambda angle: float(angle.replace('arcsec', '')) * ARCSEC)
+
+    return index
+
+
+def test_mfs_memory_model():
+
+    npix = 1000 * 1000
+    gridpix = npix * GRID_PADDING ** 2
+
+    # hogbom: image planes and one complex grid and FFT plane
+    assert _mfs_memory([1000, 1000], 1, 'standard') == \
+        pytest.approx(4.0 * npix * 8 + 8.0 * gridpix * 2)
+    assert _mfs_memory([1000, 1000], 2, 'standard') > \
+        _mfs_memory([1000, 1000], 1, 'standard')
+    assert _mfs_memory([1000, 1000], 1, 'mosaic') - \
+        _mfs_memory([1000, 1000], 1, 'standard') == GRIDDER_CFCACHE['mosaic']
+
+
+def test_plan_mfs(machine):
+
+    plan = plan_tclean('cont.ms', {'imsize': [1000, 1000], 'niter': 1000,
+                                   'weighting': 'briggs'}, ncores=4)
+
+    # mfs doesn't grid the weight density per channel by default
+    assert plan['memory'] == _mfs_memory([1000, 1000], 1, 'standard')
+    assert plan['njobs'] == min(4, int(0.8 * 10.0e9 // plan['memory']))
+    assert plan['disk'] == 4.0 * 1000 * 1000 * resource_planner.PRODUCT_PLANES
+    assert plan['runtime'] > 0
+
+    perchan = plan_tclean('cont.ms', {'imsize': [1000, 1000],
+                                      'weighting': 'briggs',
+                                      'perchanweightdensity': True})
+    assert perchan['memory'] == pytest.approx(
+        plan['memory'] + 4.0 * 1000 * 1000 * GRID_PADDING ** 2)
+
+
+def test_plan_cube_uses_cube_memory(machine):
+
+    plan = plan_tclean('line.ms', {'imsize': [500, 500], 'specmode': 'cube',
+                                   'spw': '1', 'weighting': 'briggs'},
+                       ncores=4)
+    assert plan['memory'] == cube_memory([500, 500], 128)
+    assert plan['nchunks'] == 1
+
+    # a cube that doesn't fit gets the chunks image_line_cube_chunked
+    # would use
+    plan = plan_tclean('line.ms', {'imsize': [2000, 2000], 'specmode': 'cube',
+                                   'spw': '0', 'gridder': 'mosaic',
+                                   'weighting': 'natural'}, ncores=4)
+    assert plan['memory'] == cube_memory([2000, 2000], 1920, gridder='mosaic',
+                                         perchanweightdensity=False)
+    assert plan['njobs'] == 0
+    assert plan['nchunks'] == cube_nchunks([2000, 2000], 1920, 4,
+                                           gridder='mosaic',
+                                           perchanweightdensity=False)
+    assert 'nchunks=%d' % plan['nchunks'] in plan['recommendation']
+
+
+def test_plan_mosaic_tiles_fit(machine):
+
+    plan = plan_tclean('cont.ms', {'imsize': [30000, 30000], 'cell': '0.1arcsec',
+                                   'gridder': 'mosaic'}, ncores=4)
+
+    (ntiles, ntiles2) = plan['ntiles']
+    assert ntiles == ntiles2 and ntiles > 1
+    assert plan['memory'] > 0.8 * 10.0e9
+    assert 'ntiles=(%d,%d)' % (ntiles, ntiles) in plan['recommendation']
@@ -0,0 +1,23 @@
+import selfcal
+from selfcal import write_callib
+
+
+def test_write_callib_one_entry_per_execution(monkeypatch, tmp_path):
+
+    monkeypatch.setattr(selfcal, 'get_ms_index', lambda vis: {
+        'observations': [{'id': 0}, {'id': 1}, {'id': 2}]})
+    callibfile = str(tmp_path / 'test.callib')
+
+    write_callib(callibfile, 'test.ms', ['pcal3', 'apcal'], [0, 0, 0, 0],
+                 field='0', obsmap={2: 1})
+
+    with open(callibfile) as f:
+        lines = f.read().splitlines()
+
+    assert lines == [
+        "field='0' obs='0' caltable='pcal3' calwt=False tinterp='linear' spwmap=[0,0,0,0] obsmap=[0]",
+        "field='0' obs='1' caltable='pcal3' calwt=False tinterp='linear' spwmap=[0,0,0,0] obsmap=[0,1]",
+        "field='0' obs='2' caltable='pcal3' calwt=False tinterp='linear' spwmap=[0,0,0,0] obsmap=[0,1,1]",
+        "field='0' obs='0' caltable='apcal' calwt=False tinterp='linear' spwmap=[0,0,0,0] obsmap=[0]",
+        "field='0' obs='1' caltable='apcal' calwt=False tinterp='linear' spwmap=[0,0,0,0] obsmap=[0,1]",
+        "field='0' obs='2' caltable='apcal' calwt=False tinterp='linear' spwmap=[0,0,0,0] obsmap=[0,1,1]"]
@@ -0,0 +1,202 @@
+import os
+import shutil
+import sys
+import types
+
+import pytest
+
+import ms_metadata
+from stage_cache import (can_reclean, input_fingerprint, run_stage,
+                         stage_is_current, stage_key, stage_outputs)
+
+# Data files of the columns of the fake ms (see _make_ms).
+COLUMN_FILES = {'FLAG': ['table.f1_TSM0'],
+                'FLAG_ROW': ['table.f0'],
+                'TIME': ['table.f0'],
+                'DATA': ['table.f2_TSM0'],
+                'CORRECTED_DATA': ['table.f3_TSM0'],
+                'MODEL_DATA': ['table.f4_TSM0']}
+
+
+def _write(filepath, content):
+
+    """
+    This function writes content to filepath and moves its modification
+    time forward, as a task rewriting the file would.
+    """
+
+    with open(filepath, 'w') as f:
+        f.write(content)
+    mtime = os.path.getmtime(filepath) + 10
+    os.utime(filepath, (mtime, mtime))
+
+
+def _make_ms(vis):
+
+    """
+    This function makes a fake ms directory with the data files of
+    COLUMN_FILES and a SPECTRAL_WINDOW and HISTORY subtable.
+    """
+
+    os.makedirs(os.path.join(vis, 'SPECTRAL_WINDOW'))
+    os.makedirs(os.path.join(vis, 'HISTORY'))
+    _write(os.path.join(vis, 'table.dat'), 'main')
+    for filename in set(sum(COLUMN_FILES.values(), [])):
+        _write(os.path.join(vis, filename), filename)
+    _write(os.path.join(vis, 'SPECTRAL_WINDOW', 'table.f0'), 'spws')
+    _write(os.path.join(vis, 'HISTORY', 'table.f0'), 'history')
+
+
+@pytest.fixture
+def casa(monkeypatch, tmp_path):
+
+    """
+    This fixture replaces casatasks by a split that copies its input
+    and a tclean that writes empty products, both of which count their
+    runs, and the column lookup of the ms by COLUMN_FILES. It returns
+    the list of split outputs and tclean parameters.
+    """
+
+    calls = []
+
+    def split(vis, outputvis, **kwargs):
+        calls.append(outputvis)
+        shutil.copytree(vis, outputvis)
+
+    def tclean(vis, imagename, **kwargs):
+        calls.append(kwargs)
+        for ext in ['.image', '.psf', '.residual', '.model', '.sumwt', '.pb']:
+            if not os.path.exists(imagename + ext):
+                os.makedirs(imagename + ext)
+
+    def rmtables(tablename):
+        if os.path.exists(tablename):
+            shutil.rmtree(tablename)
+
+    casatasks = types.ModuleType('casatasks')
+    casatasks.split = split
+    casatasks.tclean = tclean
+    casatasks.rmtables = rmtables
+    monkeypatch.setitem(sys.modules, 'casatasks', casatasks)
+    monkeypatch.setattr(ms_metadata, '_column_files',
+                        lambda vis: dict(COLUMN_FILES))
+    monkeypatch.chdir(tmp_path)
+
+    return calls
+
+
+SPLITPARS = {'vis': 'calibrated_final.ms',
+             'outputvis': 'calibrated_final_cont.ms',
+             'spw': '0,1,2,3', 'width': [256, 8, 8, 8],
+             'datacolumn': 'data'}
+
+
+def test_split_rerun_is_skipped(casa):
+
+    _make_ms('calibrated_final.ms')
+    run_stage('split', **SPLITPARS)
+    assert casa == ['calibrated_final_cont.ms']
+
+    # flag the line channels and restore the flags, as the template does
+    # around the split, and write columns and subtables the split
+    # doesn't read.
+    _write('calibrated_final.ms/table.f1_TSM0', 'line flags')
+    _write('calibrated_final.ms/table.f1_TSM0', 'table.f1_TSM0')
+    _write('calibrated_final.ms/table.f0', 'table.f0')
+    _write('calibrated_final.ms/table.f3_TSM0', 'applycal')
+    _write('calibrated_final.ms/table.f4_TSM0', 'model')
+    _write('calibrated_final.ms/HISTORY/table.f0', 'more history')
+
+    assert stage_is_current('split', **SPLITPARS)
+    run_stage('split', **SPLITPARS)
+    assert casa == ['calibrated_final_cont.ms']
+
+
+def test_split_reruns_when_its_inputs_change(casa):
+
+    _make_ms('calibrated_final.ms')
+    run_stage('split', **SPLITPARS)
+
+    _write('calibrated_final.ms/table.f1_TSM0', 'new flags')
+    run_stage('split', **SPLITPARS)
+    assert len(casa) == 2
+
+    _write('calibrated_final.ms/table.f2_TSM0', 'table.f2_TSM0')
+    run_stage('split', **SPLITPARS)
+    assert len(casa) == 3
+
+    run_stage('split', **dict(SPLITPARS, width=[128, 8, 8, 8]))
+    assert len(casa) == 4
+
+    run_stage('split', usecache=False, **SPLITPARS)
+    assert len(casa) == 5
+
+
+def test_input_fingerprint_follows_datacolumn(casa):
+
+    _make_ms('calibrated_final.ms')
+    data = input_fingerprint('split', SPLITPARS, 'calibrated_final.ms')
+    corrected = input_fingerprint('split', dict(SPLITPARS, datacolumn='corrected'),
+                                  'calibrated_final.ms')
+
+    _write('calibrated_final.ms/table.f3_TSM0', 'applycal')
+
+    assert input_fingerprint('split', SPLITPARS, 'calibrated_final.ms') == data
+    assert input_fingerprint('split', dict(SPLITPARS, datacolumn='corrected'),
+                             'calibrated_final.ms') != corrected
+
+
+def test_stage_key_ignores_parameter_order():
+
+    pars = dict(SPLITPARS)
+    reordered = dict(reversed(list(SPLITPARS.items())))
+
+    assert stage_key('split', pars) == stage_key('split', reordered)
+    assert stage_key('split', pars) != stage_key('mstransform', pars)
+    assert stage_key('split', pars) != stage_key('split', dict(pars, spw='0'))
+
+
+def test_tclean_outputs_include_taylor_terms():
+
+    hogbom = stage_outputs('tclean', {'imagename': 'cont'})
+    mtmfs = stage_outputs('tclean', {'imagename': 'cont',
+                                     'deconvolver': 'mtmfs', 'nterms': 3})
+
+    assert 'cont.image' in hogbom and 'cont.psf' in hogbom
+    assert not [output for output in hogbom if '.tt' in output]
+    assert 'cont.image.tt2' in mtmfs and 'cont.alpha' in mtmfs
+    assert 'cont.image.tt3' not in mtmfs
+    assert stage_outputs('uvcontsub', {'vis': 'line.ms'}) == ['line.ms.contsub']
+
+
+CLEANPARS = {'vis': 'calibrated_final.ms', 'imagename': 'cont',
+             'imsize': [100, 100], 'cell': '0.1arcsec', 'niter': 100,
+             'threshold': '1mJy'}
+
+
+def test_reclean_continues_unchanged_imaging(casa):
+
+    _make_ms('calibrated_final.ms')
+    run_stage('tclean', reclean=True, **CLEANPARS)
+    assert 'calcpsf' not in casa[-1]
+
+    # more iterations with the same imaging parameters continue the
+    # clean from the existing products
+    deeper = dict(CLEANPARS, niter=1000, threshold='0.5mJy')
+    assert can_reclean(deeper)
+    run_stage('tclean', reclean=True, **deeper)
+    assert casa[-1]['calcpsf'] is False and casa[-1]['restart'] is True
+    assert stage_is_current('tclean', **deeper)
+
+    # without reclean, or with other imaging parameters, start over
+    run_stage('tclean', **dict(deeper, niter=2000))
+    assert 'calcpsf' not in casa[-1]
+    assert not can_reclean(dict(deeper, imsize=[200, 200]))
+
+    # not without the products or after the data changed
+    shutil.rmtree('cont.psf')
+    assert not can_reclean(dict(deeper, niter=2000))
+    run_stage('tclean', **deeper)
+    _write('calibrated_final.ms/table.f3_TSM0', 'applycal')
+    assert not can_reclean(dict(deeper, niter=2000))
+    assert len(casa) == 4
@@ -0,0 +1,103 @@
+import pytest
+
+from stage_runner import make_stage, run_stages, stage_dependencies, stage_order
+
+# Stages run by the tests, in the order they ran.
+RUNS = []
+
+
+def write_file(filename, content='', fail=False):
+
+    """
+    This function is a stage that writes content to filename and
+    records its run, or raises a RuntimeError if fail is True.
+    """
+
+    RUNS.append(filename)
+    if fail:
+        raise RuntimeError("Stage failed on purpose")
+    with open(filename, 'w') as f:
+        f.write(content)
+
+
+def _stages(fail=False, content='cont'):
+
+    """
+    This function returns a chain of stages given out of order: split
+    writes cont.ms, clean reads it and writes cont.image, and export
+    reads cont.image. contsub runs after split without reading its
+    output.
+    """
+
+    return [make_stage('export', write_file, inputs=['cont.image'],
+                       outputs=['cont.fits'], filename='cont.fits'),
+            make_stage('clean', write_file, inputs=['cont.ms'],
+                       outputs=['cont.image'], filename='cont.image',
+                       fail=fail),
+            make_stage('contsub', write_file, inputs=['calibrated.ms'],
+                       outputs=['line.ms'], after=['split'],
+                       filename='line.ms'),
+            make_stage('split', write_file, inputs=['calibrated.ms'],
+                       outputs=['cont.ms'], filename='cont.ms',
+                       content=content)]
+
+
+def test_stage_order_follows_dependencies():
+
+    stages = _stages()
+    depends = stage_dependencies(stages)
+
+    assert depends == {'export': {'clean'}, 'clean': {'split'},
+                       'contsub': {'split'}, 'split': set()}
+    assert stage_order(stages, depends) == ['split', 'clean', 'export',
+                                            'contsub']
+
+
+def test_stage_dependencies_are_checked():
+
+    with pytest.raises(ValueError):
+        stage_dependencies(_stages() + [make_stage('other', write_file,
+                                                   outputs=['cont.ms'])])
+    with pytest.raises(ValueError):
+        stage_dependencies([make_stage('a', write_file, after=['missing'])])
+    with pytest.raises(ValueError):
+        stage_dependencies([make_stage('a', write_file, inputs=['b.ms'],
+                                       outputs=['a.ms']),
+                            make_stage('b', write_file, inputs=['a.ms'],
+                                       outputs=['b.ms'])])
+
+
+def test_run_stages_resumes_from_checkpoint(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    del RUNS[:]
+
+    # the clean fails: the stages before it are recorded, the stages
+    # after it are not started
+    with pytest.raises(RuntimeError):
+        run_stages(_stages(fail=True))
+    assert RUNS == ['cont.ms', 'cont.image']
+
+    # the re-run resumes at the failed stage
+    del RUNS[:]
+    completed = run_stages(_stages())
+    assert RUNS == ['cont.image', 'cont.fits', 'line.ms']
+    assert sorted(completed) == ['clean', 'contsub', 'export', 'split']
+
+    del RUNS[:]
+    run_stages(_stages())
+    assert RUNS == []
+
+    # a removed output re-runs its stage and the stages that depend on it
+    (tmp_path / 'cont.image').unlink()
+    run_stages(_stages())
+    assert RUNS == ['cont.image', 'cont.fits']
+
+    # so do changed parameters
+    del RUNS[:]
+    run_stages(_stages(content='new'))
+    assert RUNS == ['cont.ms', 'cont.image', 'cont.fits', 'line.ms']
+
+    del RUNS[:]
+    run_stages(_stages(content='new'), restart=True)
+    assert len(RUNS) == 4
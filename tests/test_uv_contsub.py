@@ -0,0 +1,69 @@
+import numpy as np
+
+from uv_contsub import subtract_polynomial
+
+
+def _spectra(nchan=64, nrow=5, fitorder=1):
+
+    """
+    This function returns a chunk of spectra (2 correlations, nchan
+    channels, nrow rows) made of a random polynomial of order fitorder
+    plus a line in channels 20 to 29, the line alone, and the line-free
+    channel mask.
+    """
+
+    rng = np.random.RandomState(3)
+    x = np.linspace(-1.0, 1.0, nchan)
+    coeffs = rng.randn(2, fitorder + 1, nrow) + 1j * rng.randn(2, fitorder + 1, nrow)
+    continuum = np.einsum('kp,cpr->ckr', x[:, np.newaxis] ** np.arange(fitorder + 1),
+                          coeffs)
+    line = np.zeros((2, nchan, nrow), dtype=np.complex64)
+    line[:, 20:30, :] = 5.0
+    fitmask = np.ones((nchan, nrow), dtype=bool)
+    fitmask[15:35, :] = False
+
+    return ((continuum + line).astype(np.complex64), line, fitmask)
+
+
+def test_subtract_polynomial_leaves_the_line():
+
+    for fitorder in [0, 1, 2]:
+        (data, line, fitmask) = _spectra(fitorder=fitorder)
+        flag = np.zeros(data.shape, dtype=bool)
+
+        (linedata, newflag) = subtract_polynomial(data, flag, fitmask,
+                                                  fitorder=fitorder)
+
+        assert linedata.dtype == data.dtype
+        assert np.allclose(linedata, line, atol=1e-4)
+        assert not newflag.any()
+
+
+def test_subtract_polynomial_ignores_flagged_channels():
+
+    (data, line, fitmask) = _spectra()
+    flag = np.zeros(data.shape, dtype=bool)
+    flag[:, 40, :] = True
+    data[:, 40, :] += 1000.0
+
+    (linedata, newflag) = subtract_polynomial(data, flag, fitmask, fitorder=1)
+
+    assert np.allclose(linedata[:, :40], line[:, :40], atol=1e-4)
+    assert np.array_equal(newflag, flag)
+
+
+def test_subtract_polynomial_flags_unfittable_spectra():
+
+    (data, line, fitmask) = _spectra(fitorder=1)
+    flag = np.zeros(data.shape, dtype=bool)
+    # leave only one unflagged line-free channel in row 2 of the first
+    # correlation, too few for a first order fit.
+    flag[0, :, 2] = True
+    flag[0, 0, 2] = False
+
+    (linedata, newflag) = subtract_polynomial(data, flag, fitmask, fitorder=1)
+
+    assert newflag[0, :, 2].all()
+    assert not newflag[1].any()
+    assert not newflag[0, :, [0, 1, 3, 4]].any()
+    assert np.allclose(linedata[1], line[1], atol=1e-4)
@@ -0,0 +1,218 @@
+import os
+import time
+
+import numpy as np
+
+from continuum_utils import _parse_ids, parse_channel_ranges
+from ms_metadata import get_ms_index
+from stage_cache import record_stage, remove_stage_outputs, stage_is_current
+
+# Rough number of bytes held in memory per visibility-channel while a
+# chunk is fitted (data, flags, weights, model, and the subtracted
+# data). Used to choose the number of rows per chunk.
+BYTES_PER_VISCHAN = 64
+
+
+def _fit_masks(fitspw, nchans):
+
+    """
+    This function turns fitspw into a dictionary mapping each field id
+    (None for all fields) to a dictionary of boolean masks of the
+    line-free channels of each spw (see
+    continuum_utils.parse_channel_ranges). fitspw is a channel selection
+    string for all fields or a dictionary mapping field ids (or
+    comma-separated lists of field ids) to selection strings, with the
+    key '' for the remaining fields.
+    """
+
+    if isinstance(fitspw, str):
+        return {None: parse_channel_ranges(fitspw, nchans)}
+
+    masks = {}
+    for (fields, chanstring) in fitspw.items():
+        spwmasks = parse_channel_ranges(chanstring, nchans)
+        if fields == '':
+            masks[None] = spwmasks
+            continue
+        for field in _parse_ids(fields):
+            masks[field] = spwmasks
+
+    return masks
+
+
+def subtract_polynomial(data, flag, fitmask, fitorder=1, weight=None):
+
+    """
+    This function fits and subtracts a polynomial of order fitorder
+    from each spectrum of a chunk of visibilities. data and flag have
+    the shape of the DATA column (correlation, channel, row) and fitmask
+    (channel, row) selects the line-free channels of each row. The fits
+    of all spectra are done at once by solving the weighted normal
+    equations (weights from weight, e.g., WEIGHT_SPECTRUM, if given),
+    using only unflagged line-free channels. The polynomial is evaluated
+    over all channels and subtracted.
+
+    It returns the continuum subtracted data and the flags, with the
+    spectra that have no more than fitorder unflagged line-free channels
+    flagged.
+
+    Example:
+        (linedata, flag) = subtract_polynomial(data, flag, fitmask, fitorder=1)
+    """
+
+    nchan = data.shape[1]
+    x = np.linspace(-1.0, 1.0, nchan)
+    basis = x[:, np.newaxis] ** np.arange(fitorder + 1)
+
+    w = (fitmask[np.newaxis, :, :] & ~flag).astype(np.float64)
+    if weight is not None:
+        w *= weight
+
+    normal = np.einsum('ckr,kp,kq->crpq', w, basis, basis, optimize=True)
+    rhs = np.einsum('ckr,kp->crp', w * data, basis, optimize=True)
+
+    good = (w > 0).sum(axis=1) > fitorder
+    normal[~good] = np.eye(fitorder + 1)
+    rhs[~good] = 0.0
+
+    coeffs = np.linalg.solve(normal.astype(rhs.dtype), rhs[..., np.newaxis])[..., 0]
+    model = np.einsum('kp,crp->ckr', basis, coeffs, optimize=True)
+
+    return ((data - model).astype(data.dtype), flag | ~good[:, np.newaxis, :])
+
+
+def _subtract_table(vis, fitmasks, linespws, fitorder, incolumn, outcolumn,
+                    memory):
+
+    """
+    This function does the continuum subtraction of the line spws of vis
+    in chunks of rows (see uv_contsub), reading incolumn and writing
+    outcolumn and FLAG.
+    """
+
+    from casatools import table
+
+    tb = table()
+    tb.open(os.path.join(vis, 'DATA_DESCRIPTION'))
+    ddspws = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+
+    tb.open(vis, nomodify=False)
+    useweights = 'WEIGHT_SPECTRUM' in tb.colnames()
+    for (ddid, spw) in enumerate(ddspws):
+        if spw not in linespws:
+            continue
+        subtb = tb.query('DATA_DESC_ID == %d' % ddid)
+        nrows = subtb.nrows()
+        if nrows == 0:
+            subtb.close()
+            continue
+
+        (ncorr, nchan) = subtb.getcol('FLAG', 0, 1).shape[:2]
+        chunksize = max(1, int(memory // (BYTES_PER_VISCHAN * ncorr * nchan)))
+        print("Subtracting the continuum from spw %d (%d rows, %d rows per chunk)" %
+              (spw, nrows, chunksize))
+
+        for startrow in range(0, nrows, chunksize):
+            nrow = min(chunksize, nrows - startrow)
+            fields = subtb.getcol('FIELD_ID', startrow, nrow)
+            fitmask = np.empty((nchan, nrow), dtype=bool)
+            for field in np.unique(fields):
+                spwmasks = fitmasks.get(int(field), fitmasks.get(None))
+                if spwmasks is None or spw not in spwmasks:
+                    raise ValueError("No line-free channels given for spw %d "
+                                     "of field %d" % (spw, field))
+                fitmask[:, fields == field] = spwmasks[spw][:, np.newaxis]
+
+            data = subtb.getcol(incolumn, startrow, nrow)
+            flag = subtb.getcol('FLAG', startrow, nrow)
+            weight = (subtb.getcol('WEIGHT_SPECTRUM', startrow, nrow)
+                      if useweights else None)
+
+            (linedata, flag) = subtract_polynomial(data, flag, fitmask,
+                                                   fitorder=fitorder,
+                                                   weight=weight)
+            subtb.putcol(outcolumn, linedata, startrow, nrow)
+            subtb.putcol('FLAG', flag, startrow, nrow)
+        subtb.close()
+    tb.close()
+
+
+def uv_contsub(vis, fitspw, linespw, fitorder=1, outputvis='',
+               datacolumn='data', memory=2.0e9, usecache=True):
+
+    """
+    This function subtracts the continuum from the line spws linespw of
+    vis in the uv plane, like uvcontsub with solint='int': a polynomial
+    of order fitorder is fitted to the line-free channels fitspw of each
+    integration, baseline, and correlation, and subtracted. The data are
+    streamed in chunks of rows of at most about memory bytes, so the
+    memory use doesn't depend on the size of the ms, and all spectra of a
+    chunk are fitted at once with NumPy (see subtract_polynomial).
+
+    fitspw is either a channel selection string (e.g.,
+    '2:0~1200;1500~3839,3:0~1200;1500~3839') for all fields, or a
+    dictionary mapping field ids to selection strings for fields whose
+    line-free channels differ, with the key '' for all other fields, so
+    all fields are subtracted in one pass. Every line spw must have
+    line-free channels in fitspw.
+
+    If outputvis is given (e.g., vis + '.contsub'), the line spws are
+    split into outputvis (keeping their spw ids) and the continuum is
+    subtracted there. Like the cached tasks (see stage_cache.py), this
+    is skipped if outputvis is up to date unless usecache is False. If
+    outputvis is '', the continuum subtracted data are written to the
+    CORRECTED_DATA column of vis (created from datacolumn if needed),
+    which saves writing a new ms. Image it with datacolumn='corrected',
+    and note that applycal would overwrite it. The spectra that can't be
+    fitted are then flagged in vis itself, so the flags of vis are first
+    saved with flagmanager as 'before_uv_contsub'. Restore them with
+    flagmanager(vis=vis, mode='restore', versionname='before_uv_contsub')
+    before using vis for anything else.
+
+    Example:
+        uv_contsub('calibrated_final.ms',
+                   {'': '2:0~1200;1500~3839,3:0~1200;1500~3839',
+                    '3,4': '2:0~1000;1700~3839,3:0~1200;1500~3839'},
+                   '2,3', outputvis='calibrated_final.ms.contsub')
+    """
+
+    from casatasks import clearcal, flagmanager, mstransform
+
+    index = get_ms_index(vis)
+    nchans = dict((spw['id'], spw['nchan']) for spw in index['spws'])
+    fitmasks = _fit_masks(fitspw, nchans)
+    linespws = _parse_ids(linespw)
+    incolumn = {'data': 'DATA', 'corrected': 'CORRECTED_DATA'}[datacolumn.lower()]
+
+    if not outputvis:
+        from casatools import table
+
+        tb = table()
+        tb.open(vis)
+        hascorrected = 'CORRECTED_DATA' in tb.colnames()
+        tb.close()
+        if not hascorrected:
+            clearcal(vis=vis, addmodel=False)
+        flagmanager(vis=vis, mode='save', versionname='before_uv_contsub',
+                    comment='flags before uv_contsub flagged the spectra it '
+                    'could not fit')
+        _subtract_table(vis, fitmasks, linespws, fitorder, incolumn,
+                        'CORRECTED_DATA', memory)
+        return
+
+    params = {'vis': vis, 'outputvis': outputvis, 'fitspw': fitspw,
+              'linespw': linespw, 'fitorder': fitorder,
+              'datacolumn': datacolumn}
+    if usecache and stage_is_current('uvcontsubstream', **params):
+        print("Skipping continuum subtraction for " + outputvis +
+              ": products are up to date.")
+        return
+
+    remove_stage_outputs('uvcontsubstream', params)
+    starttime = time.time()
+    mstransform(vis=vis, outputvis=outputvis, spw=linespw,
+                datacolumn=datacolumn, reindex=False)
+    _subtract_table(outputvis, fitmasks, linespws, fitorder, 'DATA', 'DATA',
+                    memory)
+    record_stage('uvcontsubstream', params, time.time() - starttime)